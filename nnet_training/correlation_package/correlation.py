@@ -71,13 +71,20 @@ class Correlation(torch.nn.Module):
 
     def forward(self, input1, input2):
         if self.training:
-            return CorrelationFunction.apply(
+            output = CorrelationFunction.apply(
+                input1, input2, self.pad_size, self.kernel_size,
+                self.max_displacement, self.stride1, self.stride2, self.corr_multiply)
+        else:
+            output = torch.ops.cerberus.correlation(
                 input1, input2, self.pad_size, self.kernel_size,
                 self.max_displacement, self.stride1, self.stride2, self.corr_multiply)
 
-        return torch.ops.cerberus.correlation(
-            input1, input2, self.pad_size, self.kernel_size,
-            self.max_displacement, self.stride1, self.stride2, self.corr_multiply)
+        # Kernel reads through strided accessors so any input layout is accepted,
+        # but the output is always allocated NCHW, match the input layout again.
+        if input1.is_contiguous(memory_format=torch.channels_last):
+            output = output.contiguous(memory_format=torch.channels_last)
+
+        return output
 
 if __name__ == '__main__':
     import time
@@ -22,22 +22,26 @@ import matplotlib.pyplot as plt
 import torch
 import torchvision
 from nnet_training.nnet_models import get_model
+from nnet_training.loss_functions.UnFlowLoss import upsample_flow
 
 from nnet_training.utilities.visualisation import flow_to_image, get_color_pallete
 from nnet_training.utilities.kitti_dataset import Kitti2015Dataset
 from nnet_training.utilities.cityscapes_dataset import CityScapesDataset
+from nnet_training.utilities.dataset_statistics import resolve_dataset_statistics, get_max_depth
 from nnet_training.utilities.metrics import SegmentationMetric, DepthMetric, OpticFlowMetric
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 MIN_DEPTH = 0.
-MAX_DEPTH = 80.
 
-def data_to_gpu(data):
+def data_to_gpu(data, memory_format=torch.contiguous_format):
     """Put both image and target onto device"""
     cuda_s = torch.cuda.Stream()
     with torch.cuda.stream(cuda_s):
         for key in data:
-            if key in ['l_img', 'l_seq', 'seg', 'l_disp', 'r_img', 'r_seq', 'r_disp']:
+            if key in ['l_img', 'l_seq', 'r_img', 'r_seq']:
+                data[key] = data[key].cuda(non_blocking=True).contiguous(
+                    memory_format=memory_format)
+            elif key in ['seg', 'l_disp', 'r_disp']:
                 data[key] = data[key].cuda(non_blocking=True)
 
         if all(key in data.keys() for key in ["flow", "flow_mask"]):
@@ -59,6 +63,8 @@ def initialise_evaluation(config_json: EasyDict, experiment_path: Path)\
     else:
         n_workers = min(multiprocessing.cpu_count(), config_json.dataset.batch_size)
 
+    resolve_dataset_statistics(config_json)
+
     if config_json.dataset.type == "Kitti":
         dataset = Kitti2015Dataset(
             config_json.dataset.rootdir, config_json.dataset.objectives,
@@ -100,7 +106,7 @@ def run_evaluation(model, dataloader, loggers):
     start_time = time.time()
 
     for batch_idx, data in enumerate(dataloader):
-        data_to_gpu(data)
+        data_to_gpu(data, model.memory_format)
         forward = model(**data)
 
         if 'flow' in forward.keys():
@@ -137,10 +143,10 @@ def run_evaluation(model, dataloader, loggers):
                              f' Remain: {time_remain:.1f} s')
             sys.stdout.flush()
 
-def display_output(model, dataloader):
+def display_output(model, dataloader, max_depth):
     """Displays some sample outputs"""
     batch_data = next(iter(dataloader))
-    data_to_gpu(batch_data)
+    data_to_gpu(batch_data, model.memory_format)
 
     start_time = time.time()
     forward = model(**batch_data)
@@ -154,7 +160,8 @@ def display_output(model, dataloader):
         seg_pred_cpu = torch.argmax(forward['seg'], dim=1).cpu().numpy()
 
     if 'flow' in forward:
-        np_flow_12 = forward['flow'][0].detach().cpu().numpy()
+        np_flow_12 = upsample_flow(
+            forward['flow'][0].detach(), batch_data['l_img'].shape[2:]).cpu().numpy()
 
     if hasattr(dataloader.dataset, 'img_normalize'):
         img_mean = dataloader.dataset.img_normalize.mean
@@ -198,12 +205,12 @@ def display_output(model, dataloader):
         if 'depth' in forward and 'l_disp' in batch_data:
             plt.subplot(2, 4, 4)
             plt.imshow(depth_gt_cpu[i], cmap='magma',
-                       vmin=MIN_DEPTH, vmax=MAX_DEPTH)
+                       vmin=MIN_DEPTH, vmax=max_depth)
             plt.xlabel("Ground Truth Disparity")
 
             plt.subplot(2, 4, 8)
             plt.imshow(depth_pred_cpu[i, 0], cmap='magma',
-                       vmin=MIN_DEPTH, vmax=MAX_DEPTH)
+                       vmin=MIN_DEPTH, vmax=max_depth)
             plt.xlabel("Predicted Depth")
 
         plt.suptitle("Propagation time: " + str(propagation_time))
@@ -213,6 +220,8 @@ if __name__ == "__main__":
     PARSER = argparse.ArgumentParser()
     PARSER.add_argument('-c', '--config', default='configs/HRNetV2_sfd_kt.json')
     # PARSER.add_argument('-e', '--experiment', default='b81f8227a42faffbd2ba1c01726fd56f')
+    PARSER.add_argument('--compile', nargs='?', const='default', default=None,
+                        help='Run the model with torch.compile, optionally giving the compile mode')
 
     if 'config' in PARSER.parse_args():
         with open(PARSER.parse_args().config) as f:
@@ -237,12 +246,16 @@ if __name__ == "__main__":
                     CFG = EasyDict(json.load(f))
                 break
 
+    if PARSER.parse_args().compile is not None:
+        CFG.model.compile = {"mode": PARSER.parse_args().compile}
+
     MODEL, DATALOADER = initialise_evaluation(CFG, MODEL_PATH)
 
     LOGGERS = {
         'seg' : SegmentationMetric(19, base_dir=Path.cwd(), main_metric="IoU", savefile=''),
         'flow': OpticFlowMetric(base_dir=Path.cwd(), main_metric="EPE", savefile=''),
-        'depth': DepthMetric(base_dir=Path.cwd(), main_metric="RMSE_Log", savefile='')
+        'depth': DepthMetric(base_dir=Path.cwd(), main_metric="RMSE_Log", savefile='',
+                             max_depth=get_max_depth(CFG.dataset))
     }
 
     with torch.no_grad():
@@ -255,4 +268,4 @@ if __name__ == "__main__":
 
         while bool(input("Display Example? (Y): ")):
             torch.cuda.empty_cache()
-            display_output(MODEL, DATALOADER)
+            display_output(MODEL, DATALOADER, get_max_depth(CFG.dataset))
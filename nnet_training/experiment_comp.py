@@ -54,12 +54,13 @@ def epoch_summary_comparison(experiment_dict: Dict[str, Union[EasyDict, MetricBa
         # Plot each metric on a different subplot
         for idx, metric in enumerate(sample_data):
             for name, summary_dict in experiment_data.items():
+                epochs = summary_dict[metric]["Validation_Epochs"]
                 data_mean = summary_dict[metric]["Validation_Mean"]
                 data_conf = stats.t.ppf(0.95, n_samples-1) * \
                     summary_dict[metric]["Validation_Variance"] / np.sqrt(n_samples)
-                axis[idx].plot(data_mean, label=experiment_dict[name]['config'].note)
+                axis[idx].plot(epochs, data_mean, label=experiment_dict[name]['config'].note)
                 axis[idx].fill_between(
-                    np.arange(0, data_mean.shape[0]),
+                    epochs,
                     data_mean - data_conf,
                     data_mean + data_conf,
                     alpha=0.2)
@@ -91,7 +92,7 @@ def segmentation_comparison(experiment_dict: Dict[str, Union[EasyDict, MetricBas
         for exper_hash, summary_dict in experiment_data.items():
             for idx in range(19):
                 axis[idx%3][idx//3].plot(
-                    summary_dict[statistic][:, idx],
+                    summary_dict['epochs'], summary_dict[statistic][:, idx],
                     label=experiment_dict[exper_hash]['config'].note)
 
     for statistic, (fig, axis) in plots.items():
@@ -1,11 +1,14 @@
 
+from typing import Dict, Tuple
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from .loss_functions import SSIM
+from .loss_functions import SSIM, reduce_loss
+from .pyramid_cache import PyramidCache
 
-__all__ = ['unFlowLoss', 'flow_warp']
+__all__ = ['unFlowLoss', 'flow_warp', 'upsample_flow', 'TernaryTransform', 'OcclusionMask']
 
 def mesh_grid(batch_sz, height, width):
     '''
@@ -30,66 +33,40 @@ def norm_grid(v_grid):
     v_grid_norm[:, 1, :, :] = 2.0 * v_grid[:, 1, :, :] / (height - 1) - 1.0
     return v_grid_norm.permute(0, 2, 3, 1)  # BHW2
 
-def get_corresponding_map(data):
+# Normalised base grid and flow scale of each (height, width, dtype, device)
+_BASE_GRIDS: Dict[Tuple[int, int, torch.dtype, torch.device], Tuple[torch.Tensor, torch.Tensor]] = {}
+
+def get_base_grid(height: int, width: int, dtype: torch.dtype,
+                  device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
     """
-    :param data: unnormalized coordinates Bx2xHxW
-    :return: Bx1xHxW
+    Returns the identity sampling grid normalised to (-1,1) with shape 1HW2 and the
+    scale that converts a pixel flow to the same normalised units, built once per
+    resolution, dtype and device
     """
-    B, _, H, W = data.size()
-
-    x = data[:, 0, :, :].view(B, -1)  # BxN (N=H*W)
-    y = data[:, 1, :, :].view(B, -1)
-
-    x1 = torch.floor(x)
-    x_floor = x1.clamp(0, W - 1)
-    y1 = torch.floor(y)
-    y_floor = y1.clamp(0, H - 1)
-    x0 = x1 + 1
-    x_ceil = x0.clamp(0, W - 1)
-    y0 = y1 + 1
-    y_ceil = y0.clamp(0, H - 1)
-
-    x_ceil_out = x0 != x_ceil
-    y_ceil_out = y0 != y_ceil
-    x_floor_out = x1 != x_floor
-    y_floor_out = y1 != y_floor
-    invalid = torch.cat([x_ceil_out | y_ceil_out,
-                         x_ceil_out | y_floor_out,
-                         x_floor_out | y_ceil_out,
-                         x_floor_out | y_floor_out], dim=1)
-
-    # encode coordinates, since the scatter function can only index along one axis
-    corresponding_map = torch.zeros(B, H * W).type_as(data)
-    indices = torch.cat([x_ceil + y_ceil * W,
-                         x_ceil + y_floor * W,
-                         x_floor + y_ceil * W,
-                         x_floor + y_floor * W], 1).long()  # BxN   (N=4*H*W)
-    values = torch.cat([(1 - torch.abs(x - x_ceil)) * (1 - torch.abs(y - y_ceil)),
-                        (1 - torch.abs(x - x_ceil)) * (1 - torch.abs(y - y_floor)),
-                        (1 - torch.abs(x - x_floor)) * (1 - torch.abs(y - y_ceil)),
-                        (1 - torch.abs(x - x_floor)) * (1 - torch.abs(y - y_floor))],
-                       1)
-    # values = torch.ones_like(values)
-
-    values[invalid] = 0
-
-    corresponding_map.scatter_add_(1, indices, values)
-    # decode coordinates
-    corresponding_map = corresponding_map.view(B, H, W)
-
-    return corresponding_map.unsqueeze(1)
+    key = (height, width, dtype, device)
+    if key not in _BASE_GRIDS:
+        base_grid = norm_grid(mesh_grid(1, height, width).to(device=device, dtype=dtype))
+        scale = torch.tensor([2.0 / (width - 1), 2.0 / (height - 1)], dtype=dtype, device=device)
+        _BASE_GRIDS[key] = (base_grid, scale)
+    return _BASE_GRIDS[key]
 
 def flow_warp(image, flow12, pad='border', mode='bilinear'):
     '''
     Warps an image given a flow prediction using grid_sample
     '''
-    batch_sz, _, height, width = image.size()
+    _, _, height, width = image.size()
 
-    base_grid = mesh_grid(batch_sz, height, width).type_as(image)  # B2HW
+    base_grid, scale = get_base_grid(height, width, image.dtype, image.device)
 
-    v_grid = norm_grid(base_grid + flow12)  # BHW2
+    # base + flow * scale broadcast over the batch, BHW2
+    v_grid = torch.addcmul(base_grid, flow12.permute(0, 2, 3, 1).type_as(image), scale)
     im1_recons = nn.functional.grid_sample(image, v_grid, mode=mode, padding_mode=pad,
                                            align_corners=False)
+
+    # grid_sample always returns NCHW, keep channels_last inputs channels_last
+    if image.is_contiguous(memory_format=torch.channels_last):
+        im1_recons = im1_recons.contiguous(memory_format=torch.channels_last)
+
     return im1_recons
 
 def get_occu_mask_bidirection(flow12, flow21, scale=0.01, bias=0.5):
@@ -104,62 +81,129 @@ def get_occu_mask_bidirection(flow12, flow21, scale=0.01, bias=0.5):
     occ = (flow12_diff * flow12_diff).sum(1, keepdim=True) > occ_thresh
     return occ.float()
 
+def get_range_map(flow21):
+    '''
+    Number of pixels of the other image that bilinearly land on each pixel when
+    following flow21, splatted one corner at a time so the temporaries are a
+    single BxHxW index and weight rather than four of each
+    '''
+    batch_sz, _, height, width = flow21.size()
+    x_coords = flow21[:, 0] + torch.arange(width, dtype=flow21.dtype, device=flow21.device)
+    y_coords = flow21[:, 1] + torch.arange(
+        height, dtype=flow21.dtype, device=flow21.device).unsqueeze(1)
+
+    x_floor = torch.floor(x_coords)
+    y_floor = torch.floor(y_coords)
+    x_frac = x_coords - x_floor
+    y_frac = y_coords - y_floor
+
+    # Bilinear weight along each axis, zero where that corner is outside the image
+    x_weights = [(1 - x_frac) * ((x_floor >= 0) & (x_floor < width)),
+                 x_frac * ((x_floor >= -1) & (x_floor < width - 1))]
+    y_weights = [(1 - y_frac) * ((y_floor >= 0) & (y_floor < height)),
+                 y_frac * ((y_floor >= -1) & (y_floor < height - 1))]
+
+    # Corners outside the image have zero weight so only need an index in bounds
+    n_pixels = batch_sz * height * width
+    batch_offset = torch.arange(batch_sz, device=flow21.device).view(-1, 1, 1) * height * width
+    index = (y_floor * width + x_floor).long() + batch_offset
+
+    range_map = torch.zeros(n_pixels, dtype=flow21.dtype, device=flow21.device)
+    for y_step, y_weight in enumerate(y_weights):
+        for x_step, x_weight in enumerate(x_weights):
+            range_map.scatter_add_(
+                0, (index + (y_step * width + x_step)).clamp_(0, n_pixels - 1).view(-1),
+                (y_weight * x_weight).view(-1))
+
+    return range_map.view(batch_sz, 1, height, width)
+
 def get_occu_mask_backward(flow21, theta=0.2):
     '''
     Get an occlusion mask using backward propagation
     '''
-    B, _, H, W = flow21.size()
-    base_grid = mesh_grid(B, H, W).type_as(flow21)  # B2HW
-
-    corr_map = get_corresponding_map(base_grid + flow21)  # BHW
+    corr_map = get_range_map(flow21)
     occu_mask = corr_map.clamp(min=0., max=1.) < theta
     return occu_mask.float()
 
-# Credit: https://github.com/simonmeister/UnFlow/blob/master/src/e2eflow/core/losses.py
-def TernaryLoss(im, im_warp, max_distance=1):
-    patch_size = 2 * max_distance + 1
+class OcclusionMask(nn.Module):
+    """
+    Non-occluded (visible) masks of both images of a pair, 1 where visible.\n
+    mode 'bidirection' marks pixels whose forward and backward flows disagree, mode
+    'range' marks pixels that no pixel of the other image flows onto (range map).\n
+    Both directions are evaluated in one batched call in float32 without gradients,
+    half precision loses the integer pixel indices of the range map beyond 2048.
+    """
+    def __init__(self, mode='bidirection', scale=0.01, bias=0.5, theta=0.2):
+        super(OcclusionMask, self).__init__()
+        if mode not in ['bidirection', 'range']:
+            raise NotImplementedError(mode)
+        self.mode = mode
+        self.scale = scale
+        self.bias = bias
+        self.theta = theta
+
+    @torch.no_grad()
+    def forward(self, flow12: torch.Tensor, flow21: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        flow12 = flow12.float()
+        flow21 = flow21.float()
+        if self.mode == 'bidirection':
+            occ = get_occu_mask_bidirection(
+                torch.cat([flow12, flow21]), torch.cat([flow21, flow12]), self.scale, self.bias)
+        else:
+            occ = get_occu_mask_backward(torch.cat([flow21, flow12]), self.theta)
+        return (1 - occ).chunk(2)
 
-    def _rgb_to_grayscale(image):
-        grayscale = image[:, 0, :, :] * 0.2989 + \
-                    image[:, 1, :, :] * 0.5870 + \
-                    image[:, 2, :, :] * 0.1140
-        return grayscale.unsqueeze(1)
+def upsample_flow(flow: torch.Tensor, size: Tuple[int, int], mode='bilinear') -> torch.Tensor:
+    '''
+    Resizes a Bx2xHxW flow to size, scaling the flow vectors by the
+    change in width and height so they remain in pixels of the new size
+    '''
+    height, width = flow.size()[2:]
+    if (height, width) == tuple(size):
+        return flow
 
-    def _ternary_transform(image):
-        intensities = _rgb_to_grayscale(image) * 255
+    flow_scale = flow.new_tensor([size[1] / width, size[0] / height]).view(1, 2, 1, 1)
+    return F.interpolate(flow, size=tuple(size), mode=mode, align_corners=True) * flow_scale
+
+# Credit: https://github.com/simonmeister/UnFlow/blob/master/src/e2eflow/core/losses.py
+class TernaryTransform(nn.Module):
+    """
+    Soft census transform with the grayscale and patch kernels held as buffers.
+    Images to be compared should be concatenated along the batch and transformed
+    in a single call, then compared with distance().
+    """
+    def __init__(self, max_distance=1):
+        super(TernaryTransform, self).__init__()
+        self.max_distance = max_distance
+        patch_size = 2 * max_distance + 1
         out_channels = patch_size * patch_size
-        w = torch.eye(out_channels).view((out_channels, 1, patch_size, patch_size))
-        weights = w.type_as(im)
-        patches = F.conv2d(intensities, weights, padding=max_distance)
+        self.register_buffer('patch_kernel', torch.eye(out_channels).view(
+            (out_channels, 1, patch_size, patch_size)))
+        self.register_buffer('gray_kernel', 255. * torch.tensor(
+            [0.2989, 0.5870, 0.1140]).view(1, 3, 1, 1))
+
+    def forward(self, image: torch.Tensor) -> torch.Tensor:
+        intensities = F.conv2d(image, self.gray_kernel.type_as(image))
+        patches = F.conv2d(intensities, self.patch_kernel.type_as(image),
+                           padding=self.max_distance)
         transf = patches - intensities
-        transf_norm = transf / torch.sqrt(0.81 + torch.pow(transf, 2))
-        return transf_norm
+        return transf * torch.rsqrt(0.81 + torch.pow(transf, 2))
 
-    def _hamming_distance(t1, t2):
+    def distance(self, t1: torch.Tensor, t2: torch.Tensor) -> torch.Tensor:
+        """
+        Soft hamming distance between two census transforms, zero at the image border
+        """
         dist = torch.pow(t1 - t2, 2)
-        dist_norm = dist / (0.1 + dist)
-        dist_mean = torch.mean(dist_norm, 1, keepdim=True)  # instead of sum
-        return dist_mean
-
-    def _valid_mask(t, padding):
-        n, _, h, w = t.size()
-        inner = torch.ones(n, 1, h - 2 * padding, w - 2 * padding).type_as(t)
-        mask = F.pad(inner, [padding] * 4)
-        return mask
-
-    t1 = _ternary_transform(im)
-    t2 = _ternary_transform(im_warp)
-    dist = _hamming_distance(t1, t2)
-    mask = _valid_mask(im, max_distance)
-
-    return dist * mask
+        dist = torch.mean(dist / (0.1 + dist), 1, keepdim=True)  # instead of sum
+        pad = self.max_distance
+        return F.pad(dist[:, :, pad:-pad, pad:-pad], [pad] * 4)
 
 def gradient(data):
     D_dy = data[:, :, 1:] - data[:, :, :-1]
     D_dx = data[:, :, :, 1:] - data[:, :, :, :-1]
     return D_dx, D_dy
 
-def smooth_grad_1st(flow, image, alpha):
+def smooth_grad_1st(flow, image, alpha, reduction='mean'):
     img_dx, img_dy = gradient(image)
     weights_x = torch.exp(-torch.mean(torch.abs(img_dx), 1, keepdim=True) * alpha)
     weights_y = torch.exp(-torch.mean(torch.abs(img_dy), 1, keepdim=True) * alpha)
@@ -169,9 +213,9 @@ def smooth_grad_1st(flow, image, alpha):
     loss_x = weights_x * dx.abs() / 2.
     loss_y = weights_y * dy.abs() / 2
 
-    return (loss_x.mean() + loss_y.mean()) / 2.
+    return (reduce_loss(loss_x, reduction) + reduce_loss(loss_y, reduction)) / 2.
 
-def smooth_grad_2nd(flow, image, alpha):
+def smooth_grad_2nd(flow, image, alpha, reduction='mean'):
     img_dx, img_dy = gradient(image)
     weights_x = torch.exp(-torch.mean(torch.abs(img_dx), 1, keepdim=True) * alpha)
     weights_y = torch.exp(-torch.mean(torch.abs(img_dy), 1, keepdim=True) * alpha)
@@ -183,13 +227,14 @@ def smooth_grad_2nd(flow, image, alpha):
     loss_x = weights_x[:, :, :, 1:] * dx2.abs()
     loss_y = weights_y[:, :, 1:, :] * dy2.abs()
 
-    return (loss_x.mean() + loss_y.mean()) / 2.
+    return (reduce_loss(loss_x, reduction) + reduce_loss(loss_y, reduction)) / 2.
 
 class unFlowLoss(nn.modules.Module):
     """
     Loss function adopted by ARFlow from originally Unflow.
     """
-    def __init__(self, weight=1.0, weights=None, consistency=True, back_occ_only=False, **kwargs):
+    def __init__(self, weight=1.0, weights=None, consistency=True, back_occ_only=False,
+                 occlusion=False, occ_args=None, **kwargs):
         super(unFlowLoss, self).__init__()
         self.weight = weight
 
@@ -200,6 +245,7 @@ class unFlowLoss(nn.modules.Module):
             self.SSIM = SSIM().to("cuda" if torch.cuda.is_available() else "cpu")
         if "ternary" in weights:
             self.ternary_weight = weights["ternary"]
+            self.ternary = TernaryTransform().to("cuda" if torch.cuda.is_available() else "cpu")
 
         if 'smooth' in kwargs:
             self.smooth_args = kwargs['smooth']
@@ -221,25 +267,42 @@ class unFlowLoss(nn.modules.Module):
         self.consistency = consistency
         self.back_occ_only = back_occ_only
 
-    def loss_photometric(self, im_orig: torch.Tensor,
-                         im_recons: torch.Tensor, occu_mask: torch.Tensor):
+        # Masks are computed from the finest flows and resized for the other levels
+        if occlusion:
+            self.occlusion = OcclusionMask('range' if back_occ_only else 'bidirection',
+                                           **(occ_args if occ_args is not None else {}))
+
+    def loss_photometric(self, im_orig: torch.Tensor, im_recons: torch.Tensor,
+                         occu_mask: torch.Tensor = None, census=None, reduction='mean'):
+        """
+        census is the (original, reconstruction) census transform pair if already
+        computed, only usable without an occlusion mask as it is of the unmasked images
+        """
         loss = []
-        if occu_mask.mean() == 0:
-            occu_mask = torch.ones_like(occu_mask)
+        if occu_mask is not None:
+            if occu_mask.mean() == 0:
+                occu_mask = torch.ones_like(occu_mask)
+            im_orig = im_orig * occu_mask
+            im_recons = im_recons * occu_mask
+            census = None
 
         if hasattr(self, 'l1_weight'):
-            loss += [self.l1_weight * (im_orig - im_recons).abs() * occu_mask]
+            loss += [self.l1_weight * (im_orig - im_recons).abs()]
 
         if hasattr(self, 'ssim_weight'):
-            loss += [self.ssim_weight * self.SSIM(im_recons * occu_mask, im_orig * occu_mask)]
+            loss += [self.ssim_weight * self.SSIM(im_recons, im_orig)]
 
         if hasattr(self, 'ternary_weight'):
-            loss += [self.ternary_weight *\
-                     TernaryLoss(im_recons * occu_mask, im_orig * occu_mask)]
+            if census is None:
+                census = self.ternary(torch.cat([im_orig, im_recons])).chunk(2)
+            loss += [self.ternary_weight * self.ternary.distance(census[1], census[0])]
 
-        return sum([l.mean() for l in loss]) / occu_mask.mean()
+        if occu_mask is None:
+            return sum([reduce_loss(l, reduction) for l in loss])
+        return sum([reduce_loss(l, reduction) for l in loss]) / \
+            reduce_loss(occu_mask, reduction).clamp(min=1e-6)
 
-    def loss_smooth(self, flow, im_scaled):
+    def loss_smooth(self, flow, im_scaled, reduction='mean'):
         if self.smooth_args['degree'] == 2:
             func_smooth = smooth_grad_2nd
         elif self.smooth_args['degree'] == 1:
@@ -248,59 +311,68 @@ class unFlowLoss(nn.modules.Module):
             raise NotImplementedError(self.smooth_args['degree'])
 
         loss = []
-        loss += [func_smooth(flow, im_scaled, self.smooth_args['alpha'])]
-        return sum([l.mean() for l in loss])
+        loss += [func_smooth(flow, im_scaled, self.smooth_args['alpha'], reduction)]
+        return sum(loss)
 
-    def forward(self, pred_flow_fw, pred_flow_bw, im1_origin, im2_origin):
+    def forward(self, pred_flow_fw, pred_flow_bw, im1_origin, im2_origin,
+                cache: PyramidCache = None, reduction='mean', **kwargs):
         """
-        :param output: Multi-scale forward/backward flows n * [B x 4 x h x w]
+        :param output: Multi-scale forward/backward flows n * [B x 2 x h x w], finest first,
+            each level is evaluated at its own resolution against area resized images
+        :param reduction: 'mean' or 'none' for the losses of each sample [B]
         :param target: image pairs Nx6xHxW
+        :param cache: PyramidCache of the batch, resized images and warps are shared
         :return:
         """
-        pyramid_flows = [torch.cat([flo12, flo21], 1) for flo12, flo21 in
-                         zip(pred_flow_fw, pred_flow_bw)]
+        if cache is None:
+            cache = PyramidCache()
 
         pyramid_warp_losses = []
         pyramid_smooth_losses = []
 
+        occu_mask1 = occu_mask2 = None
+        if hasattr(self, 'occlusion'):
+            occu_full1, occu_full2 = self.occlusion(pred_flow_fw[0], pred_flow_bw[0])
+
         s = 1.
-        for i, flow in enumerate(pyramid_flows):
+        for i, (flow12, flow21) in enumerate(zip(pred_flow_fw, pred_flow_bw)):
             if self.w_wrp_scales[i] == 0:
                 pyramid_warp_losses.append(0)
                 pyramid_smooth_losses.append(0)
                 continue
 
             # resize images to match the size of layer
-            im1_scaled = F.interpolate(im1_origin, tuple(flow.size()[2:]), mode='area')
-            im2_scaled = F.interpolate(im2_origin, tuple(flow.size()[2:]), mode='area')
+            im1_scaled = cache.resize(im1_origin, tuple(flow12.size()[2:]), mode='area')
+            im2_scaled = cache.resize(im2_origin, tuple(flow12.size()[2:]), mode='area')
 
-            im1_recons = flow_warp(im2_scaled, flow[:, :2], pad='border')
-            im2_recons = flow_warp(im1_scaled, flow[:, 2:], pad='border')
+            im1_recons = cache.apply(flow_warp, im2_scaled, flow12)
+            im2_recons = cache.apply(flow_warp, im1_scaled, flow21)
 
-            #   Occlusion mask is broken, always returns zeros...
-            # if i == 0:
-            #     if self.back_occ_only:
-            #         occu_mask1 = 1 - get_occu_mask_backward(flow[:, 2:], theta=0.2)
-            #         occu_mask2 = 1 - get_occu_mask_backward(flow[:, :2], theta=0.2)
-            #     else:
-            #         occu_mask1 = 1 - get_occu_mask_bidirection(flow[:, :2], flow[:, 2:])
-            #         occu_mask2 = 1 - get_occu_mask_bidirection(flow[:, 2:], flow[:, :2])
-            # else:
-            #     occu_mask1 = F.interpolate(occu_mask1, tuple(flow.size()[2:]), mode='nearest')
-            #     occu_mask2 = F.interpolate(occu_mask2, tuple(flow.size()[2:]), mode='nearest')
+            if hasattr(self, 'occlusion'):
+                occu_mask1 = cache.resize(occu_full1, tuple(flow12.size()[2:]), mode='nearest')
+                occu_mask2 = cache.resize(occu_full2, tuple(flow12.size()[2:]), mode='nearest')
 
-            occu_mask1 = occu_mask2 = torch.ones_like(im1_scaled)
+            # Census transforms of both directions in one pass
+            census1 = census2 = None
+            if hasattr(self, 'ternary_weight') and occu_mask1 is None:
+                images = [im1_scaled, im1_recons]
+                if self.consistency:
+                    images += [im2_scaled, im2_recons]
+                census = self.ternary(torch.cat(images)).chunk(len(images))
+                census1, census2 = census[:2], census[2:]
 
-            loss_warp = self.loss_photometric(im1_scaled, im1_recons, occu_mask1)
+            loss_warp = self.loss_photometric(
+                im1_scaled, im1_recons, occu_mask1, census1, reduction)
 
             if i == 0:
-                s = min(flow.size()[2:])
+                s = min(flow12.size()[2:])
 
-            loss_smooth = self.loss_smooth(flow[:, :2] / s, im1_scaled)
+            loss_smooth = self.loss_smooth(flow12 / s, im1_scaled, reduction)
 
             if self.consistency:
-                loss_warp += self.loss_photometric(im2_scaled, im2_recons, occu_mask2)
-                loss_smooth += self.loss_smooth(flow[:, 2:] / s, im2_scaled)
+                loss_warp += self.loss_photometric(
+                    im2_scaled, im2_recons, occu_mask2, census2, reduction)
+                loss_smooth += self.loss_smooth(flow21 / s, im2_scaled, reduction)
 
                 loss_warp /= 2.
                 loss_smooth /= 2.
@@ -317,4 +389,98 @@ class unFlowLoss(nn.modules.Module):
         smooth_loss = self.weight * self.smooth_args['weighting'] * sum(pyramid_smooth_losses)
         total_loss = warp_loss + smooth_loss
 
-        return total_loss, warp_loss, smooth_loss, pyramid_flows[0].abs().mean()
+        flow_mean = (pred_flow_fw[0].abs().mean() + pred_flow_bw[0].abs().mean()) / 2.
+        return total_loss, warp_loss, smooth_loss, flow_mean
+
+
+if __name__ == '__main__':
+    import time
+
+    def _previous_corresponding_map(data):
+        """
+        Previous range map with all four corners gathered then scattered at once
+        :param data: unnormalized coordinates Bx2xHxW
+        :return: Bx1xHxW
+        """
+        B, _, H, W = data.size()
+
+        x = data[:, 0, :, :].view(B, -1)  # BxN (N=H*W)
+        y = data[:, 1, :, :].view(B, -1)
+
+        x1 = torch.floor(x)
+        x_floor = x1.clamp(0, W - 1)
+        y1 = torch.floor(y)
+        y_floor = y1.clamp(0, H - 1)
+        x0 = x1 + 1
+        x_ceil = x0.clamp(0, W - 1)
+        y0 = y1 + 1
+        y_ceil = y0.clamp(0, H - 1)
+
+        x_ceil_out = x0 != x_ceil
+        y_ceil_out = y0 != y_ceil
+        x_floor_out = x1 != x_floor
+        y_floor_out = y1 != y_floor
+        invalid = torch.cat([x_ceil_out | y_ceil_out,
+                             x_ceil_out | y_floor_out,
+                             x_floor_out | y_ceil_out,
+                             x_floor_out | y_floor_out], dim=1)
+
+        # encode coordinates, since the scatter function can only index along one axis
+        corresponding_map = torch.zeros(B, H * W).type_as(data)
+        indices = torch.cat([x_ceil + y_ceil * W,
+                             x_ceil + y_floor * W,
+                             x_floor + y_ceil * W,
+                             x_floor + y_floor * W], 1).long()  # BxN   (N=4*H*W)
+        values = torch.cat([(1 - torch.abs(x - x_ceil)) * (1 - torch.abs(y - y_ceil)),
+                            (1 - torch.abs(x - x_ceil)) * (1 - torch.abs(y - y_floor)),
+                            (1 - torch.abs(x - x_floor)) * (1 - torch.abs(y - y_ceil)),
+                            (1 - torch.abs(x - x_floor)) * (1 - torch.abs(y - y_floor))],
+                           1)
+        # values = torch.ones_like(values)
+
+        values[invalid] = 0
+
+        corresponding_map.scatter_add_(1, indices, values)
+        # decode coordinates
+        corresponding_map = corresponding_map.view(B, H, W)
+
+        return corresponding_map.unsqueeze(1)
+
+    def _benchmark(func, n_iter=10):
+        for _ in range(2):
+            func()
+        if DEVICE.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start_time = time.time()
+        for _ in range(n_iter):
+            func()
+        if DEVICE.type == 'cuda':
+            torch.cuda.synchronize()
+            return f"{1000. * (time.time() - start_time) / n_iter:.3f}ms, " \
+                f"peak {torch.cuda.max_memory_allocated() / 2**20:.1f}MB"
+        return f"{1000. * (time.time() - start_time) / n_iter:.3f}ms"
+
+    DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    FLOWS_FW = [(8 * torch.randn(4, 2, 256 // 2**i, 512 // 2**i, device=DEVICE)).requires_grad_()
+                for i in range(4)]
+    FLOWS_BW = [(8 * torch.randn(4, 2, 256 // 2**i, 512 // 2**i, device=DEVICE)).requires_grad_()
+                for i in range(4)]
+    IMAGES = [torch.rand(4, 3, 256, 512, device=DEVICE) for _ in range(2)]
+
+    PREVIOUS = lambda: _previous_corresponding_map(
+        mesh_grid(4, 256, 512).to(FLOWS_BW[0]) + FLOWS_BW[0].detach())
+    REFERENCE = PREVIOUS()
+    print(f"range map difference: "
+          f"{(get_range_map(FLOWS_BW[0].detach()) - REFERENCE).abs().max().item():.3e}")
+    print(f"{'previous range map':>24} on {DEVICE}: {_benchmark(PREVIOUS)}")
+    print(f"{'range map':>24} on {DEVICE}: "
+          f"{_benchmark(lambda: get_range_map(FLOWS_BW[0].detach()))}")
+
+    WEIGHTS = {"l1": 0.15, "ssim": 0.85, "ternary": 0.0}
+    for name, loss_fn in [
+            ("no occlusion", unFlowLoss(weights=WEIGHTS)),
+            ("bidirection occlusion", unFlowLoss(weights=WEIGHTS, occlusion=True)),
+            ("range map occlusion", unFlowLoss(weights=WEIGHTS, occlusion=True, back_occ_only=True))]:
+        step = lambda: loss_fn(FLOWS_FW, FLOWS_BW, *IMAGES)[0].backward()
+        print(f"{name:>24} on {DEVICE}: forward+backward {_benchmark(step)}")
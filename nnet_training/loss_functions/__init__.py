@@ -6,10 +6,13 @@ from typing import Dict, List
 
 import torch
 
-from .depth_losses import InvHuberLoss, InvHuberLossPyr, DepthAwareLoss, ScaleInvariantError
+from .depth_losses import InvHuberLoss, InvHuberLossPyr, DepthAwareLoss, ScaleInvariantError, \
+    DepthReconstructionLossV1
 from .UnFlowLoss import unFlowLoss
 from .rmi import RMILoss, RMILossAux, MultiScaleRMILoss
-from .seg_losses import FocalLoss2D, SegCrossEntropy
+from .seg_losses import FocalLoss2D, SegCrossEntropy, MixSoftmaxCrossEntropyOHEMLoss
+from .pyramid_cache import PyramidCache
+from .valid_pixels import ValidPixels, depth_pixels, flow_pixels
 
 def get_loss_function(loss_config) -> Dict[str, torch.nn.Module]:
     """
@@ -30,6 +33,8 @@ def get_loss_function(loss_config) -> Dict[str, torch.nn.Module]:
             loss_fn_dict[loss_fn['type']] = DepthAwareLoss(**loss_fn.args)
         elif loss_fn['function'] == "InvHuberLossPyr":
             loss_fn_dict[loss_fn['type']] = InvHuberLossPyr(**loss_fn.args)
+        elif loss_fn['function'] == "DepthReconstructionLossV1":
+            loss_fn_dict[loss_fn['type']] = DepthReconstructionLossV1(**loss_fn.args)
         elif loss_fn['function'] == "RMILoss":
             loss_fn_dict[loss_fn['type']] = RMILoss(**loss_fn.args)
         elif loss_fn['function'] == "RMILossAux":
@@ -38,6 +43,8 @@ def get_loss_function(loss_config) -> Dict[str, torch.nn.Module]:
             loss_fn_dict[loss_fn['type']] = MultiScaleRMILoss(**loss_fn.args)
         elif loss_fn['function'] == "SegCrossEntropy":
             loss_fn_dict[loss_fn['type']] = SegCrossEntropy(**loss_fn.args)
+        elif loss_fn['function'] == "MixSoftmaxCrossEntropyOHEMLoss":
+            loss_fn_dict[loss_fn['type']] = MixSoftmaxCrossEntropyOHEMLoss(**loss_fn.args)
         else:
             raise NotImplementedError(loss_fn['function'])
 
@@ -1,38 +1,43 @@
 """Various Depth losses."""
 
-from typing import List
-
-import numpy as np
+from typing import Dict, List, Tuple
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from .loss_functions import SSIM
+from .loss_functions import SSIM, reduce_loss
+from .pyramid_cache import PyramidCache
+from .valid_pixels import depth_pixels
 
 __all__ = ['DepthAwareLoss', 'ScaleInvariantError', 'InvHuberLoss',
-           'DepthReconstructionLossV1']
+           'DepthReconstructionLossV1', 'BackprojectDepth', 'Project3D']
 
 class DepthAwareLoss(nn.Module):
     def __init__(self, weight=1.0, **kwargs):
         super(DepthAwareLoss, self).__init__()
         self.weight = weight
 
-    def forward(self, disp_pred: torch.Tensor, disp_gt: torch.Tensor, **kwargs) -> torch.Tensor:
-        disp_pred = F.relu(disp_pred.squeeze(dim=1)) # depth predictions must be >=0
-        disp_pred[disp_pred == 0] += 0.001 # prevent nans during log
-        mask = disp_gt > 0
+    def forward(self, disp_pred: torch.Tensor, disp_gt: torch.Tensor,
+                cache: PyramidCache = None, reduction='mean', **kwargs) -> torch.Tensor:
+        valid = cache.apply(depth_pixels, disp_gt) if cache is not None else depth_pixels(disp_gt)
+        if len(valid) == 0:
+            return reduce_loss(disp_pred * 0., reduction)
 
-        msk_disp_pred = disp_pred[mask]
-        msk_disp_gt = disp_gt[mask]
+        msk_disp_pred = F.relu(valid.gather(disp_pred)) # depth predictions must be >=0
+        msk_disp_pred = msk_disp_pred.masked_fill(msk_disp_pred == 0, 0.001) # prevent nans during log
+        msk_disp_gt = valid.gather(disp_gt)
         l_disp_pred = torch.log(msk_disp_pred)
         l_disp_gt = torch.log(msk_disp_gt)
         regularization = 1 - torch.min(l_disp_pred, l_disp_gt) / torch.max(l_disp_pred, l_disp_gt)
 
-        l_loss = F.smooth_l1_loss(msk_disp_pred, msk_disp_gt, reduction='mean')
+        l_loss = F.smooth_l1_loss(msk_disp_pred, msk_disp_gt, reduction='none')
         depth_aware_attention = msk_disp_gt / torch.max(msk_disp_gt)
 
-        return self.weight * ((depth_aware_attention + regularization) * l_loss).mean()
+        if reduction == 'mean':
+            return self.weight * (depth_aware_attention + regularization).mean() * l_loss.mean()
+        return self.weight * valid.batch_mean(depth_aware_attention + regularization, empty=0.) \
+            * valid.batch_mean(l_loss, empty=0.)
 
 class ScaleInvariantError(nn.Module):
     def __init__(self, weight=1.0, lmda=1, **kwargs):
@@ -40,37 +45,50 @@ class ScaleInvariantError(nn.Module):
         self.lmda = lmda
         self.weight = weight
 
-    def forward(self, disp_pred: torch.Tensor, disp_gt: torch.Tensor, **kwargs) -> torch.Tensor:
-        disp_pred = F.relu(disp_pred.squeeze(dim=1)) # depth predictions must be >=0
-        disp_pred[disp_pred == 0] += 0.001 # prevent nans during log
-        mask = disp_gt > 0
+    def forward(self, disp_pred: torch.Tensor, disp_gt: torch.Tensor,
+                cache: PyramidCache = None, reduction='mean', **kwargs) -> torch.Tensor:
+        valid = cache.apply(depth_pixels, disp_gt) if cache is not None else depth_pixels(disp_gt)
+        if len(valid) == 0:
+            return reduce_loss(disp_pred * 0., reduction)
+
+        disp_pred = F.relu(valid.gather(disp_pred)) # depth predictions must be >=0
+        disp_pred = disp_pred.masked_fill(disp_pred == 0, 0.001) # prevent nans during log
 
-        log_diff = torch.log(disp_pred[mask]) - torch.log(disp_gt[mask])
+        log_diff = torch.log(disp_pred) - torch.log(valid.gather(disp_gt))
 
-        element_wise = torch.pow(log_diff, 2).mean()
-        scaled_error = self.lmda * (log_diff.sum()**2) / (log_diff.shape[0]**2)
-        return self.weight * (element_wise - scaled_error).mean()
+        if reduction == 'mean':
+            element_wise = torch.pow(log_diff, 2).mean()
+            scaled_error = self.lmda * (log_diff.sum()**2) / (log_diff.shape[0]**2)
+        else:
+            # Scale invariance within each sample
+            element_wise = valid.batch_mean(torch.pow(log_diff, 2), empty=0.)
+            scaled_error = self.lmda * valid.batch_mean(log_diff, empty=0.)**2
+        return self.weight * (element_wise - scaled_error)
 
 class InvHuberLoss(nn.Module):
     """
-    Inverse Huber (berHu) Loss for Depth/Disparity Training
+    Inverse Huber (berHu) Loss for Depth/Disparity Training\n
+    Only evaluated on the pixels with ground truth, the threshold is 20% of
+    the largest error of those pixels and the cost is their mean
     """
     def __init__(self, weight=1.0, **kwargs):
         super(InvHuberLoss, self).__init__()
         self.weight = weight
 
-    def forward(self, disp_pred: torch.Tensor, disp_gt: torch.Tensor, **kwargs) -> torch.Tensor:
-        pred_relu = F.relu(disp_pred.squeeze(dim=1)) # depth predictions must be >=0
-        diff = pred_relu - disp_gt
-        mask = disp_gt > 0
+    def forward(self, disp_pred: torch.Tensor, disp_gt: torch.Tensor,
+                cache: PyramidCache = None, reduction='mean', **kwargs) -> torch.Tensor:
+        valid = cache.apply(depth_pixels, disp_gt) if cache is not None else depth_pixels(disp_gt)
+        if len(valid) == 0:
+            return reduce_loss(disp_pred * 0., reduction)
+
+        pred_relu = F.relu(valid.gather(disp_pred)) # depth predictions must be >=0
+        err = (pred_relu - valid.gather(disp_gt)).abs()
 
-        err = (diff * mask.float()).abs()
-        c = 0.2 * err.max()
-        err2 = (diff**2 + c**2) / (2. * c)
-        mask_err = err <= c
-        mask_err2 = err > c
-        cost = (err*mask_err.float() + err2*mask_err2.float()).mean()
-        return self.weight * cost
+        c = (0.2 * err.max()).clamp(min=1e-6)
+        cost = torch.where(err <= c, err, (err**2 + c**2) / (2. * c))
+        if reduction == 'mean':
+            return self.weight * cost.mean()
+        return self.weight * valid.batch_mean(cost, empty=0.)
 
 class InvHuberLossPyr(nn.Module):
     def __init__(self, lvl_weights: List[int], weight=1.0, **kwargs):
@@ -79,100 +97,119 @@ class InvHuberLossPyr(nn.Module):
         self.weight = weight
         self.inv_huber = InvHuberLoss()
 
-    def forward(self, disp_pred: List[torch.Tensor],
-                disp_gt: torch.Tensor, **kwargs) -> torch.Tensor:
+    def forward(self, disp_pred: List[torch.Tensor], disp_gt: torch.Tensor,
+                cache: PyramidCache = None, reduction='mean', **kwargs) -> torch.Tensor:
+        if cache is None:
+            cache = PyramidCache()
+
         loss = 0
         for lvl, pred in enumerate(disp_pred):
-            disp_gt_scaled = F.interpolate(
-                disp_gt.unsqueeze(1), tuple(pred.size()[2:]), mode='nearest')
-            lvl_loss = self.inv_huber.forward(pred, disp_gt_scaled)
+            disp_gt_scaled = cache.resize(disp_gt, tuple(pred.size()[2:]), mode='nearest')
+            lvl_loss = self.inv_huber.forward(pred, disp_gt_scaled, cache=cache,
+                                              reduction=reduction)
             loss += (lvl_loss * self.lvl_weights[lvl])
 
         return self.weight * loss
 
 class BackprojectDepth(nn.Module):
-    """Layer to transform a depth image into a point cloud
+    """Layer to transform a depth image into a point cloud\n
+    Works with any batch size and resolution, the homogeneous pixel
+    grid of each resolution, dtype and device is built once and reused
     """
-    def __init__(self, batch_size, height, width):
+    def __init__(self):
         super(BackprojectDepth, self).__init__()
-
-        self.batch_size = batch_size
-        self.height = height
-        self.width = width
-
-        meshgrid = np.meshgrid(range(self.width), range(self.height), indexing='xy')
-        self.id_coords = np.stack(meshgrid, axis=0).astype(np.float32)
-        self.id_coords = nn.Parameter(torch.from_numpy(self.id_coords),
-                                      requires_grad=False)
-
-        self.ones = nn.Parameter(torch.ones(self.batch_size, 1, self.height * self.width),
-                                 requires_grad=False)
-
-        self.pix_coords = torch.unsqueeze(torch.stack(
-            [self.id_coords[0].view(-1), self.id_coords[1].view(-1)], 0), 0)
-        self.pix_coords = self.pix_coords.repeat(batch_size, 1, 1)
-        self.pix_coords = nn.Parameter(torch.cat([self.pix_coords, self.ones], 1),
-                                       requires_grad=False)
-
-    def forward(self, depth, inv_K):
-        cam_points = torch.matmul(inv_K[:, :3, :3].cuda(), self.pix_coords)
-        cam_points = depth.view(self.batch_size, 1, -1) * cam_points
-        cam_points = torch.cat([cam_points, self.ones], 1)
-
-        return cam_points
+        self._pix_coords: Dict[Tuple[int, int, torch.dtype, torch.device], torch.Tensor] = {}
+
+    def pixel_coords(self, height: int, width: int, dtype: torch.dtype,
+                     device: torch.device) -> torch.Tensor:
+        """
+        Homogeneous pixel coordinates [u, v, 1] of each pixel, shape 1x3xHW
+        """
+        key = (height, width, dtype, device)
+        if key not in self._pix_coords:
+            y_coords, x_coords = torch.meshgrid(
+                torch.arange(height, dtype=dtype, device=device),
+                torch.arange(width, dtype=dtype, device=device))
+            self._pix_coords[key] = torch.stack(
+                [x_coords.reshape(-1), y_coords.reshape(-1),
+                 torch.ones(height * width, dtype=dtype, device=device)], 0).unsqueeze(0)
+        return self._pix_coords[key]
+
+    def forward(self, depth: torch.Tensor, inv_K: torch.Tensor) -> torch.Tensor:
+        """
+        depth Bx1xHxW and inv_K Bx4x4 to homogeneous camera points Bx4xHW
+        """
+        batch_sz, _, height, width = depth.shape
+        pix_coords = self.pixel_coords(height, width, depth.dtype, depth.device)
+
+        cam_points = torch.matmul(inv_K[:, :3, :3].to(depth), pix_coords)
+        cam_points = depth.view(batch_sz, 1, -1) * cam_points
+        return torch.cat([cam_points, torch.ones_like(cam_points[:, :1])], 1)
 
 class Project3D(nn.Module):
     """Layer which projects 3D points into a camera with intrinsics K and at position T
     """
-    def __init__(self, batch_size, height, width, eps=1e-7):
+    def __init__(self, eps=1e-7):
         super(Project3D, self).__init__()
-
-        self.batch_size = batch_size
-        self.height = height
-        self.width = width
         self.eps = eps
 
-    def forward(self, points, K, T):
-        P = torch.matmul(K.cuda(), T.cuda())[:, :3, :]
+    def forward(self, points: torch.Tensor, K: torch.Tensor, T: torch.Tensor,
+                height: int, width: int) -> torch.Tensor:
+        """
+        Homogeneous points Bx4xHW to grid_sample coordinates BxHxWx2 (align_corners=True)
+        """
+        P = torch.matmul(K.to(points), T.to(points))[:, :3, :]
 
         cam_points = torch.matmul(P, points)
 
         pix_coords = cam_points[:, :2, :] / (cam_points[:, 2, :].unsqueeze(1) + self.eps)
-        pix_coords = pix_coords.view(self.batch_size, 2, self.height, self.width)
-        pix_coords = pix_coords.permute(0, 2, 3, 1)
-        pix_coords[..., 0] /= self.width - 1
-        pix_coords[..., 1] /= self.height - 1
-        pix_coords = (pix_coords - 0.5) * 2
-        return pix_coords
+        pix_coords = pix_coords.view(points.shape[0], 2, height, width).permute(0, 2, 3, 1)
+        scale = torch.tensor([2. / (width - 1), 2. / (height - 1)],
+                             dtype=points.dtype, device=points.device)
+        return pix_coords * scale - 1
+
+def scale_intrinsics(K: torch.Tensor, scale_x: float, scale_y: float) -> torch.Tensor:
+    """
+    Intrinsics Bx4x4 of an image resized by (scale_x, scale_y)
+    """
+    scale = torch.tensor([scale_x, scale_y, 1., 1.], dtype=K.dtype, device=K.device)
+    return K * scale.view(1, 4, 1)
 
 class DepthReconstructionLossV1(nn.Module):
-    """Generate the warped (reprojected) color images for a minibatch.
+    """Generate the warped (reprojected) color images for a minibatch.\n
+    The photometric error between the target image and the source image warped by
+    the predicted depth, the pose (telemetry) from target to source and the camera.
+    Batch size and resolution can change every step. A list of predictions is
+    compared at each of their own resolutions, with the images resized through the
+    cache and the intrinsics scaled to match.
     """
-    def __init__(self, batch_size, height, width, pred_type="disparity", ssim=True):
+    def __init__(self, weight=1.0, lvl_weights: List[float] = None,
+                 pred_type="depth", ssim=True, **kwargs):
         super(DepthReconstructionLossV1, self).__init__()
+        self.weight = weight
+        self.lvl_weights = lvl_weights
         self.pred_type = pred_type
-        self.BackprojDepth = BackprojectDepth(batch_size, height, width)\
-                                .to("cuda" if torch.cuda.is_available() else "cpu")
-        self.Project3D = Project3D(batch_size, height, width)\
-                                .to("cuda" if torch.cuda.is_available() else "cpu")
+        self.BackprojDepth = BackprojectDepth()
+        self.Project3D = Project3D()
         if ssim:
             self.SSIM = SSIM().to("cuda" if torch.cuda.is_available() else "cpu")
 
     def depth_from_disparity(self, disparity):
-        return (0.209313 * 2262.52) / ((disparity - 1) / 256)
-
-    def forward(self, disp_pred, source_img, target_img, telemetry, camera):
-        if self.pred_type == "depth":
-            depth = disp_pred
-        elif self.pred_type == "disparity":
-            depth = self.depth_from_disparity(disp_pred)
-        else:
-            raise NotImplementedError(self.pred_type)
-
-        cam_points = self.BackprojDepth(depth, camera["inv_K"])
-        pix_coords = self.Project3D(cam_points, camera["K"], telemetry)
-
-        source_img = F.grid_sample(source_img, pix_coords, padding_mode="border")
+        # Same conversion as the cityscapes dataset
+        return (0.209313 * 2262.52) / disparity.clamp(min=1e-3)
+
+    def reprojection_loss(self, depth: torch.Tensor, source_img: torch.Tensor,
+                          target_img: torch.Tensor, telemetry: torch.Tensor,
+                          K: torch.Tensor, reduction='mean') -> torch.Tensor:
+        """
+        Photometric loss at the resolution of depth, the images and K must match it
+        """
+        height, width = depth.shape[2:]
+        cam_points = self.BackprojDepth(depth, torch.inverse(K.to(depth)))
+        pix_coords = self.Project3D(cam_points, K, telemetry, height, width)
+
+        source_img = F.grid_sample(source_img, pix_coords.to(source_img),
+                                   padding_mode="border", align_corners=True)
 
         abs_diff = (target_img - source_img).abs()
         if hasattr(self, 'SSIM'):
@@ -180,7 +217,42 @@ class DepthReconstructionLossV1(nn.Module):
                 0.85*self.SSIM(source_img, target_img).mean(1, True)
         else:
             loss = abs_diff.mean(1, True)
-        return loss.mean()
+        return reduce_loss(loss, reduction)
+
+    def forward(self, disp_pred, source_img: torch.Tensor, target_img: torch.Tensor,
+                telemetry: torch.Tensor, camera: Dict[str, torch.Tensor],
+                cache: PyramidCache = None, reduction='mean', **kwargs) -> torch.Tensor:
+        """
+        disp_pred Bx1xHxW or a list of them, camera["K"] are the Bx4x4
+        intrinsics at the resolution of the images
+        """
+        if cache is None:
+            cache = PyramidCache()
+        if not isinstance(disp_pred, (list, tuple)):
+            disp_pred = [disp_pred]
+        lvl_weights = self.lvl_weights if self.lvl_weights is not None else [1.] * len(disp_pred)
+
+        img_h, img_w = target_img.shape[2:]
+
+        loss = 0
+        for pred, lvl_weight in zip(disp_pred, lvl_weights):
+            if lvl_weight == 0:
+                continue
+
+            if self.pred_type == "depth":
+                depth = pred
+            elif self.pred_type == "disparity":
+                depth = self.depth_from_disparity(pred)
+            else:
+                raise NotImplementedError(self.pred_type)
+
+            height, width = pred.shape[2:]
+            loss += lvl_weight * self.reprojection_loss(
+                depth, cache.resize(source_img, (height, width), mode='area'),
+                cache.resize(target_img, (height, width), mode='area'), telemetry,
+                scale_intrinsics(camera["K"], width / img_w, height / img_h), reduction)
+
+        return self.weight * loss
 
 if __name__ == '__main__':
     import PIL.Image as Image
@@ -192,7 +264,10 @@ if __name__ == '__main__':
     img1 = Image.open(BASE_DIR+'leftImg8bit/test/berlin/berlin_000000_000019_leftImg8bit.png')
     img2 = Image.open(BASE_DIR+'leftImg8bit_sequence/test/berlin/berlin_000000_000020_leftImg8bit.png')
 
-    loss_func = DepthReconstructionLossV1(1, img1.size[1], img1.size[0])
-    uniform = torch.zeros([1, img1.size[1], img1.size[0], 2])
+    loss_func = DepthReconstructionLossV1()
+    depth = torch.full([1, 1, img1.size[1], img1.size[0]], 10.)
+    camera = {"K": torch.tensor([[[2262.52, 0., 1096.98, 0.], [0., 2265.30, 513.137, 0.],
+                                  [0., 0., 1., 0.], [0., 0., 0., 1.]]])}
 
-    print(loss_func(transform(img1).unsqueeze(0), uniform, transform(img1).unsqueeze(0)))
\ No newline at end of file
+    print(loss_func(depth, transform(img2).unsqueeze(0), transform(img1).unsqueeze(0),
+                    torch.eye(4).unsqueeze(0), camera))
@@ -0,0 +1,71 @@
+"""
+Per-batch cache of derived images (resized, grayscale, census etc.) shared
+between the losses and metric loggers of a training step
+"""
+
+from typing import Any, Callable, Dict, Hashable, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+
+__all__ = ['PyramidCache']
+
+class PyramidCache(object):
+    """
+    Lazily populated cache of tensors derived from a batch, a new cache is made for
+    each batch so entries are computed at most once per step.\n
+    Entries are keyed by the identity of their source tensors, a reference to each
+    source is held so its id can't be reused by another tensor during the step.
+    """
+    def __init__(self):
+        self._cache: Dict[Tuple[Hashable, ...], Any] = {}
+        self._sources: Dict[int, torch.Tensor] = {}
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _key(self, name: Hashable, tensors: Sequence[torch.Tensor], *args) -> Tuple:
+        for tensor in tensors:
+            self._sources[id(tensor)] = tensor
+        return (name, *[id(tensor) for tensor in tensors], *args)
+
+    def apply(self, func: Callable, *tensors: torch.Tensor, **kwargs) -> Any:
+        """
+        Returns func(*tensors, **kwargs), only calling func the first time
+        """
+        key = self._key(func, tensors, *sorted(kwargs.items()))
+        if key not in self._cache:
+            self._cache[key] = func(*tensors, **kwargs)
+        return self._cache[key]
+
+    def resize(self, tensor: torch.Tensor, size: Sequence[int], mode='area') -> torch.Tensor:
+        """
+        Interpolates a [B, C, H, W] or [B, H, W] tensor to size, the tensor
+        itself is returned if it is already that size
+        """
+        size = tuple(size)
+        if tuple(tensor.shape[-2:]) == size:
+            return tensor
+
+        key = self._key('resize', [tensor], size, mode)
+        if key not in self._cache:
+            if tensor.dim() == 3:
+                resized = F.interpolate(tensor.unsqueeze(1), size, mode=mode).squeeze(1)
+            else:
+                resized = F.interpolate(tensor, size, mode=mode)
+            self._cache[key] = resized
+        return self._cache[key]
+
+    def pyramid(self, tensor: torch.Tensor, sizes: Sequence[Sequence[int]],
+                mode='area') -> Tuple[torch.Tensor, ...]:
+        """
+        The tensor resized to each size
+        """
+        return tuple(self.resize(tensor, size, mode) for size in sizes)
+
+    def clear(self) -> None:
+        """
+        Drops all entries and the references to their sources
+        """
+        self._cache.clear()
+        self._sources.clear()
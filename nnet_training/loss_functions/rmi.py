@@ -16,7 +16,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from .rmi_utils import map_get_pairs, log_det_by_cholesky
+from .rmi_utils import map_get_pairs, pair_covariances, log_det_by_cholesky, cholesky_jitter
 
 _euler_num = 2.718281828        # euler number
 _pi = 3.14159265		# pi
@@ -25,6 +25,7 @@ _CLIP_MIN = 1e-6        	# min clip value after softmax or sigmoid operations
 _CLIP_MAX = 1.0    		# max clip value after softmax or sigmoid operations
 _POS_ALPHA = 5e-4		# add this factor to ensure the AA^T is positive definite
 _IS_SUM = 1			# sum the loss per channel
+_RMI_DTYPES = {'float32': torch.float32, 'float64': torch.float64}
 
 
 __all__ = ['RMILoss', 'RMILossAux']
@@ -37,7 +38,8 @@ class RMILoss(nn.Module):
     This version need a lot of memory if do not downsample.
     """
     def __init__(self, num_classes=21, rmi_radius=3, rmi_pool_way=1, rmi_pool_size=4,
-                 rmi_pool_stride=4, loss_weight_lambda=0.5, lambda_way=1, ignore_index=255):
+                 rmi_pool_stride=4, loss_weight_lambda=0.5, lambda_way=1, ignore_index=255,
+                 rmi_dtype='float64'):
         super(RMILoss, self).__init__()
         self.num_classes = num_classes
         # radius choices
@@ -59,23 +61,28 @@ class RMILoss(nn.Module):
         self.kernel_padding = self.rmi_pool_size // 2
         # ignore class
         self.ignore_index = ignore_index
+        # precision of the covariance and cholesky solves, float32 is
+        # faster on most GPUs and relies on the jitter fallback if singular
+        assert rmi_dtype in _RMI_DTYPES, f"rmi_dtype must be one of {list(_RMI_DTYPES)}"
+        self.rmi_dtype = _RMI_DTYPES[rmi_dtype]
 
     def forward(self, logits_4D: torch.FloatTensor, labels_4D: torch.LongTensor,
-                do_rmi=True) -> torch.Tensor:
-        # explicitly disable fp16 mode because torch.cholesky and
-        # torch.inverse aren't supported by half
+                do_rmi=True, reduction='mean') -> torch.Tensor:
+        # explicitly disable fp16 mode because the cholesky
+        # decomposition and solve aren't supported by half
         with torch.cuda.amp.autocast(enabled=False):
             loss = self.forward_sigmoid(
-                logits_4D.float(), labels_4D.float(), do_rmi=do_rmi)
+                logits_4D.float(), labels_4D.float(), do_rmi=do_rmi, reduction=reduction)
         return loss
 
-    def forward_sigmoid(self, logits_4D, labels_4D, do_rmi=False):
+    def forward_sigmoid(self, logits_4D, labels_4D, do_rmi=False, reduction='mean'):
         """
         Using the sigmiod operation both.
         Args:
                 logits_4D 	:	[N, C, H, W], dtype=float32
                 labels_4D 	:	[N, H, W], dtype=long
                 do_rmi          :       bool
+                reduction       :       'mean' or 'none' for the loss of each sample [N]
         """
         # label mask -- [N, H, W, 1]
         label_mask_3d = labels_4D < self.num_classes
@@ -94,10 +101,18 @@ class RMILoss(nn.Module):
         logits_flat = logits_4D.permute(0, 2, 3, 1).contiguous().view([-1, self.num_classes])
 
         # binary loss, multiplied by the not_ignore_mask
-        valid_pixels = torch.sum(label_mask_flat)
-        binary_loss = F.binary_cross_entropy_with_logits(
-            logits_flat, target=valid_onehot_label_flat,
-            weight=label_mask_flat.unsqueeze(dim=1), reduction='sum')
+        if reduction == 'mean':
+            valid_pixels = torch.sum(label_mask_flat)
+            binary_loss = F.binary_cross_entropy_with_logits(
+                logits_flat, target=valid_onehot_label_flat,
+                weight=label_mask_flat.unsqueeze(dim=1), reduction='sum')
+        else:
+            batch_sz = logits_4D.shape[0]
+            valid_pixels = label_mask_3d.view([batch_sz, -1]).sum(dim=1)
+            binary_loss = F.binary_cross_entropy_with_logits(
+                logits_flat, target=valid_onehot_label_flat,
+                weight=label_mask_flat.unsqueeze(dim=1), reduction='none')
+            binary_loss = binary_loss.view([batch_sz, -1]).sum(dim=1)
 
         bce_loss = torch.div(binary_loss, valid_pixels + 1.0)
         if not do_rmi:
@@ -109,7 +124,7 @@ class RMILoss(nn.Module):
         valid_onehot_labels_4d = valid_onehot_labels_4d.permute(0, 3, 1, 2).requires_grad_(False)
 
         # get region mutual information
-        rmi_loss = self.rmi_lower_bound(valid_onehot_labels_4d, probs_4d)
+        rmi_loss = self.rmi_lower_bound(valid_onehot_labels_4d, probs_4d, reduction)
 
         # add together
         if self.lambda_way:
@@ -119,12 +134,13 @@ class RMILoss(nn.Module):
 
         return final_loss
 
-    def rmi_lower_bound(self, labels_4D, probs_4D):
+    def rmi_lower_bound(self, labels_4D, probs_4D, reduction='mean'):
         """
         calculate the lower bound of the region mutual information.
         Args:
                 labels_4D 	:	[N, C, H, W], dtype=float32
                 probs_4D 	:	[N, C, H, W], dtype=float32
+                reduction       :       'mean' or 'none' for the bound of each sample [N]
         """
         assert labels_4D.size() == probs_4D.size()
 
@@ -150,47 +166,35 @@ class RMILoss(nn.Module):
             else:
                 raise NotImplementedError("Pool way of RMI is not defined!")
         # we do not need the gradient of label.
-        label_shape = labels_4D.size()
-        n, c = label_shape[0], label_shape[1]
-
-        # combine the high dimension points from label and probability map.
-        # new shape [N, C, radius * radius, H, W]
-        la_vectors, pr_vectors = map_get_pairs(
-            labels_4D, probs_4D, radius=self.rmi_radius, is_combine=0)
-
-        la_vectors = la_vectors.view([n, c, self.half_d, -1]).type(torch.cuda.DoubleTensor).requires_grad_(False)
-        pr_vectors = pr_vectors.view([n, c, self.half_d, -1]).type(torch.cuda.DoubleTensor)
+        labels_4D = labels_4D.to(self.rmi_dtype).requires_grad_(False)
+        probs_4D = probs_4D.to(self.rmi_dtype)
 
-        # small diagonal matrix, shape = [1, 1, radius * radius, radius * radius]
-        diag_matrix = torch.eye(self.half_d).unsqueeze(dim=0).unsqueeze(dim=0)
+        # small diagonal matrix, shape = [radius * radius, radius * radius]
+        diag_matrix = torch.eye(self.half_d, dtype=self.rmi_dtype, device=probs_4D.device)
 
-        # the mean and covariance of these high dimension points
+        # the covariance of the radius * radius neighbourhoods of the label and probability
+        # maps, accumulated from shifted products rather than stacking the neighbourhoods.
         # Var(X) = E(X^2) - E(X) E(X), N * Var(X) = X^2 - X E(X)
-        la_vectors = la_vectors - la_vectors.mean(dim=3, keepdim=True)
-        la_cov = torch.matmul(la_vectors, la_vectors.transpose(2, 3))
-
-        pr_vectors = pr_vectors - pr_vectors.mean(dim=3, keepdim=True)
-        pr_cov = torch.matmul(pr_vectors, pr_vectors.transpose(2, 3))
-        # https://github.com/pytorch/pytorch/issues/7500
-        # waiting for batched torch.cholesky_inverse()
-        pr_cov_inv = torch.inverse(pr_cov + diag_matrix.type_as(pr_cov) * _POS_ALPHA)
-        # if the dimension of the point is less than 9, you can use the below function
-        # to acceleration computational speed.
-        #pr_cov_inv = utils.batch_cholesky_inverse(pr_cov + diag_matrix.type_as(pr_cov) * _POS_ALPHA)
+        la_cov, pr_cov, la_pr_cov = pair_covariances(labels_4D, probs_4D, radius=self.rmi_radius)
 
-        la_pr_cov = torch.matmul(la_vectors, pr_vectors.transpose(2, 3))
         # the approxiamation of the variance, det(c A) = c^n det(A), A is in n x n shape;
         # then log det(c A) = n log(c) + log det(A).
         # appro_var = appro_var / n_points, we do not divide the appro_var by number of points here,
         # and the purpose is to avoid underflow issue.
-        # If A = A^T, A^-1 = (A^-1)^T.
-        appro_var = la_cov - torch.matmul(la_pr_cov.matmul(pr_cov_inv), la_pr_cov.transpose(-2, -1))
-        #appro_var = la_cov - torch.chain_matmul(la_pr_cov, pr_cov_inv, la_pr_cov.transpose(-2, -1))
-        #appro_var = torch.div(appro_var, n_points.type_as(appro_var)) + diag_matrix.type_as(appro_var) * 1e-6
+        # pr_cov^-1 la_pr_cov^T is solved with the cholesky factor of pr_cov
+        # rather than explicitly inverting pr_cov.
+        pr_cov_chol = cholesky_jitter(pr_cov + diag_matrix * _POS_ALPHA)
+        appro_var = la_cov - torch.matmul(
+            la_pr_cov, torch.cholesky_solve(la_pr_cov.transpose(-2, -1), pr_cov_chol))
 
         # The lower bound. If A is nonsingular, ln( det(A) ) = Tr( ln(A) ).
-        rmi_now = 0.5 * log_det_by_cholesky(appro_var + diag_matrix.type_as(appro_var) * _POS_ALPHA)
-        #rmi_now = 0.5 * torch.logdet(appro_var + diag_matrix.type_as(appro_var) * _POS_ALPHA)
+        rmi_now = 0.5 * log_det_by_cholesky(appro_var + diag_matrix * _POS_ALPHA)
+
+        if reduction == 'none':
+            # sum over the classes of each sample
+            rmi_per_class = torch.div(rmi_now.view([-1, self.num_classes]).float(),
+                                      float(self.half_d))
+            return rmi_per_class.sum(dim=1) if _IS_SUM else rmi_per_class.mean(dim=1)
 
         # mean over N samples. sum over classes.
         rmi_per_class = rmi_now.view([-1, self.num_classes]).mean(dim=0).float()
@@ -211,13 +215,15 @@ class MultiScaleRMILoss(nn.Module):
         self.supervised_mscale_wt = supervised_mscale_wt
         self.rmi = RMILoss(**kwargs)
 
-    def forward(self, seg_pred: Dict[str, torch.Tensor], seg_gt: torch.Tensor, **kwargs):
-        aux_loss = self.rmi(seg_pred['aux'], seg_gt, do_rmi=self.ocr_aux_rmi)
+    def forward(self, seg_pred: Dict[str, torch.Tensor], seg_gt: torch.Tensor,
+                reduction='mean', **kwargs):
+        aux_loss = self.rmi(seg_pred['aux'], seg_gt, do_rmi=self.ocr_aux_rmi,
+                            reduction=reduction)
 
         # Optionally turn off RMI loss for first epoch to try to work
         # around cholesky errors of singular matrix
         do_rmi_main = True  # cfg.EPOCH > 0
-        main_loss = self.rmi(seg_pred['pred'], seg_gt, do_rmi=do_rmi_main)
+        main_loss = self.rmi(seg_pred['pred'], seg_gt, do_rmi=do_rmi_main, reduction=reduction)
         loss = self.alpha * aux_loss + main_loss
 
         # Optionally, apply supervision to the multi-scale predictions
@@ -227,8 +233,8 @@ class MultiScaleRMILoss(nn.Module):
                 seg_pred['pred_05x'], size=tuple(seg_pred['pred_10x'][2:]),
                 mode='bilinear', align_corners=True, recompute_scale_factor=True)
 
-            loss_lo = self.rmi(scaled_pred_05x, seg_gt, do_rmi=False)
-            loss_hi = self.rmi(seg_pred['pred_10x'], seg_gt, do_rmi=False)
+            loss_lo = self.rmi(scaled_pred_05x, seg_gt, do_rmi=False, reduction=reduction)
+            loss_hi = self.rmi(seg_pred['pred_10x'], seg_gt, do_rmi=False, reduction=reduction)
 
             loss += self.supervised_mscale_wt * loss_lo
             loss += self.supervised_mscale_wt * loss_hi
@@ -242,12 +248,81 @@ class RMILossAux(nn.Module):
         self.aux_weight = aux_weight
         self.weight = weight
 
-    def forward(self, seg_pred: Dict[str, torch.Tensor], seg_gt: torch.Tensor, **kwargs):
+    def forward(self, seg_pred: Dict[str, torch.Tensor], seg_gt: torch.Tensor,
+                reduction='mean', **kwargs):
         assert 'seg' in seg_pred.keys()
 
-        seg_loss = self.rmi(seg_pred['seg'], seg_gt)
+        seg_loss = self.rmi(seg_pred['seg'], seg_gt, reduction=reduction)
 
         if 'seg_aux' in seg_pred.keys():
-            seg_loss += (self.aux_weight * self.rmi(seg_pred['seg_aux'], seg_gt))
+            seg_loss += (self.aux_weight * self.rmi(seg_pred['seg_aux'], seg_gt,
+                                                    reduction=reduction))
 
         return self.weight * seg_loss
+
+if __name__ == '__main__':
+    import time
+    from .rmi_utils import batch_low_tri_inv
+
+    def _previous_rmi_lower_bound(labels_4D, probs_4D, radius=3, low_tri_inv=False):
+        """
+        Previous float64 path with an explicit inverse, without pooling
+        """
+        n, c = labels_4D.shape[:2]
+        half_d = radius * radius
+        la_vectors, pr_vectors = map_get_pairs(labels_4D, probs_4D, radius=radius, is_combine=0)
+        la_vectors = la_vectors.view([n, c, half_d, -1]).double()
+        pr_vectors = pr_vectors.view([n, c, half_d, -1]).double()
+        diag_matrix = torch.eye(half_d, dtype=torch.float64, device=labels_4D.device)
+
+        la_vectors = la_vectors - la_vectors.mean(dim=3, keepdim=True)
+        la_cov = torch.matmul(la_vectors, la_vectors.transpose(2, 3))
+        pr_vectors = pr_vectors - pr_vectors.mean(dim=3, keepdim=True)
+        pr_cov = torch.matmul(pr_vectors, pr_vectors.transpose(2, 3))
+        if low_tri_inv:
+            chol_low_inv = batch_low_tri_inv(torch.linalg.cholesky(pr_cov + diag_matrix * _POS_ALPHA))
+            pr_cov_inv = torch.matmul(chol_low_inv.transpose(-2, -1), chol_low_inv)
+        else:
+            pr_cov_inv = torch.inverse(pr_cov + diag_matrix * _POS_ALPHA)
+        la_pr_cov = torch.matmul(la_vectors, pr_vectors.transpose(2, 3))
+        appro_var = la_cov - torch.matmul(la_pr_cov.matmul(pr_cov_inv), la_pr_cov.transpose(-2, -1))
+
+        chol = torch.linalg.cholesky(appro_var + diag_matrix * _POS_ALPHA)
+        rmi_now = torch.sum(torch.log(torch.diagonal(chol, dim1=-2, dim2=-1) + 1e-8), dim=-1)
+        rmi_per_class = torch.div(rmi_now.view([-1, c]).mean(dim=0).float(), float(half_d))
+        return torch.sum(rmi_per_class)
+
+    def _benchmark(func, n_iter=10):
+        for _ in range(2):
+            func()
+        if DEVICE.type == 'cuda':
+            torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(n_iter):
+            func()
+        if DEVICE.type == 'cuda':
+            torch.cuda.synchronize()
+        return 1000. * (time.time() - start_time) / n_iter
+
+    DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    LABELS = F.one_hot(torch.randint(0, 19, (4, 64, 128), device=DEVICE), 19) \
+        .permute(0, 3, 1, 2).float()
+    PROBS = (torch.randn(4, 19, 64, 128, device=DEVICE).sigmoid() + _CLIP_MIN).requires_grad_()
+
+    RMI_64 = RMILoss(num_classes=19, rmi_pool_stride=1, rmi_pool_size=1)
+    RMI_32 = RMILoss(num_classes=19, rmi_pool_stride=1, rmi_pool_size=1, rmi_dtype='float32')
+
+    REFERENCE = _previous_rmi_lower_bound(LABELS, PROBS)
+    for name, loss_fn in [
+            ("previous inverse", lambda: _previous_rmi_lower_bound(LABELS, PROBS)),
+            ("previous low tri", lambda: _previous_rmi_lower_bound(LABELS, PROBS, low_tri_inv=True)),
+            ("cholesky float64", lambda: RMI_64.rmi_lower_bound(LABELS, PROBS)),
+            ("cholesky float32", lambda: RMI_32.rmi_lower_bound(LABELS, PROBS))]:
+        print(f"{name:>16} on {DEVICE}: "
+              f"forward {_benchmark(loss_fn):.3f}ms, "
+              f"forward+backward {_benchmark(lambda: loss_fn().backward()):.3f}ms, "
+              f"difference {(loss_fn() - REFERENCE).abs().item():.3e}")
+        if DEVICE.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+            loss_fn().backward()
+            print(f"{'':>16} peak memory {torch.cuda.max_memory_allocated() / 2**20:.1f}MB")
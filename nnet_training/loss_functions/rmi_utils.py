@@ -8,7 +8,22 @@ from __future__ import absolute_import
 import torch
 import torch.nn.functional as F
 
-__all__ = ['map_get_pairs', 'log_det_by_cholesky']
+__all__ = ['map_get_pairs', 'shifted_views', 'pair_covariances',
+           'log_det_by_cholesky', 'cholesky_jitter']
+
+def shifted_views(tensor_4D, radius=3):
+    """
+    Every radius x radius shift of a map as a strided view, nothing is copied.
+    Args:
+        tensor_4D	:	shape [N, C, H, W]
+        radius		:	the square radius
+    Return:
+        view with shape [N, C, radius, radius, H - (radius - 1), W - (radius - 1)],
+        [:, :, y, x] is the map shifted by (y, x)
+    """
+    new_h, new_w = tensor_4D.shape[2] - (radius - 1), tensor_4D.shape[3] - (radius - 1)
+    return tensor_4D.unfold(2, new_h, 1).unfold(3, new_w, 1)
+
 
 def map_get_pairs(labels_4D, probs_4D, radius=3, is_combine=True):
     """get map pairs
@@ -18,40 +33,109 @@ def map_get_pairs(labels_4D, probs_4D, radius=3, is_combine=True):
         radius		:	the square radius
     Return:
         tensor with shape [N, C, radius * radius, H - (radius - 1), W - (radius - 1)]
+    Note that this materialises radius * radius copies of each map, use
+    pair_covariances if only the covariances of the pairs are needed.
     """
-    # pad to ensure the following slice operation is valid
-    #pad_beg = int(radius // 2)
-    #pad_end = radius - pad_beg
-
-    # the original height and width
-    label_shape = labels_4D.size()
-    h, w = label_shape[2], label_shape[3]
-    new_h, new_w = h - (radius - 1), w - (radius - 1)
-    # https://pytorch.org/docs/stable/nn.html?highlight=f%20pad#torch.nn.functional.pad
-    #padding = (pad_beg, pad_end, pad_beg, pad_end)
-    #labels_4D, probs_4D = F.pad(labels_4D, padding), F.pad(probs_4D, padding)
-
-    # get the neighbors
-    la_ns = []
-    pr_ns = []
-    #for x in range(0, radius, 1):
-    for y in range(0, radius, 1):
-        for x in range(0, radius, 1):
-            la_now = labels_4D[:, :, y:y + new_h, x:x + new_w]
-            pr_now = probs_4D[:, :, y:y + new_h, x:x + new_w]
-            la_ns.append(la_now)
-            pr_ns.append(pr_now)
+    la_vectors = shifted_views(labels_4D, radius).flatten(2, 3)
+    pr_vectors = shifted_views(probs_4D, radius).flatten(2, 3)
 
     if is_combine:
         # for calculating RMI
-        pair_ns = la_ns + pr_ns
-        p_vectors = torch.stack(pair_ns, dim=2)
-        return p_vectors
-    else:
-        # for other purpose
-        la_vectors = torch.stack(la_ns, dim=2)
-        pr_vectors = torch.stack(pr_ns, dim=2)
-        return la_vectors, pr_vectors
+        return torch.cat([la_vectors, pr_vectors], dim=2)
+    # for other purpose
+    return la_vectors, pr_vectors
+
+
+def _window_sums(tensor, size, dim):
+    """
+    Sums of every window of length size along dim, from a cumulative sum
+    """
+    csum = tensor.cumsum(dim=dim)
+    first = csum.narrow(dim, size - 1, 1)
+    rest = csum.narrow(dim, size, csum.shape[dim] - size) - \
+        csum.narrow(dim, 0, csum.shape[dim] - size)
+    return torch.cat([first, rest], dim=dim)
+
+
+def _shifted_products(a_4D, b_4D, radius=3, symmetric=False):
+    """
+    Sum over the valid region of the product of every pair of radius x radius
+    shifts of a_4D and b_4D, shape [N, C, radius * radius, radius * radius].\n
+    Pairs with the same relative shift share one product map, with the window of
+    each pair summed from its cumulative sums. Only (2 * radius - 1)^2 products
+    (about half if symmetric, i.e. a_4D is b_4D) are taken, one at a time.
+    """
+    n, c, h, w = a_4D.shape
+    win_h, win_w = h - (radius - 1), w - (radius - 1)
+
+    # Relative shifts of the pairs, if symmetric the pair (a, b) is the pair (b, a)
+    deltas = [(dy, dx) for dy in range(1 - radius, radius) for dx in range(1 - radius, radius)
+              if not symmetric or (dy, dx) >= (0, 0)]
+
+    sums = []
+    offsets = {}
+    n_sums = 0
+    for dy, dx in deltas:
+        oy, ox = max(0, -dy), max(0, -dx)
+        ov_h, ov_w = h - abs(dy), w - abs(dx)
+        product = a_4D[:, :, oy:oy + ov_h, ox:ox + ov_w] * \
+            b_4D[:, :, oy + dy:oy + dy + ov_h, ox + dx:ox + dx + ov_w]
+        # [N, C, radius - |dy|, radius - |dx|] sums of each window
+        product = _window_sums(_window_sums(product, win_h, dim=2), win_w, dim=3)
+        offsets[(dy, dx)] = (n_sums, product.shape[3])
+        n_sums += product.shape[2] * product.shape[3]
+        sums.append(product.flatten(2))
+    sums = torch.cat(sums, dim=2)
+
+    index = []
+    shifts = [(y, x) for y in range(radius) for x in range(radius)]
+    for shift_a in shifts:
+        for shift_b in shifts:
+            dy, dx = shift_b[0] - shift_a[0], shift_b[1] - shift_a[1]
+            first = shift_a
+            if (dy, dx) not in offsets:
+                dy, dx, first = -dy, -dx, shift_b
+            start, n_x = offsets[(dy, dx)]
+            index.append(start + (first[0] - max(0, -dy)) * n_x + first[1] - max(0, -dx))
+    index = torch.tensor(index, device=sums.device)
+
+    return sums.index_select(2, index).view(n, c, radius * radius, radius * radius)
+
+
+def pair_covariances(labels_4D, probs_4D, radius=3):
+    """
+    Covariances of the radius * radius neighbourhoods of the labels and probabilities,
+    equal to the (unnormalised) covariances of the vectors from map_get_pairs without
+    materialising them, memory doesn't scale with the radius.
+    Args:
+        labels_4D	:	labels, shape [N, C, H, W]
+        probs_4D	:	probabilities, shape [N, C, H, W]
+        radius		:	the square radius
+    Return:
+        la_cov, pr_cov, la_pr_cov each with shape [N, C, radius * radius, radius * radius]
+    """
+    # Covariance is invariant to an offset, removing the mean of each map
+    # first avoids cancellation in sum(XY) - sum(X) sum(Y) / N
+    labels_4D = labels_4D - labels_4D.mean(dim=(2, 3), keepdim=True)
+    probs_4D = probs_4D - probs_4D.mean(dim=(2, 3), keepdim=True)
+
+    la_views = shifted_views(labels_4D, radius)
+    pr_views = shifted_views(probs_4D, radius)
+    n_points = la_views.shape[-2] * la_views.shape[-1]
+
+    # [N, C, radius * radius] sum of each shifted view
+    la_sums = la_views.sum(dim=(-2, -1)).flatten(2)
+    pr_sums = pr_views.sum(dim=(-2, -1)).flatten(2)
+
+    # N * Cov(X, Y) = sum(XY) - sum(X) sum(Y) / N
+    la_cov = _shifted_products(labels_4D, labels_4D, radius, symmetric=True) - \
+        la_sums.unsqueeze(-1) * la_sums.unsqueeze(-2) / n_points
+    pr_cov = _shifted_products(probs_4D, probs_4D, radius, symmetric=True) - \
+        pr_sums.unsqueeze(-1) * pr_sums.unsqueeze(-2) / n_points
+    la_pr_cov = _shifted_products(labels_4D, probs_4D, radius) - \
+        la_sums.unsqueeze(-1) * pr_sums.unsqueeze(-2) / n_points
+
+    return la_cov, pr_cov, la_pr_cov
 
 
 def map_get_pairs_region(labels_4D, probs_4D, radius=3, is_combine=0, num_classeses=21):
@@ -92,6 +176,30 @@ def map_get_pairs_region(labels_4D, probs_4D, radius=3, is_combine=0, num_classe
     return
 
 
+def cholesky_jitter(matrix, jitter=1e-6, max_tries=4):
+    """
+    Batched lower cholesky factor. Matrices in the batch that aren't numerically
+    positive definite (common in float32) are retried with a growing diagonal jitter,
+    the rest of the batch is left untouched.
+    Args:
+        matrix: symmetric matrices, shape [..., D, D].
+    """
+    chol, info = torch.linalg.cholesky_ex(matrix)
+    if not torch.any(info > 0):
+        return chol
+
+    eye = torch.eye(matrix.shape[-1], dtype=matrix.dtype, device=matrix.device)
+    for attempt in range(max_tries):
+        failed = (info > 0).unsqueeze(-1).unsqueeze(-1)
+        matrix = torch.where(failed, matrix + eye * jitter * 10 ** attempt, matrix)
+        chol, info = torch.linalg.cholesky_ex(matrix)
+        if not torch.any(info > 0):
+            return chol
+
+    # Raises with the index of the offending matrix
+    return torch.linalg.cholesky(matrix)
+
+
 def log_det_by_cholesky(matrix):
     """
     Args:
@@ -102,7 +210,7 @@ def log_det_by_cholesky(matrix):
     """
     # This uses the property that the log det(A) = 2 * sum(log(real(diag(C))))
     # where C is the cholesky decomposition of A.
-    chol = torch.cholesky(matrix)
+    chol = cholesky_jitter(matrix)
     #return 2.0 * torch.sum(torch.log(torch.diagonal(chol, dim1=-2, dim2=-1) + 1e-6), dim=-1)
     return 2.0 * torch.sum(torch.log(torch.diagonal(chol, dim1=-2, dim2=-1) + 1e-8), dim=-1)
 
@@ -112,9 +220,7 @@ def batch_cholesky_inverse(matrix):
     Args: 	matrix, 4-D tensor, [N, C, M, M].
             matrix must be a symmetric positive define matrix.
     """
-    chol_low = torch.cholesky(matrix, upper=False)
-    chol_low_inv = batch_low_tri_inv(chol_low)
-    return torch.matmul(chol_low_inv.transpose(-2, -1), chol_low_inv)
+    return torch.cholesky_inverse(cholesky_jitter(matrix))
 
 
 def batch_low_tri_inv(L):
@@ -2,12 +2,11 @@
 
 from typing import Dict, List
 
-import numpy as np
-
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
+
+from .loss_functions import reduce_loss
 
 __all__ = ['MixSoftmaxCrossEntropyLoss', 'MixSoftmaxCrossEntropyOHEMLoss',
            'FocalLoss2D']
@@ -38,22 +37,47 @@ class MixSoftmaxCrossEntropyLoss(nn.CrossEntropyLoss):
 
 
 class SoftmaxCrossEntropyOHEMLoss(nn.Module):
-    def __init__(self, ignore_label=-1, thresh=0.7, min_kept=256, use_weight=True, **kwargs):
+    """
+    Cross entropy over the hardest pixels, those where the probability of the target
+    class is at most thresh. If fewer than min_kept pixels are that hard the threshold
+    is raised to the min_kept'th smallest target probability.
+    """
+    def __init__(self, ignore_label=-1, thresh=0.7, min_kept=256, use_weight=True,
+                 class_weights: List[float] = None, **kwargs):
         super(SoftmaxCrossEntropyOHEMLoss, self).__init__()
         self.ignore_label = ignore_label
         self.thresh = float(thresh)
         self.min_kept = int(min_kept)
-        if use_weight:
+        if class_weights is None and use_weight:
             print("w/ class balance")
-            weight = torch.FloatTensor([0.8373, 0.918, 0.866, 1.0345, 1.0166, 0.9969, 0.9754,
-                                        1.0489, 0.8786, 1.0023, 0.9539, 0.9843, 1.1116, 0.9037, 1.0865, 1.0955,
-                                        1.0865, 1.1529, 1.0507])
-            self.criterion = torch.nn.CrossEntropyLoss(weight=weight, ignore_index=ignore_label)
-        else:
+            class_weights = [0.8373, 0.918, 0.866, 1.0345, 1.0166, 0.9969, 0.9754,
+                             1.0489, 0.8786, 1.0023, 0.9539, 0.9843, 1.1116, 0.9037, 1.0865,
+                             1.0955, 1.0865, 1.1529, 1.0507]
+        elif class_weights is None:
             print("w/o class balance")
-            self.criterion = torch.nn.CrossEntropyLoss(ignore_index=ignore_label)
-
-    def forward(self, predict, target, weight=None):
+        self.register_buffer('class_weights', None if class_weights is None \
+            else torch.tensor(class_weights, dtype=torch.float32))
+
+    @torch.no_grad()
+    def ohem_target(self, predict: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+        """
+        Returns the target with every pixel that isn't hard enough set to ignore_label
+        """
+        valid = target != self.ignore_label
+        target_idx = torch.where(valid, target, torch.zeros_like(target)).unsqueeze(1)
+        prob = F.softmax(predict.float(), dim=1).gather(1, target_idx).squeeze(1)
+        # Ignored pixels sort last so they're never among the min_kept
+        prob = prob.masked_fill(~valid, float('inf'))
+
+        threshold = torch.tensor(self.thresh, device=prob.device)
+        if self.min_kept > 0:
+            # If there are fewer valid pixels than min_kept this is inf and all are kept
+            kth_prob = prob.flatten().kthvalue(min(self.min_kept, prob.numel())).values
+            threshold = torch.max(kth_prob, threshold)
+
+        return target.masked_fill(valid & (prob > threshold), self.ignore_label)
+
+    def forward(self, predict, target, weight=None, reduction='mean'):
         assert not target.requires_grad
         assert predict.dim() == 4
         assert target.dim() == 3
@@ -61,69 +85,51 @@ class SoftmaxCrossEntropyOHEMLoss(nn.Module):
         assert predict.size(2) == target.size(1), "{0} vs {1} ".format(predict.size(2), target.size(1))
         assert predict.size(3) == target.size(2), "{0} vs {1} ".format(predict.size(3), target.size(3))
 
-        n, c, h, w = predict.size()
-        input_label = target.data.cpu().numpy().ravel().astype(np.int32)
-        x = np.rollaxis(predict.data.cpu().numpy(), 1).reshape((c, -1))
-        input_prob = np.exp(x - x.max(axis=0).reshape((1, -1)))
-        input_prob /= input_prob.sum(axis=0).reshape((1, -1))
-
-        valid_flag = input_label != self.ignore_label
-        valid_inds = np.where(valid_flag)[0]
-        label = input_label[valid_flag]
-        num_valid = valid_flag.sum()
-        if self.min_kept >= num_valid:
-            print('Labels: {}'.format(num_valid))
-        elif num_valid > 0:
-            prob = input_prob[:, valid_flag]
-            pred = prob[label, np.arange(len(label), dtype=np.int32)]
-            threshold = self.thresh
-            if self.min_kept > 0:
-                index = pred.argsort()
-                threshold_index = index[min(len(index), self.min_kept) - 1]
-                if pred[threshold_index] > self.thresh:
-                    threshold = pred[threshold_index]
-            kept_flag = pred <= threshold
-            valid_inds = valid_inds[kept_flag]
-
-        label = input_label[valid_inds].copy()
-        input_label.fill(self.ignore_label)
-        input_label[valid_inds] = label
-        valid_flag_new = input_label != self.ignore_label
-        # print(np.sum(valid_flag_new))
-        target = Variable(torch.from_numpy(input_label.reshape(target.size())).long().cuda())
-
-        return self.criterion(predict, target)
+        class_weights = None if self.class_weights is None \
+            else self.class_weights.to(predict.device)
+
+        target = self.ohem_target(predict, target)
+        if reduction == 'mean':
+            return F.cross_entropy(predict, target, weight=class_weights,
+                                   ignore_index=self.ignore_label)
+
+        # Each sample's weighted mean over its own kept pixels
+        valid = target != self.ignore_label
+        pixel_weight = valid.float() if class_weights is None else \
+            class_weights[target.masked_fill(~valid, 0)] * valid
+        return reduce_loss(F.cross_entropy(predict, target, ignore_index=self.ignore_label,
+                                           reduction='none'), reduction, pixel_weight)
 
 
 class MixSoftmaxCrossEntropyOHEMLoss(SoftmaxCrossEntropyOHEMLoss):
-    def __init__(self, aux=False, aux_weight=0.2, ignore_index=255, **kwargs):
+    """
+    OHEM cross entropy of the segmentation output and optionally the auxiliary output
+    """
+    def __init__(self, weight=1.0, aux=False, aux_weight=0.2, ignore_index=255, **kwargs):
         super(MixSoftmaxCrossEntropyOHEMLoss, self).__init__(ignore_label=ignore_index, **kwargs)
+        self.weight = weight
         self.aux = aux
         self.aux_weight = aux_weight
 
-    def _aux_forward(self, *inputs, **kwargs):
-        *preds, target = tuple(inputs)
-
-        loss = super(MixSoftmaxCrossEntropyOHEMLoss, self).forward(preds[0], target)
-        for i in range(1, len(preds)):
-            aux_loss = super(MixSoftmaxCrossEntropyOHEMLoss, self).forward(preds[i], target)
-            loss += self.aux_weight * aux_loss
-        return loss
+    def forward(self, seg_pred: Dict[str, torch.Tensor],
+                seg_gt: torch.Tensor, reduction='mean', **kwargs) -> torch.Tensor:
+        loss = super(MixSoftmaxCrossEntropyOHEMLoss, self).forward(
+            seg_pred['seg'], seg_gt, reduction=reduction)
+        if self.aux and 'seg_aux' in seg_pred.keys():
+            loss += self.aux_weight * super(MixSoftmaxCrossEntropyOHEMLoss, self).forward(
+                seg_pred['seg_aux'], seg_gt, reduction=reduction)
+        return self.weight * loss
 
-    def forward(self, *inputs, **kwargs):
-        preds, target = tuple(inputs)
-        inputs = tuple(list([preds]) + [target])
-        if self.aux:
-            return self._aux_forward(*inputs)
-        else:
-            return super(MixSoftmaxCrossEntropyOHEMLoss, self).forward(*inputs)
 
 class FocalLoss2D(nn.Module):
     """
-    Focal Loss for Imbalanced problems, also includes additonal weighting
+    Focal Loss for Imbalanced problems, also includes additonal weighting.\n
+    The focal term is applied to each pixel's cross entropy before the weighted
+    average, class weights are fixed (class_weights, e.g. from dataset_statistics)
+    or computed from each batch's class frequency if dynamic_weights is set.
     """
     def __init__(self, weight=1.0, gamma=2.0, ignore_index=255, dynamic_weights=False,
-                 scale_factor=0.125, **kwargs):
+                 scale_factor=0.125, class_weights: List[float] = None, **kwargs):
         super(FocalLoss2D, self).__init__()
 
         self.weight = weight
@@ -131,52 +137,126 @@ class FocalLoss2D(nn.Module):
         self.ignore_index = ignore_index
         self.dynamic_weights = dynamic_weights
         self.scale_factor = scale_factor
+        # Fixed weights (e.g. from dataset_statistics) take priority over dynamic weights
+        self.register_buffer('class_weights', None if class_weights is None \
+            else torch.tensor(class_weights, dtype=torch.float32))
+
+    def _get_weights(self, seg_gt: torch.Tensor, valid: torch.Tensor,
+                     n_classes: int, device: torch.device) -> torch.Tensor:
+        if self.class_weights is not None:
+            return self.class_weights.to(device)
+
+        weights = torch.ones(n_classes, device=device)
+        if self.dynamic_weights:
+            counts = torch.bincount(seg_gt[valid], minlength=n_classes)[:n_classes]
+            present = counts > 0
+            weights[present] = self.scale_factor / \
+                (self.scale_factor + counts[present] / float(seg_gt.nelement()))
+        return weights
 
     def forward(self, seg_pred: Dict[str, torch.Tensor],
-                seg_gt: torch.Tensor, **kwargs) -> torch.Tensor:
+                seg_gt: torch.Tensor, reduction='mean', **kwargs) -> torch.Tensor:
         '''
-        Forward implementation that returns focal loss between prediciton and target
+        Forward implementation that returns focal loss between prediciton and target,
+        reduction 'none' gives the loss of each sample
         '''
         assert 'seg' in seg_pred.keys()
+        logits = seg_pred['seg'].float()
 
-        weights = torch.ones(seg_pred['seg'].shape[1]).to(seg_pred['seg'].get_device())
-        if self.dynamic_weights:
-            class_ids, counts = seg_gt[seg_gt != self.ignore_index].unique(return_counts=True)
-            weights[class_ids] = self.scale_factor / \
-                    (self.scale_factor + counts / float(seg_gt.nelement()))
+        valid = seg_gt != self.ignore_index
+        target = torch.where(valid, seg_gt, torch.zeros_like(seg_gt))
+        weights = self._get_weights(seg_gt, valid, logits.shape[1], logits.device)
 
-        # compute the negative likelyhood
-        ce_loss = F.cross_entropy(
-            seg_pred['seg'], seg_gt, ignore_index=self.ignore_index, weight=weights)
+        # Log probability of each pixel's target class, no one-hot is made
+        logp_t = F.log_softmax(logits, dim=1).gather(1, target.unsqueeze(1)).squeeze(1)
+        pixel_weight = weights[target] * valid
 
-        # compute the loss
-        focal_loss = torch.pow(1 - torch.exp(-ce_loss), self.gamma) * ce_loss
+        focal_loss = -torch.pow(1 - logp_t.exp(), self.gamma) * logp_t
 
-        # return the average
-        return self.weight * focal_loss.mean()
+        # Weighted average over valid pixels like cross entropy's
+        return self.weight * reduce_loss(focal_loss, reduction, pixel_weight)
 
 class SegCrossEntropy(nn.Module):
     def __init__(self, weight=1.0, ignore_index=255, dynamic_weights=False,
-                 scale_factor=0.125, **kwargs):
+                 scale_factor=0.125, class_weights: List[float] = None, **kwargs):
         super(SegCrossEntropy, self).__init__()
 
         self.weight = weight
         self.ignore_index = ignore_index
         self.dynamic_weights = dynamic_weights
         self.scale_factor = scale_factor
+        self.register_buffer('class_weights', None if class_weights is None \
+            else torch.tensor(class_weights, dtype=torch.float32))
 
     def forward(self, seg_pred: Dict[str, torch.Tensor],
-                seg_gt: torch.Tensor, **kwargs) -> torch.Tensor:
+                seg_gt: torch.Tensor, reduction='mean', **kwargs) -> torch.Tensor:
         '''
-        Forward implementation that returns cross entropy between prediciton and target
+        Forward implementation that returns cross entropy between prediciton and target,
+        reduction 'none' gives the loss of each sample
         '''
         assert 'seg' in seg_pred.keys()
 
-        weights = torch.ones(seg_pred['seg'].shape[1]).to(seg_pred['seg'].get_device())
-        if self.dynamic_weights:
-            class_ids, counts = seg_gt[seg_gt != self.ignore_index].unique(return_counts=True)
-            weights[class_ids] = self.scale_factor / \
-                    (self.scale_factor + counts / float(seg_gt.nelement()))
-
-        return self.weight * F.cross_entropy(
-            seg_pred['seg'], seg_gt, ignore_index=self.ignore_index, weight=weights)
+        if self.class_weights is not None:
+            weights = self.class_weights.to(seg_pred['seg'].device)
+        else:
+            weights = torch.ones(seg_pred['seg'].shape[1], device=seg_pred['seg'].device)
+            if self.dynamic_weights:
+                class_ids, counts = seg_gt[seg_gt != self.ignore_index].unique(return_counts=True)
+                weights[class_ids] = self.scale_factor / \
+                        (self.scale_factor + counts / float(seg_gt.nelement()))
+
+        if reduction == 'mean':
+            return self.weight * F.cross_entropy(
+                seg_pred['seg'], seg_gt, ignore_index=self.ignore_index, weight=weights)
+
+        # Each sample's weighted mean over its own valid pixels
+        valid = seg_gt != self.ignore_index
+        pixel_weight = weights[seg_gt.masked_fill(~valid, 0)] * valid
+        ce_loss = F.cross_entropy(seg_pred['seg'], seg_gt, ignore_index=self.ignore_index,
+                                  reduction='none')
+        return self.weight * reduce_loss(ce_loss, reduction, pixel_weight)
+
+if __name__ == '__main__':
+    import time
+
+    def _batch_focal_loss(seg_pred, seg_gt, gamma=2.0, ignore_index=255, scale_factor=0.125):
+        """
+        Previous implementation, focal term applied to the averaged cross entropy
+        """
+        weights = torch.ones(seg_pred.shape[1], device=seg_pred.device)
+        class_ids, counts = seg_gt[seg_gt != ignore_index].unique(return_counts=True)
+        weights[class_ids] = scale_factor / (scale_factor + counts / float(seg_gt.nelement()))
+        ce_loss = F.cross_entropy(seg_pred, seg_gt, ignore_index=ignore_index, weight=weights)
+        return torch.pow(1 - torch.exp(-ce_loss), gamma) * ce_loss
+
+    def _benchmark(func, n_iter=20):
+        for _ in range(3):
+            func()
+        if DEVICE.type == 'cuda':
+            torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(n_iter):
+            func()
+        if DEVICE.type == 'cuda':
+            torch.cuda.synchronize()
+        return 1000. * (time.time() - start_time) / n_iter
+
+    DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    PRED = torch.randn(4, 19, 256, 512, device=DEVICE, requires_grad=True)
+    TARGET = torch.randint(0, 19, (4, 256, 512), device=DEVICE)
+    TARGET[:, :32] = 255
+
+    DYNAMIC = FocalLoss2D(dynamic_weights=True)
+    FIXED = FocalLoss2D(class_weights=[1.] * 19)
+
+    for name, loss_fn in [("previous", lambda: _batch_focal_loss(PRED, TARGET)),
+                          ("dynamic weights", lambda: DYNAMIC({'seg': PRED}, TARGET)),
+                          ("fixed weights", lambda: FIXED({'seg': PRED}, TARGET))]:
+        print(f"{name:>16} on {DEVICE}: "
+              f"forward {_benchmark(loss_fn):.3f}ms, "
+              f"forward+backward {_benchmark(lambda: loss_fn().backward()):.3f}ms")
+
+    # With gamma=0 both reduce to the same weighted cross entropy
+    REFERENCE = _batch_focal_loss(PRED, TARGET, gamma=0.)
+    FUSED = FocalLoss2D(gamma=0., dynamic_weights=True)({'seg': PRED}, TARGET)
+    print(f"gamma=0 difference: {(REFERENCE - FUSED).abs().item():.3e}")
@@ -0,0 +1,69 @@
+"""
+Sparse evaluation of losses and metrics over the valid pixels of ground truth
+such as KITTI disparity and flow, where most of the dense tensor is empty
+"""
+
+from typing import Optional
+
+import torch
+
+__all__ = ['ValidPixels', 'depth_pixels', 'flow_pixels']
+
+class ValidPixels(object):
+    """
+    Batch and pixel indices of the valid pixels of a [B, H, W] or [B, 1, H, W] mask.\n
+    Values are gathered once into a flat [N] or [N, C] tensor and reduced directly,
+    nothing is scattered back into a dense tensor.
+    """
+    def __init__(self, mask: torch.Tensor):
+        mask = mask.reshape(mask.shape[0], -1)
+        self.batch_sz = mask.shape[0]
+        self.batch_idx, self.pixel_idx = mask.nonzero(as_tuple=True)
+        self.counts = torch.bincount(self.batch_idx, minlength=self.batch_sz)
+
+    def __len__(self):
+        return self.batch_idx.shape[0]
+
+    def gather(self, tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Valid values of a [B, H, W] or [B, 1, H, W] tensor as [N],
+        or of a [B, C, H, W] tensor as [N, C]
+        """
+        if tensor.dim() == 4 and tensor.shape[1] == 1:
+            tensor = tensor.squeeze(1)
+        if tensor.dim() == 3:
+            return tensor.reshape(self.batch_sz, -1)[self.batch_idx, self.pixel_idx]
+        return tensor.reshape(*tensor.shape[:2], -1)[self.batch_idx, :, self.pixel_idx]
+
+    def batch_sum(self, values: torch.Tensor) -> torch.Tensor:
+        """
+        Sum of the gathered values [N] of each sample of the batch
+        """
+        return torch.zeros(self.batch_sz, dtype=values.dtype, device=values.device) \
+            .index_add_(0, self.batch_idx, values)
+
+    def batch_mean(self, values: torch.Tensor, empty: float = None) -> torch.Tensor:
+        """
+        Mean of the gathered values [N] of each sample of the batch, samples
+        without valid pixels are NaN or the value of empty if given
+        """
+        if empty is None:
+            return self.batch_sum(values) / self.counts.to(values.dtype)
+        return torch.where(self.counts > 0,
+                           self.batch_sum(values) / self.counts.clamp(min=1).to(values.dtype),
+                           values.new_tensor(empty))
+
+def depth_pixels(depth: torch.Tensor, max_depth: Optional[float] = None) -> ValidPixels:
+    """
+    Pixels with a depth/disparity greater than zero, and less than max_depth if given
+    """
+    mask = depth > 0
+    if max_depth is not None:
+        mask &= depth < max_depth
+    return ValidPixels(mask)
+
+def flow_pixels(flow_mask: torch.Tensor) -> ValidPixels:
+    """
+    Pixels of the flow mask that are set
+    """
+    return ValidPixels(flow_mask > 0)
@@ -1,14 +1,19 @@
+import torch
+
 from .fast_scnn import FastSCNN
 from .pwcnet_sfd import MonoSFDNet
 from .nnet_models import *
 from .pwcnet import PWCNet
 from .ocrnet import OCRNet, MscaleOCR
 from .ocrnet_sfd import OCRNetSFD
+from .compile_utils import compile_model, report_graph_breaks
 
 def get_model(model_args):
     """
     Returns pytorch model given dictionary pair of the model
-    name and args/configuration
+    name and args/configuration\n
+    Optional keys: channels_last (bool) and compile (dict of torch.compile
+    settings, see compile_utils.compile_model)
     """
     if model_args.name == "MonoSFDNet":
         model = MonoSFDNet(**model_args.args)
@@ -25,4 +30,16 @@ def get_model(model_args):
     else:
         raise NotImplementedError(model_args.name)
 
+    # Optional NHWC layout for the convolution heavy models, incoming batches
+    # are converted to match by reading model.memory_format
+    if 'channels_last' in model_args and model_args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+        model.memory_format = torch.channels_last
+    else:
+        model.memory_format = torch.contiguous_format
+
+    if 'compile' in model_args and model_args.compile:
+        compile_cfg = model_args.compile if isinstance(model_args.compile, dict) else {}
+        model = compile_model(model, model_args, compile_cfg)
+
     return model
@@ -0,0 +1,124 @@
+"""
+Opt-in compiled execution of models built by get_model
+"""
+
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Dict
+
+import torch
+
+__all__ = ['compile_model', 'report_graph_breaks']
+
+COMPILE_CACHE_DIR = Path.cwd() / "torch_models" / "compile_cache"
+
+def _shape_key(module: torch.nn.Module, args, kwargs) -> str:
+    """
+    Name of the compiled artifact for a set of inputs, graphs differ
+    between train/eval mode and with/without autograd so they are included
+    """
+    key = ['train' if module.training else 'eval',
+           'grad' if torch.is_grad_enabled() else 'nograd']
+
+    inputs = [(str(idx), arg) for idx, arg in enumerate(args)] + sorted(kwargs.items())
+    for name, data in inputs:
+        if isinstance(data, torch.Tensor):
+            key.append(f"{name}-{'x'.join(str(dim) for dim in data.shape)}")
+        elif isinstance(data, bool):
+            key.append(f"{name}-{data}")
+
+    return "_".join(key)
+
+class CompiledForward(object):
+    """
+    Replaces a module's forward with a torch.compile'd version while saving the
+    compiled artifacts of each new input shape to disk, the artifacts are loaded
+    back in the next time that shape is seen so later runs skip recompilation.\n
+    Assigning this to module.forward leaves the state_dict keys untouched, so
+    existing checkpoints still load.
+    """
+    def __init__(self, module: torch.nn.Module, cache_dir: Path, **compile_kwargs):
+        self.eager = module.forward
+        self._module = module
+        self._compiled = torch.compile(self.eager, **compile_kwargs)
+        self._cache_dir = cache_dir
+        self._seen_keys = set()
+        # Portable artifact (de)serialisation was only added in PyTorch 2.6
+        self._persist = hasattr(torch.compiler, 'save_cache_artifacts')
+
+    def __call__(self, *args, **kwargs):
+        shape_key = _shape_key(self._module, args, kwargs)
+        if shape_key in self._seen_keys or not self._persist:
+            return self._compiled(*args, **kwargs)
+
+        artifact_path = self._cache_dir / f"{shape_key}.bin"
+        if os.path.isfile(artifact_path):
+            with open(artifact_path, 'rb') as artifact_f:
+                torch.compiler.load_cache_artifacts(artifact_f.read())
+
+        output = self._compiled(*args, **kwargs)
+        self._seen_keys.add(shape_key)
+
+        if not os.path.isfile(artifact_path):
+            artifacts = torch.compiler.save_cache_artifacts()
+            if artifacts is not None:
+                with open(artifact_path, 'wb') as artifact_f:
+                    artifact_f.write(artifacts[0])
+
+        return output
+
+def compile_model(model: torch.nn.Module, model_args: Dict,
+                  compile_cfg: Dict) -> torch.nn.Module:
+    """
+    Compiles the forward method of the model in place. The on-disk cache
+    is keyed by the model configuration and then the input shape.\n
+    compile_cfg keys: backend, mode, dynamic, fullgraph, cache_dir
+    """
+    if not hasattr(torch, 'compile'):
+        raise NotImplementedError("Compiled mode requires torch.compile (PyTorch >= 2.0)")
+
+    cfg_hash = hashlib.md5(json.dumps(model_args, sort_keys=True).encode('utf-8'))
+    cache_dir = Path(compile_cfg.get('cache_dir', COMPILE_CACHE_DIR)) / cfg_hash.hexdigest()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Inductor's own FX graph and autotuning caches also live with the artifacts
+    from torch._inductor import config as inductor_config
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = str(cache_dir / "inductor")
+    inductor_config.fx_graph_cache = True
+
+    mode = compile_cfg.get('mode', None)
+    model.forward = CompiledForward(
+        model, cache_dir,
+        backend=compile_cfg.get('backend', 'inductor'),
+        mode=None if mode == 'default' else mode,
+        dynamic=compile_cfg.get('dynamic', None),
+        fullgraph=compile_cfg.get('fullgraph', False))
+    model.compile_cache = cache_dir
+
+    return model
+
+def report_graph_breaks(model: torch.nn.Module, *args, **kwargs) -> str:
+    """
+    Traces the eager forward method with TorchDynamo and returns a report of the
+    graph breaks and their reasons, if the model was compiled with compile_model
+    the report is also written to its cache directory.
+    """
+    forward = getattr(model.forward, 'eager', model.forward)
+    explanation = torch._dynamo.explain(forward)(*args, **kwargs)
+
+    report = [f"{model.modelname}: {explanation.graph_count} graphs, "
+              f"{len(explanation.break_reasons)} graph breaks"]
+    for idx, reason in enumerate(explanation.break_reasons):
+        report.append(f"Break {idx+1}: {reason.reason}")
+        for frame in reason.user_stack[-2:]:
+            report.append(f"\t{frame.filename}:{frame.lineno} in {frame.name}")
+    report = "\n".join(report)
+
+    if hasattr(model, 'compile_cache'):
+        with open(model.compile_cache / "graph_breaks.txt", "w") as txt_file:
+            txt_file.write(report)
+
+    return report
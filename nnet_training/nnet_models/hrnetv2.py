@@ -12,6 +12,7 @@ from __future__ import print_function
 
 import os
 from pathlib import Path
+from typing import List
 import numpy as np
 
 import torch
@@ -421,7 +422,16 @@ class HighResolutionNet(nn.Module):
                 x_list.append(y_list[i])
         x = self.stage4(x_list)
 
-        # Upsampling
+        # Return concatinated features for segmentation, and separated unscaled
+        # features for flow from smallest to highest resolution
+        return self.fuse_pyramid(x), x[::-1]
+
+    @staticmethod
+    def fuse_pyramid(x: List[torch.Tensor]) -> torch.Tensor:
+        """
+        Upsamples and concatenates the stage 4 outputs (highest resolution first)
+        into the high level features used by the segmentation and depth heads
+        """
         x0_h, x0_w = x[0].size(2), x[0].size(3)
         x1 = F.interpolate(x[1], size=(x0_h, x0_w), mode='bilinear',
                            align_corners=align_corners)
@@ -430,11 +440,7 @@ class HighResolutionNet(nn.Module):
         x3 = F.interpolate(x[3], size=(x0_h, x0_w), mode='bilinear',
                            align_corners=align_corners)
 
-        feats = torch.cat([x[0], x1, x2, x3], 1)
-
-        # Return concatinated features for segmentation, and separated unscaled
-        # features for flow from smallest to highest resolution
-        return feats, x[::-1]
+        return torch.cat([x[0], x1, x2, x3], 1)
 
     def init_weights(self, pretrained: Path):
         print('=> init weights from normal distribution')
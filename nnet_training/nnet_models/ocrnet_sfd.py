@@ -48,6 +48,7 @@ Example Config Structure
             "args" : {}
         },
         "1x1_conv_out" : 32,
+        "batch_pairs" : false,
         "depth_network" : {
             "type" : "DepthHeadV1",
             "args" : {"inter_ch" : [128, 32]}
@@ -58,13 +59,13 @@ Example Config Structure
 """
 
 from collections import OrderedDict
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from nnet_training.loss_functions.UnFlowLoss import flow_warp
+from nnet_training.loss_functions.UnFlowLoss import flow_warp, upsample_flow
 from nnet_training.correlation_package.correlation import Correlation
 
 from .hrnetv2 import get_seg_model
@@ -98,11 +99,15 @@ class DepthHeadV1(nn.Module):
 
 class OCRNetSFD(nn.Module):
     """
-    OCRNet with Segmentation + Optic Flow Output
+    OCRNet with Segmentation + Optic Flow Output\n
+    With batch_pairs both frames go through the backbone in a single batched call,
+    during training the batch norm statistics are then shared by both frames.
     """
-    def __init__(self, **kwargs):
+    def __init__(self, upsample=True, batch_pairs=False, **kwargs):
         super(OCRNetSFD, self).__init__()
         self.modelname = "OCRNetSFD"
+        self.upsample = upsample
+        self.batch_pairs = batch_pairs
 
         self.backbone = get_seg_model(**kwargs['hrnetv2_config'])
         self.ocr = OCR_block(self.backbone.high_level_ch, **kwargs['ocr_config'])
@@ -154,9 +159,11 @@ class OCRNetSFD(nn.Module):
             self.depth_head = DepthHeadV1(self.backbone.high_level_ch, 32)
 
     def flow_forward(self, im1_pyr: List[torch.Tensor], im2_pyr: List[torch.Tensor],
-                     final_scale: float):
+                     out_size: Tuple[int, int] = None) -> List[torch.Tensor]:
         '''
-        Auxillary forward method that does the flow prediction
+        Auxillary forward method that does the flow prediction, flows are returned
+        finest first at the resolution of their level, only the finest is upsampled
+        to out_size if given
         '''
         # output
         flows = []
@@ -164,6 +171,8 @@ class OCRNetSFD(nn.Module):
         # init
         b_size, _, h_x1, w_x1, = im1_pyr[0].size()
         flow = im1_pyr[0].new_zeros((b_size, 2, h_x1, w_x1))
+        if im1_pyr[0].is_contiguous(memory_format=torch.channels_last):
+            flow = flow.contiguous(memory_format=torch.channels_last)
 
         for level, (im1, im2) in enumerate(zip(im1_pyr, im2_pyr)):
             # warping
@@ -189,21 +198,52 @@ class OCRNetSFD(nn.Module):
 
             flows.append(flow)
 
-        flows = [F.interpolate(flow * final_scale, scale_factor=final_scale,
-                               mode='bilinear', align_corners=True) for flow in flows]
+        if out_size is not None:
+            flows[-1] = upsample_flow(flows[-1], out_size)
 
         return flows[::-1]
 
+    def backbone_forward(self, img: torch.Tensor, img_pyr: List[torch.Tensor] = None):
+        """
+        Runs the backbone on an image unless its feature pyramid (lowest resolution
+        first) has already been given from the feature cache.
+        """
+        if img_pyr is None:
+            return self.backbone(img)
+        return self.backbone.fuse_pyramid(img_pyr[::-1]), img_pyr
+
+    def backbone_pair(self, img1: torch.Tensor, img2: torch.Tensor,
+                      img1_pyr: List[torch.Tensor] = None, img2_pyr: List[torch.Tensor] = None):
+        """
+        Backbone features and pyramid of both frames of a pair, both frames are
+        concatenated along the batch for one backbone call with batch_pairs
+        unless their pyramids have been given from the feature cache.
+        """
+        if not self.batch_pairs or img1_pyr is not None or img2_pyr is not None:
+            return self.backbone_forward(img1, img1_pyr), self.backbone_forward(img2, img2_pyr)
+
+        features, pyramid = self.backbone(torch.cat([img1, img2]))
+        features1, features2 = features.chunk(2)
+        pyr1, pyr2 = zip(*[level.chunk(2) for level in pyramid])
+        return (features1, list(pyr1)), (features2, list(pyr2))
+
     def forward(self, l_img: torch.Tensor, consistency=True, **kwargs) -> Dict[str, torch.Tensor]:
         """
         Forward method for OCRNet with segmentation, flow and depth, returns dictionary of outputs.
         \nDuring onnx export, consistency becomes the sequential image argument because onnx\
         export is not compatible with keyword aruments.
+        \nPrecomputed backbone pyramids can be given with l_img_pyr and l_seq_pyr.
         """
         forward = {}
 
-        # Backbone Forward pass on image 1 and 2
-        high_level_features, im1_pyr = self.backbone(l_img)
+        # Backbone Forward pass on image 1 and 2, the sequential image is given as
+        # consistency during onnx export
+        l_seq = consistency if isinstance(consistency, torch.Tensor) else kwargs.get('l_seq')
+        if l_seq is not None:
+            (high_level_features, im1_pyr), (seq_features, im2_pyr) = self.backbone_pair(
+                l_img, l_seq, kwargs.get('l_img_pyr'), kwargs.get('l_seq_pyr'))
+        else:
+            high_level_features, im1_pyr = self.backbone_forward(l_img, kwargs.get('l_img_pyr'))
 
         # Segmentation pass with image 1
         forward['seg'], forward['seg_aux'], _ = self.ocr(high_level_features)
@@ -214,30 +254,23 @@ class OCRNetSFD(nn.Module):
 
         # We must be ONNX exporting
         if isinstance(consistency, torch.Tensor):
-            _, im2_pyr = self.backbone(consistency)
             # Flow pass with image 1
-            scale_factor = l_img.size()[-1] // forward['seg'].size()[-1]
-            forward['flow'] = self.flow_forward(im1_pyr, im2_pyr, scale_factor)[0]
+            forward['flow'] = self.flow_forward(im1_pyr, im2_pyr, tuple(l_img.size()[2:]))[0]
             del forward['seg_aux']
 
         if 'l_seq' in kwargs:
-            _, im2_pyr = self.backbone(kwargs['l_seq'])
-
-            # Flow pass with image 1
-            scale_factor = l_img.size()[-1] // forward['seg'].size()[-1]
-            forward['flow'] = self.flow_forward(im1_pyr, im2_pyr, scale_factor)
+            # Flow pass with image 1, only the finest flow at full resolution
+            out_size = tuple(l_img.size()[2:]) if self.upsample else None
+            forward['flow'] = self.flow_forward(im1_pyr, im2_pyr, out_size)
 
             if consistency:
                 # Flow pass with image 2
-                forward['flow_b'] = self.flow_forward(im2_pyr, im1_pyr, scale_factor)
+                forward['flow_b'] = self.flow_forward(im2_pyr, im1_pyr, out_size)
 
             if 'slam' in kwargs and kwargs['slam'] is True:
-                # Another forward brah
-                high_level_features, _ = self.backbone(kwargs['l_seq'])
-
-                # Estimate seg and depth
-                forward['depth_b'] = self.depth_head(high_level_features)
-                forward['seg_b'], _, _ = self.ocr(high_level_features)
+                # Estimate seg and depth from the features of image 2
+                forward['depth_b'] = self.depth_head(seq_features)
+                forward['seg_b'], _, _ = self.ocr(seq_features)
 
                 # Rescale
                 forward['seg_b'] = scale_as(forward['seg_b'], l_img)
@@ -66,6 +66,8 @@ class PWCNet(nn.Module):
         # init
         b_size, _, h_x1, w_x1, = im1_pyr[0].size()
         flow = im1_pyr[0].new_zeros((b_size, 2, h_x1, w_x1)).float()
+        if im1_pyr[0].is_contiguous(memory_format=torch.channels_last):
+            flow = flow.contiguous(memory_format=torch.channels_last)
 
         for lvl, (im1, im2) in enumerate(zip(im1_pyr, im2_pyr)):
             # warping
@@ -105,8 +107,7 @@ class PWCNet(nn.Module):
         # outputs
         flows = {}
 
-        im1_pyr = self.feature_pyramid_extractor(l_img)
-        im2_pyr = self.feature_pyramid_extractor(l_seq)
+        im1_pyr, im2_pyr = self.feature_pyramid_extractor.pair_forward(l_img, l_seq)
 
         flows['flow'] = self.aux_forward(im1_pyr, im2_pyr)
         if consistency:
@@ -45,6 +45,15 @@ class FeatureExtractor(nn.Module):
 
         return feature_pyramid[::-1]
 
+    def pair_forward(self, img1, img2):
+        """
+        Feature pyramids of both frames of a pair from one call with the frames
+        concatenated along the batch, the same as two calls as there is no normalisation
+        """
+        pyramid = self.forward(torch.cat([img1, img2]))
+        pyr1, pyr2 = zip(*[level.chunk(2) for level in pyramid])
+        return list(pyr1), list(pyr2)
+
 
 class FlowEstimatorDense(nn.Module):
     def __init__(self, ch_in):
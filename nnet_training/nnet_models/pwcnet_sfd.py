@@ -38,13 +38,13 @@ Example Config Structure
 
 """
 
-from typing import List
+from typing import List, Tuple
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from nnet_training.loss_functions.UnFlowLoss import flow_warp
+from nnet_training.loss_functions.UnFlowLoss import flow_warp, upsample_flow
 from nnet_training.correlation_package.correlation import Correlation
 
 from .pwcnet_modules import *
@@ -188,17 +188,32 @@ class MonoSFDNet(nn.Module):
         else:
             self.context_networks = ContextNetwork(self.flow_estimator.feat_dim + 2)
 
-    def flow_forward(self, im1_pyr: List[torch.Tensor],
-                     im2_pyr: List[torch.Tensor]) -> List[torch.Tensor]:
+    def project_pyramid(self, feat_pyr: List[torch.Tensor]) -> List[torch.Tensor]:
         '''
-        Auxillary forward method that does the flow prediction
+        1x1 projection of each level of a feature pyramid up to the output level,
+        computed once per image and shared by the depth and both flow decoders
         '''
+        return [conv_1x1(feat) for conv_1x1, feat in zip(self.conv_1x1, feat_pyr)]
+
+    def flow_forward(self, im1_pyr: List[torch.Tensor], im2_pyr: List[torch.Tensor],
+                     out_size: Tuple[int, int] = None,
+                     im1_proj: List[torch.Tensor] = None) -> List[torch.Tensor]:
+        '''
+        Auxillary forward method that does the flow prediction, flows are returned
+        finest first at the resolution of their level, only the finest is upsampled
+        to out_size if given. im1_proj is the project_pyramid of im1_pyr if already computed.
+        '''
+        if im1_proj is None:
+            im1_proj = self.project_pyramid(im1_pyr)
+
         # output
         flows = []
 
         # init
         b_size, _, h_x1, w_x1, = im1_pyr[0].size()
         flow = im1_pyr[0].new_zeros((b_size, 2, h_x1, w_x1))
+        if im1_pyr[0].is_contiguous(memory_format=torch.channels_last):
+            flow = flow.contiguous(memory_format=torch.channels_last)
 
         for level, (im1, im2) in enumerate(zip(im1_pyr, im2_pyr)):
             # warping
@@ -214,9 +229,8 @@ class MonoSFDNet(nn.Module):
             nn.functional.leaky_relu(out_corr, 0.1, inplace=True)
 
             # concat and estimate flow
-            im1_1by1 = self.conv_1x1[level](im1)
             im1_intm, flow_res = self.flow_estimator(
-                torch.cat([out_corr, im1_1by1, flow], dim=1))
+                torch.cat([out_corr, im1_proj[level], flow], dim=1))
             flow += flow_res
 
             flow_fine = self.context_networks(torch.cat([im1_intm, flow], dim=1))
@@ -228,22 +242,29 @@ class MonoSFDNet(nn.Module):
             if level == self.output_level:
                 break
 
-        if self.upsample:
-            flows = [F.interpolate(flow * 4, scale_factor=4, mode='bilinear',
-                                   align_corners=True) for flow in flows]
+        if out_size is not None:
+            flows[-1] = upsample_flow(flows[-1], out_size)
 
         return flows[::-1]
 
-    def depth_forward(self, feat_pyr, seg):
+    def depth_forward(self, feat_pyr: List[torch.Tensor], seg: torch.Tensor,
+                      feat_proj: List[torch.Tensor] = None) -> List[torch.Tensor]:
+        '''
+        Auxillary forward method that does the depth prediction,
+        feat_proj is the project_pyramid of feat_pyr if already computed
+        '''
+        if feat_proj is None:
+            feat_proj = self.project_pyramid(feat_pyr)
+
         depths = []
 
         # init
         b_size, _, h_x1, w_x1, = feat_pyr[0].size()
         depth = feat_pyr[0].new_zeros((b_size, 1, h_x1, w_x1)).float()
+        if feat_pyr[0].is_contiguous(memory_format=torch.channels_last):
+            depth = depth.contiguous(memory_format=torch.channels_last)
 
-        for level, enc_feat in enumerate(feat_pyr):
-            enc_1by1 = self.conv_1x1[level](enc_feat)
-
+        for level, (enc_feat, enc_1by1) in enumerate(zip(feat_pyr, feat_proj)):
             # concat and estimate depth
             new_size = tuple(enc_feat.size()[2:])
             seg_resized = F.interpolate(seg, size=new_size, mode='nearest')
@@ -270,7 +291,12 @@ class MonoSFDNet(nn.Module):
         # outputs
         preds = {}
 
-        im1_pyr = self.feature_pyramid_extractor(l_img)
+        # Both frames share a single pass of the feature extractor
+        if 'l_seq' in kwargs:
+            im1_pyr, im2_pyr = self.feature_pyramid_extractor.pair_forward(l_img, kwargs['l_seq'])
+        else:
+            im1_pyr = self.feature_pyramid_extractor(l_img)
+
         preds['seg'] = self.segmentation_network(im1_pyr)
 
         # I'll revisit using GT, will have to make a
@@ -281,16 +307,19 @@ class MonoSFDNet(nn.Module):
         # else:
         #     seg_gt = kwargs['seg']
 
-        preds['depth'] = self.depth_forward(im1_pyr, preds['seg'].clone().detach())
+        # 1x1 projections shared by the depth and flow decoders
+        im1_proj = self.project_pyramid(im1_pyr)
 
-        if 'l_seq' in kwargs:
-            im2_pyr = self.feature_pyramid_extractor(kwargs['l_seq'])
+        preds['depth'] = self.depth_forward(im1_pyr, preds['seg'].clone().detach(), im1_proj)
 
+        if 'l_seq' in kwargs:
             preds['seg_b'] = self.segmentation_network(im2_pyr)
 
-            preds['flow'] = self.flow_forward(im1_pyr, im2_pyr)
+            out_size = tuple(l_img.size()[2:]) if self.upsample else None
+            preds['flow'] = self.flow_forward(im1_pyr, im2_pyr, out_size, im1_proj)
 
             if consistency:
-                preds['flow_b'] = self.flow_forward(im2_pyr, im1_pyr)
+                preds['flow_b'] = self.flow_forward(
+                    im2_pyr, im1_pyr, out_size, self.project_pyramid(im2_pyr))
 
         return preds
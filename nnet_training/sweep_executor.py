@@ -0,0 +1,235 @@
+#!/usr/bin/env python3.8
+
+"""
+Expands a base config and a parameter grid into a set of experiments and
+trains them non-interactively, spread over the available GPUs or CPU core groups.\n
+The grid is a JSON dictionary of dotted config keys to lists of values, e.g.\n
+{"optimiser.args.lr": [1e-4, 1e-3], "dataset.batch_size": [4, 8]}\n
+With "target_metrics" in the base config the table also compares the time each
+variant took to reach the targets, e.g. uniform against loss importance sampling with
+{"dataset.sampler": [null, {"type": "LossImportance", "args": {"alpha": 1.0}}]}
+"""
+
+__author__ = "Bryce Ferenczi"
+__email__ = "bryce.ferenczi@monashmotorsport.com"
+
+import os
+import sys
+import json
+import time
+import copy
+import hashlib
+import argparse
+import itertools
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List, Set, Tuple
+
+from easydict import EasyDict
+import pandas as pd
+
+import torch
+
+from nnet_training.training_executor import experiment_hash
+from nnet_training.utilities.metrics import get_loggers
+
+def set_nested(config: Dict, dotted_key: str, value: Any) -> None:
+    """
+    Sets config["a"]["b"]["c"] = value given the key "a.b.c"
+    """
+    *parents, key = dotted_key.split('.')
+    for parent in parents:
+        if parent not in config:
+            raise KeyError(f"{parent} of {dotted_key} not in config")
+        config = config[parent]
+    config[key] = value
+
+def expand_grid(base_config: Dict, grid: Dict[str, List[Any]]) -> List[Tuple[Dict, Dict]]:
+    """
+    Returns the (parameters, config) of every combination of the grid values
+    """
+    variants = []
+    for values in itertools.product(*grid.values()):
+        params = dict(zip(grid.keys(), values))
+        config = copy.deepcopy(base_config)
+        for dotted_key, value in params.items():
+            set_nested(config, dotted_key, value)
+        variants.append((params, config))
+    return variants
+
+def parse_cpu_groups(cpu_groups: str) -> List[Set[int]]:
+    """
+    Parses core groups written as "0-7,8-15" or "0-3+8-11,4-7+12-15"
+    """
+    groups = []
+    for group in cpu_groups.split(','):
+        cores = set()
+        for span in group.split('+'):
+            start, _, end = span.partition('-')
+            cores.update(range(int(start), int(end if end else start) + 1))
+        groups.append(cores)
+    return groups
+
+class SweepScheduler(object):
+    """
+    Runs a training process for each variant with at most per_slot jobs on each
+    slot (GPU or CPU core group) and at most max_concurrent jobs overall
+    """
+    def __init__(self, slots: List[Dict[str, Any]], per_slot=1, max_concurrent=None):
+        self._slots = slots
+        self._per_slot = per_slot
+        self._max_concurrent = max_concurrent if max_concurrent else len(slots) * per_slot
+        self._slot_usage = [0] * len(slots)
+
+    def _launch(self, slot_idx: int, config_path: Path, epochs: int, log_file):
+        slot = self._slots[slot_idx]
+        env = os.environ.copy()
+        if 'gpu' in slot:
+            env['CUDA_VISIBLE_DEVICES'] = str(slot['gpu'])
+        else:
+            env['CUDA_VISIBLE_DEVICES'] = ""
+
+        preexec_fn = None
+        if 'cpus' in slot:
+            cpus = slot['cpus']
+            preexec_fn = lambda: os.sched_setaffinity(0, cpus)
+            env['OMP_NUM_THREADS'] = str(len(cpus))
+
+        cmd = [sys.executable, '-m', 'nnet_training.training_executor',
+               '-c', str(config_path), '-e', str(epochs)]
+        return subprocess.Popen(cmd, env=env, stdout=log_file, stderr=subprocess.STDOUT,
+                                stdin=subprocess.DEVNULL, preexec_fn=preexec_fn)
+
+    def run(self, config_paths: List[Path], epochs: int) -> Dict[int, Dict[str, Any]]:
+        """
+        Blocks until every config has been trained, returns the exit code,
+        wall time and slot of each job
+        """
+        pending = list(enumerate(config_paths))
+        running = {}
+        results = {}
+
+        while len(pending) > 0 or len(running) > 0:
+            for idx, job in list(running.items()):
+                if job['proc'].poll() is not None:
+                    job['log'].close()
+                    self._slot_usage[job['slot']] -= 1
+                    results[idx] = {
+                        'returncode': job['proc'].returncode,
+                        'wall_time': time.time() - job['start'],
+                        'slot': job['slot']
+                    }
+                    del running[idx]
+                    print(f"Finished variant {idx} with code {job['proc'].returncode}, "
+                          f"{len(pending)} pending, {len(running)} running")
+
+            while len(pending) > 0 and len(running) < self._max_concurrent:
+                slot_idx = min(range(len(self._slots)), key=lambda i: self._slot_usage[i])
+                if self._slot_usage[slot_idx] >= self._per_slot:
+                    break
+
+                idx, config_path = pending.pop(0)
+                log_file = open(config_path.with_suffix('.log'), 'w')
+                running[idx] = {
+                    'proc': self._launch(slot_idx, config_path, epochs, log_file),
+                    'log': log_file, 'slot': slot_idx, 'start': time.time()
+                }
+                self._slot_usage[slot_idx] += 1
+                print(f"Started variant {idx} on {self._slots[slot_idx]}")
+
+            time.sleep(1.)
+
+        return results
+
+def results_table(variants: List[Tuple[Dict, Dict]],
+                  run_info: Dict[int, Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Gathers the grid parameters, run status and best main metric
+    of each objective into a table with one row per variant
+    """
+    rows = []
+    for idx, (params, config) in enumerate(variants):
+        exper_hash = experiment_hash(EasyDict(config))
+        row = {'variant': idx, 'hash': exper_hash}
+        row.update(params)
+        row.update(run_info.get(idx, {}))
+
+        exper_path = Path.cwd() / "torch_models" / exper_hash
+        if os.path.isdir(exper_path):
+            for objective, logger in get_loggers(config['logger_cfg'], exper_path).items():
+                max_data = logger.max_accuracy(main_metric=True)
+                if max_data is not None:
+                    row[f"{objective}_{logger.main_metric}"] = max_data[1]
+
+        # Written by the trainer when "target_metrics" is configured
+        if os.path.isfile(exper_path / "time_to_target.json"):
+            with open(exper_path / "time_to_target.json") as json_file:
+                for objective, reached in json.load(json_file).items():
+                    row[f"{objective}_target_epoch"] = reached['epoch']
+                    row[f"{objective}_target_time"] = reached['time']
+
+        rows.append(row)
+
+    return pd.DataFrame(rows)
+
+def get_slots(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """
+    Each slot is either a GPU index or a set of CPU cores
+    """
+    if args.cpu_groups is not None:
+        return [{'cpus': cpus} for cpus in parse_cpu_groups(args.cpu_groups)]
+    if args.devices is not None:
+        return [{'gpu': int(device)} for device in args.devices.split(',')]
+    if torch.cuda.is_available():
+        return [{'gpu': device} for device in range(torch.cuda.device_count())]
+    return [{'cpus': os.sched_getaffinity(0)}]
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument('-c', '--config', default='configs/HRNetV2_kt.json',
+                        help='Base config the grid is applied to')
+    PARSER.add_argument('-g', '--grid', required=True,
+                        help='JSON file of {"dotted.config.key": [values, ...]}')
+    PARSER.add_argument('-e', '--epochs', type=int, required=True)
+    PARSER.add_argument('-n', '--name', default=None,
+                        help='Name of the sweep, defaults to the base config name')
+    PARSER.add_argument('--devices', default=None,
+                        help='Comma separated GPU indices, defaults to all visible GPUs')
+    PARSER.add_argument('--cpu-groups', default=None,
+                        help='Run on CPU core groups instead, e.g. "0-7,8-15"')
+    PARSER.add_argument('--per-device', type=int, default=1,
+                        help='Concurrent runs on each GPU or CPU core group')
+    PARSER.add_argument('--max-concurrent', type=int, default=None,
+                        help='Limit on the total number of concurrent runs')
+    ARGS = PARSER.parse_args()
+
+    with open(ARGS.config) as f:
+        BASE_CONFIG = json.load(f)
+    with open(ARGS.grid) as f:
+        GRID = json.load(f)
+
+    VARIANTS = expand_grid(BASE_CONFIG, GRID)
+
+    NAME = ARGS.name if ARGS.name is not None else Path(ARGS.config).stem
+    SWEEP_HASH = hashlib.md5(json.dumps([BASE_CONFIG, GRID]).encode('utf-8')).hexdigest()
+    SWEEP_PATH = Path.cwd() / "torch_models" / "sweeps" / f"{NAME}_{SWEEP_HASH[:8]}"
+    if not os.path.isdir(SWEEP_PATH):
+        os.makedirs(SWEEP_PATH)
+
+    with open(SWEEP_PATH / "grid.json", 'w') as f:
+        json.dump({'base': ARGS.config, 'grid': GRID}, f, indent=4)
+
+    CONFIG_PATHS = []
+    for IDX, (PARAMS, CONFIG) in enumerate(VARIANTS):
+        CONFIG_PATHS.append(SWEEP_PATH / f"variant_{IDX}.json")
+        with open(CONFIG_PATHS[-1], 'w') as f:
+            json.dump(CONFIG, f, indent=4)
+        print(f"Variant {IDX}: {experiment_hash(EasyDict(CONFIG))} {PARAMS}")
+
+    SCHEDULER = SweepScheduler(get_slots(ARGS), ARGS.per_device, ARGS.max_concurrent)
+    RUN_INFO = SCHEDULER.run(CONFIG_PATHS, ARGS.epochs)
+
+    RESULTS = results_table(VARIANTS, RUN_INFO)
+    RESULTS.to_csv(SWEEP_PATH / "results.csv", index=False)
+    print(RESULTS.to_string(index=False))
+    print(f"Results saved to {SWEEP_PATH / 'results.csv'}")
@@ -21,14 +21,43 @@ from nnet_training.nnet_models import get_model
 
 from nnet_training.utilities.kitti_dataset import get_kitti_dataset
 from nnet_training.utilities.cityscapes_dataset import get_cityscapse_dataset
+from nnet_training.utilities.dataset_statistics import resolve_dataset_statistics, get_max_depth
 from nnet_training.loss_functions import get_loss_function
 from nnet_training.utilities.model_trainer import ModelTrainer
 
+def experiment_hash(config_json: EasyDict) -> str:
+    """
+    Returns the md5 hash of a config used to name its experiment directory
+    """
+    return hashlib.md5(json.dumps(config_json).encode('utf-8')).hexdigest()
+
+def initialise_optimiser(optimiser_cfg: EasyDict, model: torch.nn.Module)\
+        -> torch.optim.Optimizer:
+    """
+    Returns the configured optimiser for the model's parameters
+    """
+    if optimiser_cfg.type in ['adam', 'Adam']:
+        optimiser = torch.optim.Adam(
+            model.parameters(),
+            **optimiser_cfg.args
+        )
+    elif optimiser_cfg.type in ['sgd', 'SGD']:
+        optimiser = torch.optim.SGD(
+            model.parameters(),
+            **optimiser_cfg.args
+        )
+    else:
+        raise NotImplementedError(optimiser_cfg.type)
+
+    return optimiser
+
 def initialise_training_network(config_json: EasyDict, train_path: Path) -> ModelTrainer:
     """
     Sets up the network and training configurations
     Returns initialised training framework class
     """
+    # Placeholders are filled after hashing so the experiment doesn't change
+    resolve_dataset_statistics(config_json)
 
     if config_json.dataset.type == "Kitti":
         datasets = get_kitti_dataset(config_json.dataset)
@@ -41,44 +70,46 @@ def initialise_training_network(config_json: EasyDict, train_path: Path) -> Mode
 
     loss_fns = get_loss_function(config_json.loss_functions)
 
-    if config_json.optimiser.type in ['adam', 'Adam']:
-        optimiser = torch.optim.Adam(
-            model.parameters(),
-            **config_json.optimiser.args
-        )
-    elif config_json.optimiser.type in ['sgd', 'SGD']:
-        optimiser = torch.optim.SGD(
-            model.parameters(),
-            **config_json.optimiser.args
-        )
-    else:
-        raise NotImplementedError(config_json.optimiser.type)
+    optimiser = initialise_optimiser(config_json.optimiser, model)
 
     trainer = ModelTrainer(
         model=model, optimizer=optimiser, loss_fn=loss_fns,
         dataloaders=datasets, lr_cfg=config_json.lr_scheduler,
-        basepath=train_path, logger_cfg=config_json.logger_cfg)
+        basepath=train_path, logger_cfg=config_json.logger_cfg,
+        feature_cache_cfg=config_json.get('feature_cache', None),
+        checkpoint_cfg=config_json.get('checkpoint_cfg', None),
+        resolution_cfg=config_json.get('resolution_schedule', None),
+        target_metrics=config_json.get('target_metrics', None),
+        validation_cfg=config_json.get('validation_cfg', None),
+        max_depth=get_max_depth(config_json.dataset))
 
     return trainer
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', default='configs/MonoSFD_cs.json')
-    parser.add_argument('-e', '--epochs', default=0)
+    parser.add_argument('-e', '--epochs', type=int, default=0,
+                        help='Train for this many epochs and exit instead of the menu')
+    parser.add_argument('--compile', nargs='?', const='default', default=None,
+                        help='Run the model with torch.compile, optionally giving the compile mode')
     args = parser.parse_args()
 
     with open(args.config) as f:
         cfg = EasyDict(json.load(f))
 
-    encoding = hashlib.md5(json.dumps(cfg).encode('utf-8'))
-    training_path = Path.cwd() / "torch_models" / str(encoding.hexdigest())
+    encoding = experiment_hash(cfg)
+    training_path = Path.cwd() / "torch_models" / encoding
     if not os.path.isdir(training_path):
         os.makedirs(training_path)
 
-    print("Experiment # ", encoding.hexdigest())
+    print("Experiment # ", encoding)
 
     copy(args.config, training_path / os.path.basename(args.config))
 
+    # Set after hashing, compiling doesn't change the experiment
+    if args.compile is not None:
+        cfg.model.compile = {"mode": args.compile}
+
     TRAINER = initialise_training_network(cfg, training_path)
 
     if args.epochs > 0:
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""
+Probes the largest batch size and resolution of a config that fit in GPU memory
+"""
+
+__author__ = "Bryce Ferenczi"
+__email__ = "bryce.ferenczi@monashmotorsport.com"
+
+import json
+import argparse
+from typing import Dict, List, Tuple
+
+from easydict import EasyDict
+
+import torch
+
+from nnet_training.nnet_models import get_model
+from nnet_training.loss_functions import get_loss_function
+from nnet_training.training_executor import initialise_optimiser
+from nnet_training.utilities.model_trainer import calculate_losses
+
+N_CLASSES = 19
+
+def scaled_size(output_size: List[int], scale: float) -> List[int]:
+    """
+    Same rounding to a multiple of 32 the datasets use for rand_scale
+    """
+    return [int(scale * x / 32.0) * 32 for x in output_size]
+
+def worst_case_scale(config: EasyDict) -> float:
+    """
+    Largest scale the training dataloader will produce relative to output_size,
+    random crops are taken after scaling so they reduce the final size.
+    """
+    augmentations = config.dataset.augmentations
+    scale = max(augmentations.rand_scale) if 'rand_scale' in augmentations else 1.0
+    if 'crop_fraction' in augmentations:
+        scale /= augmentations.crop_fraction
+    return scale
+
+class MemoryProbe(object):
+    """
+    Builds the model, losses and optimiser of a config and measures the peak
+    memory of a training step with synthetic data at a given batch and resolution
+    """
+    def __init__(self, config: EasyDict):
+        if not torch.cuda.is_available():
+            raise EnvironmentError("Memory probing requires a CUDA device")
+
+        self._device = torch.device("cuda")
+        self._model = get_model(config.model).to(self._device)
+        self._model.train()
+        self._loss_fns = get_loss_function(config.loss_functions)
+        self._optimiser = initialise_optimiser(config.optimiser, self._model)
+
+    def _synthetic_batch(self, batch_size: int, size: List[int]) -> Dict[str, torch.Tensor]:
+        dim_w, dim_h = size
+        batch = {
+            'l_img' : torch.rand(batch_size, 3, dim_h, dim_w, device=self._device),
+            'flow_gt' : None
+        }
+        if 'flow' in self._loss_fns:
+            batch['l_seq'] = torch.rand_like(batch['l_img'])
+        if 'segmentation' in self._loss_fns:
+            batch['seg'] = torch.randint(0, N_CLASSES, (batch_size, dim_h, dim_w),
+                                         device=self._device)
+        if 'depth' in self._loss_fns:
+            batch['l_disp'] = 80. * torch.rand(batch_size, dim_h, dim_w, device=self._device)
+
+        for key in ['l_img', 'l_seq']:
+            if key in batch:
+                batch[key] = batch[key].contiguous(memory_format=self._model.memory_format)
+
+        return batch
+
+    def __call__(self, batch_size: int, size: List[int], n_steps=2) -> int:
+        """
+        Returns the peak memory in bytes of n_steps training steps, None if OOM.\n
+        Two steps are used so the optimiser state is also allocated.
+        """
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(self._device)
+
+        try:
+            for _ in range(n_steps):
+                batch_data = self._synthetic_batch(batch_size, size)
+                forward = self._model(**batch_data)
+                losses = calculate_losses(self._loss_fns, forward, batch_data)
+
+                self._optimiser.zero_grad()
+                sum(losses.values()).backward()
+                self._optimiser.step()
+
+                del batch_data, forward, losses
+
+            peak_memory = torch.cuda.max_memory_allocated(self._device)
+        except RuntimeError as err:
+            if 'out of memory' not in str(err):
+                raise err
+            peak_memory = None
+
+        self._optimiser.zero_grad()
+        torch.cuda.empty_cache()
+
+        return peak_memory
+
+def find_max_batch(probe: MemoryProbe, size: List[int], budget: int,
+                   max_batch=256) -> Tuple[int, int]:
+    """
+    Largest batch size (and its peak memory) that fits in the budget at
+    a given resolution, doubling until it fails then bisecting
+    """
+    fits = lambda mem: mem is not None and mem <= budget
+
+    best = (0, None)
+    low, high = 0, None
+    batch_size = 1
+    while high is None and batch_size <= max_batch:
+        peak_memory = probe(batch_size, size)
+        print(f"Batch {batch_size:3d} @ {size}: "
+              f"{'OOM' if peak_memory is None else f'{peak_memory / 2**30:.2f} GiB'}")
+        if fits(peak_memory):
+            best = (batch_size, peak_memory)
+            low, batch_size = batch_size, batch_size * 2
+        else:
+            high = batch_size
+
+    while high is not None and high - low > 1:
+        batch_size = (low + high) // 2
+        peak_memory = probe(batch_size, size)
+        print(f"Batch {batch_size:3d} @ {size}: "
+              f"{'OOM' if peak_memory is None else f'{peak_memory / 2**30:.2f} GiB'}")
+        if fits(peak_memory):
+            best = (batch_size, peak_memory)
+            low = batch_size
+        else:
+            high = batch_size
+
+    return best
+
+def find_max_scale(probe: MemoryProbe, config: EasyDict, batch_size: int, budget: int,
+                   step=0.125, max_scale=4.0) -> float:
+    """
+    Largest multiple of output_size at a fixed batch size where the
+    worst case rand_scale/crop resolution still fits in the budget
+    """
+    output_size = config.dataset.augmentations.output_size
+    headroom = worst_case_scale(config)
+
+    best = 0.
+    scale = step
+    while scale <= max_scale:
+        size = scaled_size(output_size, scale * headroom)
+        peak_memory = probe(batch_size, size)
+        print(f"Scale {scale:.3f} -> worst case {size}: "
+              f"{'OOM' if peak_memory is None else f'{peak_memory / 2**30:.2f} GiB'}")
+        if peak_memory is None or peak_memory > budget:
+            break
+        best = scale
+        scale += step
+
+    return best
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument('-c', '--config', default='configs/HRNetV2_kt.json')
+    PARSER.add_argument('-b', '--budget', type=float, default=None,
+                        help='Memory budget in GiB, defaults to 90%% of the device')
+    PARSER.add_argument('-r', '--resolution', action='store_true',
+                        help='Find the largest output_size at the configured batch size '
+                             'instead of the largest batch size at the configured output_size')
+    PARSER.add_argument('-w', '--write', action='store_true',
+                        help='Write the result back into the config file')
+    ARGS = PARSER.parse_args()
+
+    with open(ARGS.config) as f:
+        CONFIG = EasyDict(json.load(f))
+
+    if ARGS.budget is None:
+        BUDGET = int(0.9 * torch.cuda.get_device_properties(0).total_memory)
+    else:
+        BUDGET = int(ARGS.budget * 2**30)
+
+    PROBE = MemoryProbe(CONFIG)
+    OUTPUT_SIZE = CONFIG.dataset.augmentations.output_size
+    HEADROOM = worst_case_scale(CONFIG)
+    print(f"Budget: {BUDGET / 2**30:.2f} GiB, worst case scale: {HEADROOM:.3f}")
+
+    if ARGS.resolution:
+        SCALE = find_max_scale(PROBE, CONFIG, CONFIG.dataset.batch_size, BUDGET)
+        if SCALE == 0:
+            raise RuntimeError(f"Batch size {CONFIG.dataset.batch_size} "
+                               "doesn't fit at any resolution")
+        CONFIG.dataset.augmentations.output_size = scaled_size(OUTPUT_SIZE, SCALE)
+        print(f"\nLargest output_size at batch {CONFIG.dataset.batch_size}: "
+              f"{CONFIG.dataset.augmentations.output_size}")
+    else:
+        BATCH, PEAK = find_max_batch(PROBE, scaled_size(OUTPUT_SIZE, HEADROOM), BUDGET)
+        if BATCH == 0:
+            raise RuntimeError(f"Batch size 1 doesn't fit at {OUTPUT_SIZE}")
+        CONFIG.dataset.batch_size = BATCH
+        print(f"\nLargest batch size at {OUTPUT_SIZE}: {BATCH}, "
+              f"peak memory: {PEAK / 2**30:.2f} GiB")
+
+    if ARGS.write:
+        with open(ARGS.config, 'w') as f:
+            json.dump(CONFIG, f, indent=4)
+        print(f"Written to {ARGS.config}")
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""
+Background checkpoint writer so training doesn't wait on serialisation and disk
+"""
+
+__author__ = "Bryce Ferenczi"
+__email__ = "bryce.ferenczi@monashmotorsport.com"
+
+import os
+import copy
+import queue
+import shutil
+import threading
+from pathlib import Path
+from typing import Any, Dict, List
+
+import torch
+
+__all__ = ['AsyncCheckpointWriter']
+
+def snapshot_state(state: Any) -> Any:
+    """
+    Copies a (nested) state dict to host memory so training can keep
+    modifying the original while the copy is being written
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot_state(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(value) for value in state)
+    return copy.deepcopy(state)
+
+def _atomic_link(src: Path, dst: Path) -> None:
+    """
+    Points dst at the same file as src, falls back to a copy if
+    the filesystem doesn't support hard links
+    """
+    tmp_path = dst.with_name(dst.name + ".tmp")
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+class AsyncCheckpointWriter(object):
+    """
+    Writes checkpoints from a background thread. Each checkpoint is written once to a
+    temporary file and renamed into place so a crash never leaves a partial file, any
+    extra paths (e.g. per-objective bests) are hard links to it. As the primary file is
+    replaced by a rename rather than overwritten, older links keep their contents.\n
+    At most max_pending snapshots wait in host memory, further saves block until one
+    has been written. Errors in the writer are raised on the next save or flush.
+    """
+    def __init__(self, max_pending=1):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                state, path, links = item
+                tmp_path = path.with_name(path.name + ".tmp")
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+                for link in links:
+                    _atomic_link(path, link)
+            except Exception as err:
+                self._error = err
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            err, self._error = self._error, None
+            raise err
+
+    def save(self, state: Dict[str, Any], path: Path, links: List[Path] = None) -> None:
+        """
+        Snapshots the state to host memory and queues it to be written to path,
+        returns as soon as the snapshot is taken
+        """
+        self._raise_error()
+        if not self._thread.is_alive():
+            raise RuntimeError("Checkpoint writer has been closed")
+        self._queue.put((snapshot_state(state), Path(path),
+                         [Path(link) for link in links] if links else []))
+
+    def flush(self) -> None:
+        """
+        Blocks until all queued checkpoints have been written
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        """
+        Writes any remaining checkpoints and stops the writer thread
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
@@ -15,16 +15,17 @@ from typing import Dict
 
 import torch
 import torchvision
-from torch.utils.data import RandomSampler
 from PIL import Image
 
 import numpy as np
 
-from nnet_training.utilities.custom_batch_sampler import BatchSamplerRandScale
+from nnet_training.utilities.custom_batch_sampler import BatchSamplerRandScale, get_training_sampler
 
 __all__ = ['CityScapesDataset', 'get_cityscapse_dataset']
 
 IMG_EXT = '.png'
+# Time between a frame and the next frame of the sequence, recorded at 17Hz
+SEQ_DT = 1. / 17.
 
 class CityScapesDataset(torch.utils.data.Dataset):
     """
@@ -44,7 +45,8 @@ class CityScapesDataset(torch.utils.data.Dataset):
         @param crop_fraction determines if the image is randomly cropped to by a fraction
             e.g. 2 results in width/2 by height/2 random crop of original image\n
         @param rand_rotation randomly rotates an image a maximum number of degrees.\n
-        @param rand_brightness, the maximum random increase or decrease as a percentage.
+        @param rand_brightness, the maximum random increase or decrease as a percentage.\n
+        @param rand_flip randomly mirrors the image horizontally, default True.
         '''
         super(CityScapesDataset, self).__init__()
         l_img_key = None
@@ -97,7 +99,7 @@ class CityScapesDataset(torch.utils.data.Dataset):
             self.img_normalize = torchvision.transforms.Normalize(
                 kwargs['img_normalize']['mean'], kwargs['img_normalize']['std'])
 
-        self.rand_flip = True
+        self.rand_flip = kwargs['rand_flip'] if 'rand_flip' in kwargs else True
 
         # valid_classes = [7, 8, 11, 12, 13, 17, 19, 20, 21, 22,
         #                       23, 24, 25, 26, 27, 28, 31, 32, 33]
@@ -242,22 +244,33 @@ class CityScapesDataset(torch.utils.data.Dataset):
         if hasattr(self, 'r_seq'):
             epoch_data["r_seq"] = Image.open(self.r_seq[idx]).convert('RGB')
 
-        self._sync_transform(epoch_data)
+        native_size = epoch_data["l_img"].size
+        geometry = self._sync_transform(epoch_data)
 
         if hasattr(self, 'cam'):
             epoch_data["cam"] = self.json_to_intrinsics(self.cam[idx])
+            self._transform_intrinsics(epoch_data["cam"], native_size, geometry)
 
-        # if hasattr(self, 'pose'):
-        #     epoch_data["pose"] = self.json_to_pose(self.pose[idx])
+        if hasattr(self, 'pose'):
+            epoch_data["pose"] = self.json_to_pose(self.pose[idx])
+            if geometry['flip']:
+                mirror = np.diag([-1., 1., 1., 1.]).astype(np.float32)
+                epoch_data["pose"] = mirror @ epoch_data["pose"] @ mirror
 
         return epoch_data
 
     def _sync_transform(self, epoch_data):
+        """
+        Augments and converts the sample to tensors, returns the geometric
+        transforms applied (flip and crop offset) for the camera and pose
+        """
         scale_func = lambda x: int(self.scale_factor * x / 32.0) * 32
         self.output_shape = [scale_func(x) for x in self.base_size]
+        geometry = {'flip': False, 'crop': (0, 0)}
 
         # random mirror
         if random.random() < 0.5 and self.rand_flip:
+            geometry['flip'] = True
             for key, data in epoch_data.items():
                 epoch_data[key] = data.transpose(Image.FLIP_LEFT_RIGHT)
 
@@ -301,6 +314,9 @@ class CityScapesDataset(torch.utils.data.Dataset):
                     epoch_data[key] = data[crop_y:crop_y+crop_h, crop_x:crop_x+crop_w]
                 else:
                     epoch_data[key] = data[:, crop_y:crop_y+crop_h, crop_x:crop_x+crop_w]
+            geometry['crop'] = (crop_x, crop_y)
+
+        return geometry
 
     def _class_to_index(self, seg):
         values = np.unique(seg)
@@ -350,8 +366,54 @@ class CityScapesDataset(torch.utils.data.Dataset):
 
         return {"K":K, "inv_K":np.linalg.pinv(K), "baseline_T":stereo_t}
 
-    def json_to_pose(self, json_path):
-        raise NotImplementedError
+    def _transform_intrinsics(self, camera, native_size, geometry):
+        """
+        Applies the flip, resize and crop of the images to the intrinsics in place
+        """
+        native_w, native_h = native_size
+        out_w, out_h = self.output_shape
+        K = camera["K"]
+        if geometry['flip']:
+            K[0, 2] = native_w - 1 - K[0, 2]
+        K[0, :3] *= out_w / native_w
+        K[1, :3] *= out_h / native_h
+        K[0, 2] -= geometry['crop'][0]
+        K[1, 2] -= geometry['crop'][1]
+        camera["inv_K"] = np.linalg.pinv(K)
+
+    @staticmethod
+    def json_to_pose(json_path):
+        """
+        Relative pose from the camera at this frame to the camera at the next sequence
+        frame (SEQ_DT later), from the vehicle speed and yaw rate assuming constant
+        speed and turn rate. The returned 4x4 maps points from this camera to the next.
+        """
+        with open(json_path) as json_file:
+            json_data = json.load(json_file)
+
+        distance = json_data["speed"] * SEQ_DT
+        # yawRate is given in degrees per second like gpsHeading
+        yaw = np.deg2rad(json_data["yawRate"]) * SEQ_DT
+
+        # Displacement along the arc in the vehicle frame (x forward, y left)
+        if abs(yaw) > 1e-6:
+            forward = distance * np.sin(yaw) / yaw
+            left = distance * (1. - np.cos(yaw)) / yaw
+        else:
+            forward, left = distance, 0.
+
+        # Camera motion in the camera frame (x right, y down, z forward), turning left is a
+        # negative rotation about the downward y axis
+        rotation = np.array([[np.cos(yaw), 0., -np.sin(yaw)],
+                             [0., 1., 0.],
+                             [np.sin(yaw), 0., np.cos(yaw)]], dtype=np.float32)
+        translation = np.array([-left, 0., forward], dtype=np.float32)
+
+        # Inverse of the camera motion takes points into the next camera frame
+        pose = np.eye(4, dtype=np.float32)
+        pose[:3, :3] = rotation.T
+        pose[:3, 3] = -rotation.T @ translation
+        return pose
 
 def get_cityscapse_dataset(dataset_config) -> Dict[str, torch.utils.data.DataLoader]:
     """
@@ -377,6 +439,8 @@ def get_cityscapse_dataset(dataset_config) -> Dict[str, torch.utils.data.DataLoa
         aux_aug['img_normalize'] = dataset_config.augmentations.img_normalize
     if 'disparity_out' in dataset_config.augmentations:
         aux_aug['disparity_out'] = dataset_config.augmentations.disparity_out
+    if 'rand_flip' in dataset_config.augmentations:
+        aux_aug['rand_flip'] = dataset_config.augmentations.rand_flip
 
     datasets = {
         'Training'   : CityScapesDataset(training_dirs, **dataset_config.augmentations),
@@ -399,7 +463,7 @@ def get_cityscapse_dataset(dataset_config) -> Dict[str, torch.utils.data.DataLoa
         dataloaders['Training'] = torch.utils.data.DataLoader(
             datasets["Training"], num_workers=n_workers, pin_memory=True,
             batch_sampler=BatchSamplerRandScale(
-                sampler=RandomSampler(datasets["Training"]),
+                sampler=get_training_sampler(datasets["Training"], dataset_config),
                 batch_size=dataset_config.batch_size,
                 drop_last=dataset_config.drop_last,
                 scale_range=dataset_config.augmentations.rand_scale)
@@ -410,7 +474,7 @@ def get_cityscapse_dataset(dataset_config) -> Dict[str, torch.utils.data.DataLoa
         dataloaders['Training'] = torch.utils.data.DataLoader(
             datasets["Training"],
             batch_size=dataset_config.batch_size,
-            shuffle=dataset_config.shuffle,
+            sampler=get_training_sampler(datasets["Training"], dataset_config),
             num_workers=n_workers,
             drop_last=dataset_config.drop_last,
             pin_memory=True
@@ -1,12 +1,183 @@
 r"""
-Extension to pytorch batch sampler to also yield a random scalar between a given range.
+Extension to pytorch batch sampler to also yield a random scalar between a given range,
+a sampler whose epoch permutation can be saved and resumed part way through and a
+sampler that draws samples in proportion to their recent loss.
 """
 
 import random
+from collections import deque
+from typing import Any, Dict, List
 
+import torch
 from torch.utils.data import Sampler
 from torch.utils.data import SequentialSampler
-from torch._six import int_classes as _int_classes
+
+class ResumableSampler(Sampler):
+    r"""Random (or sequential) sampler that can save the permutation of the
+        current epoch and resume from a given number of consumed samples.
+
+    Args:
+        data_source (Dataset): dataset to sample from
+        shuffle (bool): If ``False`` samples are drawn in order
+        seed (int): Seed of the sampler's own generator, random if ``None``
+
+    Example:
+        >>> sampler = ResumableSampler(range(6))
+        >>> it = iter(sampler); consumed = [next(it), next(it)]
+        >>> state = sampler.state_dict(n_consumed=2)
+        >>> resumed = ResumableSampler(range(6)); resumed.load_state_dict(state)
+        >>> consumed + list(resumed) == list(sampler)  # same epoch order
+    """
+
+    def __init__(self, data_source, shuffle=True, seed=None):
+        super().__init__(data_source)
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.generator = torch.Generator()
+        if seed is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        self.generator.manual_seed(seed)
+
+        self._perm = None
+        self._start = 0
+
+    def _epoch_order(self) -> torch.Tensor:
+        """
+        Order of the sample indices of a new epoch
+        """
+        if self.shuffle:
+            return torch.randperm(len(self.data_source), generator=self.generator)
+        return torch.arange(len(self.data_source))
+
+    def __iter__(self):
+        if self._perm is None or self._start == 0:
+            self._perm = self._epoch_order()
+
+        start, self._start = self._start, 0
+        yield from self._perm[start:].tolist()
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def state_dict(self, n_consumed: int) -> Dict[str, Any]:
+        """
+        State to resume the current epoch after n_consumed samples
+        """
+        return {'perm': self._perm, 'start': n_consumed,
+                'generator': self.generator.get_state()}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """
+        The next iteration continues the saved epoch from its resume point
+        """
+        self._perm = state_dict['perm']
+        self._start = state_dict['start']
+        self.generator.set_state(state_dict['generator'])
+
+class LossImportanceSampler(ResumableSampler):
+    r"""Draws each epoch's samples with replacement in proportion to an exponentially
+        decayed table of each sample's recent loss. Losses are reported back in the
+        order batches are consumed with :meth:`next_batch` and :meth:`update_losses`,
+        so it can be wrapped by any batch sampler that keeps the sampler order.
+        :meth:`importance_weight` gives each sample's weight w_i = 1/(N*p_i), the
+        batch loss mean_i(w_i * l_i) keeps the expected gradient equal to that of
+        uniform sampling.
+
+    Args:
+        data_source (Dataset): dataset to sample from
+        decay (float): Weight of the previous loss in the table on each update
+        alpha (float): Exponent of the loss, 0 is uniform and 1 is proportional
+        uniform_mix (float): Fraction of the distribution that is uniform so every
+            sample can still be drawn, this also bounds the importance weight
+        seed (int): Seed of the sampler's own generator, random if ``None``
+    """
+
+    def __init__(self, data_source, decay=0.9, alpha=1.0, uniform_mix=0.2, seed=None):
+        super().__init__(data_source, shuffle=True, seed=seed)
+        assert 0. <= decay < 1. and alpha >= 0. and 0. < uniform_mix <= 1.
+        self.decay = decay
+        self.alpha = alpha
+        self.uniform_mix = uniform_mix
+
+        self._loss_table = torch.zeros(len(data_source), dtype=torch.float64)
+        self._seen = torch.zeros(len(data_source), dtype=torch.bool)
+        self._probs = torch.full((len(data_source),), 1. / len(data_source),
+                                 dtype=torch.float64)
+        self._pending = deque()
+
+    def _sample_probabilities(self) -> torch.Tensor:
+        if not self._seen.any():
+            return torch.full_like(self._loss_table, 1. / self._loss_table.shape[0])
+
+        # Unseen samples get the largest priority so they're visited early
+        priority = self._loss_table.clone()
+        priority[~self._seen] = priority[self._seen].max()
+        priority = priority.clamp(min=0.).pow(self.alpha)
+        if priority.sum() <= 0:
+            priority = torch.ones_like(priority)
+
+        return (1. - self.uniform_mix) * priority / priority.sum() + \
+            self.uniform_mix / priority.shape[0]
+
+    def _epoch_order(self) -> torch.Tensor:
+        self._probs = self._sample_probabilities()
+        return torch.multinomial(self._probs, self._probs.shape[0],
+                                 replacement=True, generator=self.generator)
+
+    def __iter__(self):
+        self._pending.clear()
+        for idx in super().__iter__():
+            self._pending.append(idx)
+            yield idx
+
+    def next_batch(self, batch_size: int) -> List[int]:
+        """
+        Indices of the next batch_size samples consumed by training
+        """
+        return [self._pending.popleft() for _ in range(min(batch_size, len(self._pending)))]
+
+    def importance_weight(self, indices: List[int]) -> torch.Tensor:
+        """
+        Weight 1/(N*p) of each of the indices, the mean of each sample's loss scaled
+        by its weight corrects for the non-uniform sampling probability
+        """
+        probs = self._probs[torch.as_tensor(indices, dtype=torch.long)]
+        return 1. / (self._probs.shape[0] * probs)
+
+    def update_losses(self, indices: List[int], losses: torch.Tensor) -> None:
+        """
+        Folds the (unweighted) loss of each sample of the batch of indices into the table
+        """
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        losses = torch.as_tensor(losses, dtype=self._loss_table.dtype).cpu().reshape(-1)
+        seen = self._seen[indices]
+        self._loss_table[indices] = torch.where(
+            seen, self.decay * self._loss_table[indices] + (1. - self.decay) * losses, losses)
+        self._seen[indices] = True
+
+    def state_dict(self, n_consumed: int) -> Dict[str, Any]:
+        state_dict = super().state_dict(n_consumed)
+        state_dict.update({'loss_table': self._loss_table, 'seen': self._seen,
+                           'probs': self._probs})
+        return state_dict
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        super().load_state_dict(state_dict)
+        self._loss_table = state_dict['loss_table']
+        self._seen = state_dict['seen']
+        self._probs = state_dict['probs']
+
+def get_training_sampler(dataset, dataset_config) -> ResumableSampler:
+    """
+    Returns the sampler given by dataset_config.sampler, defaults
+    to a ResumableSampler that follows dataset_config.shuffle
+    """
+    sampler_cfg = dataset_config.get('sampler', None)
+    if sampler_cfg is None:
+        return ResumableSampler(dataset, shuffle=dataset_config.shuffle)
+    if sampler_cfg['type'] == 'LossImportance':
+        return LossImportanceSampler(dataset, **sampler_cfg.get('args', {}))
+    raise NotImplementedError(sampler_cfg['type'])
 
 class BatchSamplerRandScale(Sampler):
     r"""Extending the Batch Sampler to also pass a scale factor for
@@ -34,7 +205,7 @@ class BatchSamplerRandScale(Sampler):
         # is one way for an object to be an iterable, we don't do an `isinstance`
         # check here.
         super().__init__(None)
-        if not isinstance(batch_size, _int_classes) or isinstance(batch_size, bool) or \
+        if not isinstance(batch_size, int) or isinstance(batch_size, bool) or \
                 batch_size <= 0:
             raise ValueError("batch_size should be a positive integer value, "
                              "but got batch_size={}".format(batch_size))
@@ -47,17 +218,27 @@ class BatchSamplerRandScale(Sampler):
         assert len(scale_range) == 2
         self.scale_range = scale_range
 
+        self._rng = random.Random()
+        self._epoch_rng_state = self._rng.getstate()
+        self._skip_batches = 0
+
     def __iter__(self):
+        # Rewind the scale factors of batches already consumed when resuming
+        self._epoch_rng_state = self._rng.getstate()
+        for _ in range(self._skip_batches):
+            self._rng.uniform(*self.scale_range)
+        self._skip_batches = 0
+
         batch = []
         for idx in self.sampler:
             batch.append(idx)
             if len(batch) == self.batch_size:
-                scale_factor = random.uniform(*self.scale_range)
+                scale_factor = self._rng.uniform(*self.scale_range)
                 batch = [(x, scale_factor) for x in batch]
                 yield batch
                 batch = []
         if len(batch) > 0 and not self.drop_last:
-            scale_factor = random.uniform(*self.scale_range)
+            scale_factor = self._rng.uniform(*self.scale_range)
             batch = [(x, scale_factor) for x in batch]
             yield batch
 
@@ -66,6 +247,21 @@ class BatchSamplerRandScale(Sampler):
             return len(self.sampler) // self.batch_size
         return (len(self.sampler) + self.batch_size - 1) // self.batch_size
 
+    def state_dict(self, n_batches: int) -> Dict[str, Any]:
+        """
+        State to resume the current epoch after n_batches, requires a resumable sampler
+        """
+        return {'sampler': self.sampler.state_dict(n_batches * self.batch_size),
+                'rng': self._epoch_rng_state, 'n_batches': n_batches}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """
+        The next iteration continues the saved epoch from its resume point
+        """
+        self.sampler.load_state_dict(state_dict['sampler'])
+        self._rng.setstate(state_dict['rng'])
+        self._skip_batches = state_dict['n_batches']
+
 if __name__ == "__main__":
     test = list(BatchSamplerRandScale(SequentialSampler(range(10)),
         batch_size=3, drop_last=False, scale_range=[0.5, 1]))
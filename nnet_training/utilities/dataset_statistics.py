@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+"""
+Single pass statistics of a dataset split, computed over a process pool and cached by
+the hash of the dataset configuration:
+    per-channel image mean/std, class pixel histogram, depth (or disparity with
+    disparity_out) and flow magnitude histograms.\n
+Configs can then use "dataset" in place of values derived from them, e.g.
+"img_normalize" : "dataset", a segmentation loss's "class_weights" : "dataset"
+or the depth clip of the metrics and visualisation "max_depth" : "dataset".
+"""
+
+__author__ = "Bryce Ferenczi"
+__email__ = "bryce.ferenczi@monashmotorsport.com"
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import multiprocessing
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+from easydict import EasyDict
+
+from nnet_training.utilities.kitti_dataset import Kitti2015Dataset, id_vec_generator
+from nnet_training.utilities.cityscapes_dataset import CityScapesDataset
+
+__all__ = ['MAX_DEPTH', 'get_dataset_statistics', 'resolve_dataset_statistics', 'get_max_depth']
+
+STATS_CACHE_DIR = Path.cwd() / "torch_models" / "dataset_stats"
+
+N_CLASSES = 19
+IGNORE_INDEX = 255
+DEPTH_EDGES = np.linspace(0., 200., 401)
+FLOW_EDGES = np.linspace(0., 512., 513)
+
+# Depth clip without dataset.max_depth, "dataset" uses this percentile of the depth histogram
+MAX_DEPTH = 80.
+MAX_DEPTH_PERCENTILE = 'p99.9'
+
+# Dataset of each pool worker, built once by _init_worker
+_DATASET = None
+
+def _dataset_key(dataset_config: EasyDict, split: str) -> str:
+    """
+    Hash of everything that changes the samples of a split (not augmentations)
+    """
+    key_cfg = {
+        'split': split, 'type': dataset_config.type, 'rootdir': dataset_config.rootdir,
+        'output_size': dataset_config.augmentations.output_size,
+        'disparity_out': dataset_config.augmentations.get('disparity_out', None)
+    }
+    for key in ['objectives', 'train_ratio', 'train_subdirs', 'val_subdirs']:
+        if key in dataset_config:
+            key_cfg[key] = dataset_config[key]
+    return hashlib.md5(json.dumps(key_cfg, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _statistics_dataset(dataset_config: EasyDict, split: str):
+    """
+    Dataset of a split at output_size without any augmentation or normalisation
+    """
+    aux_aug = {'rand_flip': False}
+    if 'disparity_out' in dataset_config.augmentations:
+        aux_aug['disparity_out'] = dataset_config.augmentations.disparity_out
+
+    if dataset_config.type == "Kitti":
+        seg_dir = os.path.join(dataset_config.rootdir, "semantic")
+        train_ids, val_ids = id_vec_generator(dataset_config.train_ratio, seg_dir)
+        return Kitti2015Dataset(
+            dataset_config.rootdir, dataset_config.objectives,
+            output_size=dataset_config.augmentations.output_size,
+            id_vector=train_ids if split == 'Training' else val_ids, **aux_aug)
+
+    if dataset_config.type == "Cityscapes":
+        subdirs = dataset_config.train_subdirs if split == 'Training' \
+            else dataset_config.val_subdirs
+        directories = {str(key): dataset_config.rootdir + subdirs[str(key)] for key in subdirs}
+        return CityScapesDataset(
+            directories, output_size=dataset_config.augmentations.output_size, **aux_aug)
+
+    raise NotImplementedError(dataset_config.type)
+
+def _init_worker(dataset_config: EasyDict, split: str):
+    global _DATASET
+    _DATASET = _statistics_dataset(dataset_config, split)
+
+def _accumulate(indices: List[int]) -> Dict[str, np.ndarray]:
+    """
+    Sums of a chunk of samples, the sums of all chunks give the statistics
+    """
+    sums = {
+        'n_samples': np.zeros(1), 'n_pixels': np.zeros(1),
+        'img_sum': np.zeros(3), 'img_sq_sum': np.zeros(3),
+        'class_pixels': np.zeros(N_CLASSES), 'seg_pixels': np.zeros(1),
+        'depth_hist': np.zeros(DEPTH_EDGES.shape[0] - 1),
+        'flow_hist': np.zeros(FLOW_EDGES.shape[0] - 1)
+    }
+
+    for idx in indices:
+        sample = _DATASET[idx]
+        sums['n_samples'] += 1
+
+        img = sample['l_img'].numpy().reshape(3, -1).astype(np.float64)
+        sums['n_pixels'] += img.shape[1]
+        sums['img_sum'] += img.sum(axis=1)
+        sums['img_sq_sum'] += np.square(img).sum(axis=1)
+
+        if 'seg' in sample:
+            seg = sample['seg'].numpy().ravel()
+            sums['seg_pixels'] += seg.shape[0]
+            seg = seg[(seg >= 0) & (seg != IGNORE_INDEX)]
+            sums['class_pixels'] += np.bincount(seg, minlength=N_CLASSES)[:N_CLASSES]
+
+        if 'l_disp' in sample:
+            depth = sample['l_disp'].numpy()
+            sums['depth_hist'] += np.histogram(depth[depth > 0], bins=DEPTH_EDGES)[0]
+
+        if 'flow' in sample:
+            magnitude = np.linalg.norm(sample['flow'].numpy(), axis=0)
+            if 'flow_mask' in sample:
+                magnitude = magnitude[sample['flow_mask'].numpy()[0] > 0]
+            sums['flow_hist'] += np.histogram(magnitude, bins=FLOW_EDGES)[0]
+
+    return sums
+
+def _histogram_percentiles(hist: np.ndarray, edges: np.ndarray,
+                           percentiles=(50, 95, 99, 99.9)) -> Dict[str, float]:
+    """
+    Percentiles interpolated from a histogram, upper bin edge of each
+    """
+    if hist.sum() == 0:
+        return {}
+    cdf = np.cumsum(hist) / hist.sum()
+    return {f"p{pct}": float(edges[1:][np.searchsorted(cdf, pct / 100.)])
+            for pct in percentiles}
+
+def compute_statistics(dataset_config: EasyDict, split='Training',
+                       n_workers: int = None, chunk_size=16) -> Dict[str, Any]:
+    """
+    Streams a split once across a process pool and returns its statistics
+    """
+    n_samples = len(_statistics_dataset(dataset_config, split))
+    n_workers = n_workers if n_workers is not None else multiprocessing.cpu_count()
+    chunks = [list(range(start, min(start + chunk_size, n_samples)))
+              for start in range(0, n_samples, chunk_size)]
+
+    totals = None
+    with multiprocessing.Pool(n_workers, initializer=_init_worker,
+                              initargs=(dataset_config, split)) as pool:
+        for chunk_idx, sums in enumerate(pool.imap_unordered(_accumulate, chunks)):
+            if totals is None:
+                totals = sums
+            else:
+                for key in totals:
+                    totals[key] += sums[key]
+            sys.stdout.write(f'\rComputing {split} Statistics: [{chunk_idx+1:4d}/{len(chunks):4d}]')
+            sys.stdout.flush()
+    sys.stdout.write("\n")
+
+    mean = totals['img_sum'] / totals['n_pixels']
+    std = np.sqrt(totals['img_sq_sum'] / totals['n_pixels'] - np.square(mean))
+
+    statistics = {
+        'n_samples': int(totals['n_samples'][0]),
+        'img_normalize': {'mean': mean.tolist(), 'std': std.tolist()}
+    }
+
+    if totals['class_pixels'].sum() > 0:
+        statistics['class_pixels'] = totals['class_pixels'].astype(np.int64).tolist()
+        # Including ignored pixels, the denominator of the losses' dynamic weights
+        statistics['seg_pixels'] = int(totals['seg_pixels'][0])
+        statistics['class_frequency'] = \
+            (totals['class_pixels'] / totals['class_pixels'].sum()).tolist()
+
+    if totals['depth_hist'].sum() > 0:
+        # l_disp is disparity rather than depth with disparity_out
+        depth_key = 'disparity' if dataset_config.augmentations.get('disparity_out', False) \
+            else 'depth'
+        statistics[depth_key] = {
+            'hist': totals['depth_hist'].astype(np.int64).tolist(),
+            'edges': DEPTH_EDGES.tolist(),
+            'percentiles': _histogram_percentiles(totals['depth_hist'], DEPTH_EDGES)
+        }
+
+    if totals['flow_hist'].sum() > 0:
+        statistics['flow_magnitude'] = {
+            'hist': totals['flow_hist'].astype(np.int64).tolist(),
+            'edges': FLOW_EDGES.tolist(),
+            'percentiles': _histogram_percentiles(totals['flow_hist'], FLOW_EDGES)
+        }
+
+    return statistics
+
+def get_dataset_statistics(dataset_config: EasyDict, split='Training',
+                           n_workers: int = None, recompute=False) -> Dict[str, Any]:
+    """
+    Returns the cached statistics of a split, computing them if they don't exist
+    """
+    cache_path = STATS_CACHE_DIR / f"{_dataset_key(dataset_config, split)}.json"
+    if os.path.isfile(cache_path) and not recompute:
+        with open(cache_path) as json_file:
+            return json.load(json_file)
+
+    statistics = compute_statistics(dataset_config, split, n_workers)
+
+    if not os.path.isdir(STATS_CACHE_DIR):
+        os.makedirs(STATS_CACHE_DIR)
+    with open(cache_path, 'w') as json_file:
+        json.dump(statistics, json_file)
+
+    return statistics
+
+def class_weights(class_pixels: List[int], seg_pixels: int, scale_factor=0.125) -> List[float]:
+    """
+    Same weighting the segmentation losses use for dynamic weights, the frequency
+    of each class is of all segmentation pixels including those ignored
+    """
+    return [scale_factor / (scale_factor + n_pixels / seg_pixels) for n_pixels in class_pixels]
+
+def resolve_dataset_statistics(config: EasyDict) -> EasyDict:
+    """
+    Replaces "dataset" placeholders in the config with the training split's
+    statistics, only computing them if a placeholder is used
+    """
+    augmentations = config.dataset.augmentations
+    if augmentations.get('img_normalize', None) == 'dataset':
+        statistics = get_dataset_statistics(config.dataset)
+        augmentations.img_normalize = EasyDict(statistics['img_normalize'])
+
+    for loss_fn in config.get('loss_functions', []):
+        if loss_fn.get('args', {}).get('class_weights', None) == 'dataset':
+            statistics = get_dataset_statistics(config.dataset)
+            if 'class_frequency' in statistics and 'seg_pixels' not in statistics:
+                # Cached before the total segmentation pixels were recorded
+                statistics = get_dataset_statistics(config.dataset, recompute=True)
+            if 'class_frequency' not in statistics:
+                raise ValueError("Class weights requested but the dataset has no segmentation")
+            loss_fn.args.class_weights = class_weights(
+                statistics['class_pixels'], statistics['seg_pixels'],
+                loss_fn.args.get('scale_factor', 0.125))
+
+    if config.dataset.get('max_depth', None) == 'dataset':
+        statistics = get_dataset_statistics(config.dataset)
+        if augmentations.get('disparity_out', False) or 'depth' not in statistics:
+            raise ValueError("Max depth requested but the dataset has no depth ground truth")
+        config.dataset.max_depth = statistics['depth']['percentiles'][MAX_DEPTH_PERCENTILE]
+
+    return config
+
+def get_max_depth(dataset_config: EasyDict) -> float:
+    """
+    Depth clip of the metrics and visualisation, dataset.max_depth if given
+    """
+    return float(dataset_config.get('max_depth', MAX_DEPTH))
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument('-c', '--config', default='configs/HRNetV2_kt.json')
+    PARSER.add_argument('-s', '--split', default='Training', choices=['Training', 'Validation'])
+    PARSER.add_argument('-w', '--workers', type=int, default=None)
+    PARSER.add_argument('--recompute', action='store_true')
+    ARGS = PARSER.parse_args()
+
+    with open(ARGS.config) as f:
+        CONFIG = EasyDict(json.load(f))
+
+    STATISTICS = get_dataset_statistics(CONFIG.dataset, ARGS.split, ARGS.workers, ARGS.recompute)
+
+    print(f"Samples: {STATISTICS['n_samples']}")
+    print(f"img_normalize: {json.dumps(STATISTICS['img_normalize'])}")
+    if 'class_frequency' in STATISTICS:
+        print("Class frequency: " + ", ".join(f"{freq:.4f}"
+                                              for freq in STATISTICS['class_frequency']))
+    if 'depth' in STATISTICS:
+        print(f"Depth percentiles: {STATISTICS['depth']['percentiles']}")
+    if 'disparity' in STATISTICS:
+        print(f"Disparity percentiles: {STATISTICS['disparity']['percentiles']}")
+    if 'flow_magnitude' in STATISTICS:
+        print(f"Flow magnitude percentiles: {STATISTICS['flow_magnitude']['percentiles']}")
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+Feature cache for training the heads of a model on top of a frozen backbone.
+The backbone is run once over each dataset split and its multi-resolution feature
+pyramid is stored as float16 memory-mapped arrays, the high level features are
+rebuilt from the pyramid by the model since they are just its upsampled concatenation.
+"""
+
+__author__ = "Bryce Ferenczi"
+__email__ = "bryce.ferenczi@monashmotorsport.com"
+
+import os
+import sys
+import json
+import hashlib
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, RandomSampler
+
+from nnet_training.utilities.custom_batch_sampler import BatchSamplerRandScale, ResumableSampler
+
+__all__ = ['FeatureCacheDataset', 'check_fixed_augmentation', 'get_feature_cache_loaders']
+
+CACHE_DTYPE = np.float16
+
+def check_fixed_augmentation(dataloader: DataLoader) -> None:
+    """
+    Cached features are only valid if each image is identical every epoch,
+    raises if the dataloader applies any random augmentation
+    """
+    dataset = dataloader.dataset
+    random_augs = []
+    if getattr(dataset, 'rand_flip', False):
+        random_augs.append('rand_flip')
+    if hasattr(dataset, 'rand_rot'):
+        random_augs.append('rand_rotation')
+    if hasattr(dataset, 'brightness'):
+        random_augs.append('rand_brightness')
+    if hasattr(dataset, 'crop_fraction'):
+        random_augs.append('crop_fraction')
+    if hasattr(dataset, 'scale_range') or \
+            isinstance(dataloader.batch_sampler, BatchSamplerRandScale):
+        random_augs.append('rand_scale')
+
+    if len(random_augs) > 0:
+        raise ValueError(f"Feature cache requires fixed augmentations, disable {random_augs} "
+                         "(set \"rand_flip\": false in the augmentation config)")
+
+def _backbone_fingerprint(backbone: torch.nn.Module) -> str:
+    """
+    Hash of the backbone weights so a cache made with different weights isn't reused
+    """
+    encoding = hashlib.md5()
+    for name, tensor in backbone.state_dict().items():
+        encoding.update(name.encode('utf-8'))
+        encoding.update(tensor.detach().cpu().numpy().tobytes())
+    return encoding.hexdigest()
+
+@torch.no_grad()
+def build_feature_cache(model: torch.nn.Module, dataset: torch.utils.data.Dataset,
+                        cache_dir: Path, img_keys: List[str], batch_size: int,
+                        num_workers: int, memory_format=torch.contiguous_format) -> None:
+    """
+    Runs the backbone over the dataset in order and writes each level
+    of the feature pyramid to cache_dir/{img_key}_{level}.npy
+    """
+    device = next(model.parameters()).device
+    model.backbone.eval()
+
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                        num_workers=num_workers, drop_last=False, pin_memory=True)
+
+    memmaps = {}
+    sample_idx = 0
+    for batch_idx, batch_data in enumerate(loader):
+        for key in img_keys:
+            img = batch_data[key].to(device).contiguous(memory_format=memory_format)
+            _, img_pyr = model.backbone(img)
+
+            if key not in memmaps:
+                memmaps[key] = [np.lib.format.open_memmap(
+                    cache_dir / f"{key}_{level}.npy", mode='w+', dtype=CACHE_DTYPE,
+                    shape=(len(dataset),) + tuple(feats.shape[1:]))
+                                for level, feats in enumerate(img_pyr)]
+
+            for level, feats in enumerate(img_pyr):
+                memmaps[key][level][sample_idx:sample_idx + img.shape[0]] = \
+                    feats.cpu().numpy().astype(CACHE_DTYPE)
+
+        sample_idx += batch_data[img_keys[0]].shape[0]
+
+        sys.stdout.write(f'\rCaching Features: [{batch_idx+1:4d}/{len(loader):4d}]')
+        sys.stdout.flush()
+
+    for level_maps in memmaps.values():
+        for memmap in level_maps:
+            memmap.flush()
+
+    sys.stdout.write("\n")
+
+class FeatureCacheDataset(torch.utils.data.Dataset):
+    """
+    Wraps a dataset and adds the cached backbone pyramid of each image as {img_key}_pyr,
+    attributes not found here (e.g. img_normalize) are read from the wrapped dataset.
+    """
+    def __init__(self, dataset: torch.utils.data.Dataset, cache_dir: Path, img_keys: List[str]):
+        self.dataset = dataset
+        self.cache_dir = cache_dir
+        self.img_keys = img_keys
+
+        with open(cache_dir / "meta.json") as meta_f:
+            self.n_levels = json.load(meta_f)['n_levels']
+
+        # Opened lazily so each dataloader worker maps the files itself
+        self._memmaps = None
+
+    def __getattr__(self, name):
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        if self._memmaps is None:
+            self._memmaps = {key: [np.load(self.cache_dir / f"{key}_{level}.npy", mmap_mode='r')
+                                   for level in range(self.n_levels)]
+                             for key in self.img_keys}
+
+        epoch_data = self.dataset[idx]
+        for key, level_maps in self._memmaps.items():
+            epoch_data[f"{key}_pyr"] = [torch.from_numpy(level_map[idx].astype(np.float32))
+                                        for level_map in level_maps]
+
+        return epoch_data
+
+def get_feature_cache_loaders(model: torch.nn.Module, dataloaders: Dict[str, DataLoader],
+                              basepath: Path, memory_format=torch.contiguous_format)\
+        -> Dict[str, DataLoader]:
+    """
+    Freezes the model's backbone, (re)builds the feature cache for each dataloader
+    if it is missing or stale and returns dataloaders that read from the cache.
+    """
+    if not hasattr(model, 'backbone') or not hasattr(model, 'backbone_forward'):
+        raise NotImplementedError(f"Feature cache unsupported by {model.modelname}")
+
+    for loader in dataloaders.values():
+        check_fixed_augmentation(loader)
+
+    for param in model.backbone.parameters():
+        param.requires_grad = False
+
+    fingerprint = _backbone_fingerprint(model.backbone)
+
+    cached_loaders = {}
+    for split, loader in dataloaders.items():
+        dataset = loader.dataset
+        img_keys = [key for key in ['l_img', 'l_seq'] if hasattr(dataset, key)]
+        meta = {
+            'backbone': fingerprint, 'n_samples': len(dataset),
+            'output_size': list(dataset.base_size), 'img_keys': img_keys,
+        }
+
+        cache_dir = basepath / "feature_cache" / split
+        meta_path = cache_dir / "meta.json"
+        if os.path.isfile(meta_path):
+            with open(meta_path) as meta_f:
+                cached_meta = json.load(meta_f)
+            n_levels = cached_meta.pop('n_levels')
+            stale = cached_meta != meta
+        else:
+            stale = True
+
+        if stale:
+            print(f"Building {split} feature cache in {cache_dir}")
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            build_feature_cache(model, dataset, cache_dir, img_keys, loader.batch_size,
+                                loader.num_workers, memory_format)
+            n_levels = len([f for f in os.listdir(cache_dir) if f.startswith(img_keys[0])])
+            with open(meta_path, 'w') as meta_f:
+                json.dump(dict(meta, n_levels=n_levels), meta_f)
+
+        cached_dataset = FeatureCacheDataset(dataset, cache_dir, img_keys)
+        if isinstance(loader.sampler, ResumableSampler):
+            # Indices are unchanged by the cache so the configured sampler is kept
+            sampler = loader.sampler
+        else:
+            sampler = ResumableSampler(cached_dataset,
+                                       shuffle=isinstance(loader.sampler, RandomSampler))
+        cached_loaders[split] = DataLoader(
+            cached_dataset,
+            batch_size=loader.batch_size,
+            sampler=sampler,
+            num_workers=loader.num_workers,
+            drop_last=loader.drop_last,
+            pin_memory=loader.pin_memory
+        )
+
+    return cached_loaders
@@ -17,16 +17,16 @@ import torch
 import numpy as np
 import matplotlib.pyplot as plt
 
-from nnet_training.loss_functions.UnFlowLoss import flow_warp
+from nnet_training.loss_functions.UnFlowLoss import flow_warp, upsample_flow
 from nnet_training.evaluate_model import data_to_gpu
 from nnet_training.nnet_models import get_model
 from nnet_training.utilities.cityscapes_dataset import CityScapesDataset
+from nnet_training.utilities.dataset_statistics import resolve_dataset_statistics, get_max_depth
 from nnet_training.utilities.visualisation import flow_to_image, CITYSPALLETTE
 from nnet_training.utilities.cityscapes_labels import labels
 
 IMG_EXT = '.png'
 MIN_DEPTH = 0.
-MAX_DEPTH = 80.
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 VIDEO_HZ = 17.0
 
@@ -56,6 +56,8 @@ def get_config_argparse(base_path_list: List[Path]):
     parser = argparse.ArgumentParser()
     # parser.add_argument('-c', '--config', default='configs/HRNetV2_sfd_kt.json')
     parser.add_argument('-e', '--experiment', default='8f23c8346c898db41c5bc7c13c36da66')
+    parser.add_argument('--compile', nargs='?', const='default', default=None,
+                        help='Run the model with torch.compile, optionally giving the compile mode')
     model_path = None
 
     if 'config' in parser.parse_args():
@@ -89,6 +91,9 @@ def get_config_argparse(base_path_list: List[Path]):
                     model_cfg = EasyDict(json.load(conf_f))
                 break
 
+    if parser.parse_args().compile is not None:
+        model_cfg.model.compile = {"mode": parser.parse_args().compile}
+
     return model_cfg, model_path
 
 def get_loader_and_model(model_cfg: EasyDict, model_path: Path, data_dir: str):
@@ -101,6 +106,8 @@ def get_loader_and_model(model_cfg: EasyDict, model_path: Path, data_dir: str):
     else:
         n_workers = min(multiprocessing.cpu_count(), model_cfg.dataset.batch_size * 5)
 
+    resolve_dataset_statistics(model_cfg)
+
     dataset = CityScapesDemo(
         data_dir, output_size=model_cfg.dataset.augmentations.output_size,
         img_normalize=model_cfg.dataset.augmentations.img_normalize
@@ -148,7 +155,8 @@ def generate_static_mask(segmentation: torch.Tensor):
     return mask
 
 @torch.no_grad()
-def slam_testing(model: torch.nn.Module, dataloader: torch.utils.data.DataLoader, path: str):
+def slam_testing(model: torch.nn.Module, dataloader: torch.utils.data.DataLoader, path: str,
+                 max_depth: float):
     """
     Testing odometry concept
     """
@@ -159,18 +167,19 @@ def slam_testing(model: torch.nn.Module, dataloader: torch.utils.data.DataLoader
         VIDEO_HZ, tuple(dataloader.dataset.output_shape))
 
     for idx, batch_data in enumerate(dataloader):
-        data_to_gpu(batch_data)
+        data_to_gpu(batch_data, model.memory_format)
         forward = model(**batch_data, slam=True)
 
         batch_depth = forward['depth'].detach()
         batch_depth[batch_depth < MIN_DEPTH] = MIN_DEPTH
-        batch_depth[batch_depth > MAX_DEPTH] = MAX_DEPTH
+        batch_depth[batch_depth > max_depth] = max_depth
 
         batch_depth_seq = forward['depth_b'].detach()
         batch_depth_seq[batch_depth_seq < MIN_DEPTH] = MIN_DEPTH
-        batch_depth_seq[batch_depth_seq > MAX_DEPTH] = MAX_DEPTH
+        batch_depth_seq[batch_depth_seq > max_depth] = max_depth
 
-        batch_flow = forward['flow'][0].detach()
+        # Flow is at the resolution of its pyramid level
+        batch_flow = upsample_flow(forward['flow'][0].detach(), batch_data['l_img'].shape[2:])
 
         batch_seg = torch.argmax(forward['seg'], dim=1)
         seq_depth = flow_warp(batch_depth_seq, batch_flow)
@@ -220,7 +229,7 @@ def slam_testing(model: torch.nn.Module, dataloader: torch.utils.data.DataLoader
 
 @torch.no_grad()
 def generate_video(model: torch.nn.Module, dataloader: torch.utils.data.DataLoader,
-                   path: str):
+                   path: str, max_depth: float):
     """
     Sequentially steps through dataloader and uses opencv to write to a video
     """
@@ -244,16 +253,17 @@ def generate_video(model: torch.nn.Module, dataloader: torch.utils.data.DataLoad
 
     print('Beginning video writing')
     for idx, batch_data in enumerate(dataloader):
-        data_to_gpu(batch_data)
+        data_to_gpu(batch_data, model.memory_format)
         forward = model(**batch_data)
 
         batch_depth = forward['depth'].detach().cpu().numpy()
         batch_depth[batch_depth < MIN_DEPTH] = MIN_DEPTH
-        batch_depth[batch_depth > MAX_DEPTH] = MAX_DEPTH
+        batch_depth[batch_depth > max_depth] = max_depth
 
         batch_seg = torch.argmax(forward['seg'], dim=1).cpu().numpy()
 
-        batch_flow = forward['flow'][0].detach().cpu().numpy()
+        batch_flow = upsample_flow(
+            forward['flow'][0].detach(), batch_data['l_img'].shape[2:]).cpu().numpy()
 
         for i in range(batch_seg.shape[0]):
             seg_frame = np.empty(shape=(resolution[1], resolution[0], 3), dtype=np.uint8)
@@ -265,7 +275,7 @@ def generate_video(model: torch.nn.Module, dataloader: torch.utils.data.DataLoad
             flow_frame = flow_to_image(flow_transpose)
 
             depth_frame = cv2.applyColorMap(
-                (batch_depth[i, 0] / MAX_DEPTH * 255).astype(np.uint8),
+                (batch_depth[i, 0] / max_depth * 255).astype(np.uint8),
                 cv2.COLORMAP_MAGMA)
 
             image_frame = np.moveaxis(
@@ -304,6 +314,6 @@ if __name__ == "__main__":
 
     DATALOADER, MODEL = get_loader_and_model(MODEL_CFG, MODEL_PTH, DATA_DIR)
 
-    slam_testing(MODEL, DATALOADER, MODEL_PTH)
+    slam_testing(MODEL, DATALOADER, MODEL_PTH, get_max_depth(MODEL_CFG.dataset))
 
-    # generate_video(MODEL, DATALOADER, MODEL_PTH)
+    # generate_video(MODEL, DATALOADER, MODEL_PTH, get_max_depth(MODEL_CFG.dataset))
@@ -19,9 +19,8 @@ from PIL import Image
 
 import numpy as np
 
-from torch.utils.data import RandomSampler
 from nnet_training.utilities.visualisation import get_color_pallete, flow_to_image
-from nnet_training.utilities.custom_batch_sampler import BatchSamplerRandScale
+from nnet_training.utilities.custom_batch_sampler import BatchSamplerRandScale, get_training_sampler
 
 __all__ = ['Kitti2015Dataset', 'get_kitti_dataset']
 
@@ -46,7 +45,8 @@ class Kitti2015Dataset(torch.utils.data.Dataset):
         @param crop_fraction determines if the image is randomly cropped to by a fraction
             e.g. 2 results in width/2 by height/2 random crop of original image\n
         @param rand_rotation randomly rotates an image a maximum number of degrees.\n
-        @param rand_brightness, the maximum random increase or decrease as a percentage.
+        @param rand_brightness, the maximum random increase or decrease as a percentage.\n
+        @param rand_flip randomly mirrors the image horizontally, default True.
         '''
         self.l_img = []
 
@@ -168,6 +168,7 @@ class Kitti2015Dataset(torch.utils.data.Dataset):
         }
 
         self.mirror_x = 1.0
+        self.rand_flip = kwargs['rand_flip'] if 'rand_flip' in kwargs else True
 
         if 'crop_fraction' in kwargs:
             self.crop_fraction = kwargs['crop_fraction']
@@ -233,7 +234,7 @@ class Kitti2015Dataset(torch.utils.data.Dataset):
         self.output_shape = [scale_func(x) for x in self.base_size]
 
         # random mirror
-        if random.random() < 0.5:
+        if self.rand_flip and random.random() < 0.5:
             self.mirror_x = -1.0
             for key, data in epoch_data.items():
                 epoch_data[key] = data.transpose(Image.FLIP_LEFT_RIGHT)
@@ -372,6 +373,8 @@ def get_kitti_dataset(dataset_config) -> Dict[str, torch.utils.data.DataLoader]:
         aux_aug['img_normalize'] = dataset_config.augmentations.img_normalize
     if 'disparity_out' in dataset_config.augmentations:
         aux_aug['disparity_out'] = dataset_config.augmentations.disparity_out
+    if 'rand_flip' in dataset_config.augmentations:
+        aux_aug['rand_flip'] = dataset_config.augmentations.rand_flip
 
     datasets = {
         'Training'   : Kitti2015Dataset(
@@ -398,7 +401,7 @@ def get_kitti_dataset(dataset_config) -> Dict[str, torch.utils.data.DataLoader]:
         dataloaders['Training'] = torch.utils.data.DataLoader(
             datasets["Training"], num_workers=n_workers, pin_memory=True,
             batch_sampler=BatchSamplerRandScale(
-                sampler=RandomSampler(datasets["Training"]),
+                sampler=get_training_sampler(datasets["Training"], dataset_config),
                 batch_size=dataset_config.batch_size,
                 drop_last=dataset_config.drop_last,
                 scale_range=dataset_config.augmentations.rand_scale)
@@ -409,7 +412,7 @@ def get_kitti_dataset(dataset_config) -> Dict[str, torch.utils.data.DataLoader]:
         dataloaders['Training'] = torch.utils.data.DataLoader(
             datasets["Training"],
             batch_size=dataset_config.batch_size,
-            shuffle=dataset_config.shuffle,
+            sampler=get_training_sampler(datasets["Training"], dataset_config),
             num_workers=n_workers,
             drop_last=dataset_config.drop_last,
             pin_memory=True
@@ -58,6 +58,8 @@ class LRScheduler(object):
         self.power = power
         self.step_factor = step_factor
         self.learning_rate = 0.0
+        # Multiplier applied on top of the schedule, e.g. by the resolution curriculum
+        self.lr_scale = 1.0
 
     def __call__(self, num_update: int) -> float:
         self.update(num_update)
@@ -71,6 +73,12 @@ class LRScheduler(object):
         if epoch_iters > 0:
             self.niters = epoch_iters
 
+    def state_dict(self) -> dict:
+        return dict(self.__dict__)
+
+    def load_state_dict(self, state_dict: dict):
+        self.__dict__.update(state_dict)
+
     def update(self, num_update: int):
         N = self.niters - 1
         T = num_update - self.offset
@@ -97,6 +105,7 @@ class LRScheduler(object):
             self.learning_rate = self.base_lr * factor
         else:
             self.learning_rate = self.target_lr + (self.base_lr - self.target_lr) * factor
+        self.learning_rate *= self.lr_scale
 
 
 if __name__ == '__main__':
@@ -18,10 +18,19 @@ from scipy import stats
 import torch
 
 from nnet_training.utilities.cityscapes_labels import trainId2name
-from nnet_training.loss_functions.UnFlowLoss import flow_warp
+from nnet_training.loss_functions.UnFlowLoss import flow_warp, upsample_flow
+from nnet_training.loss_functions.valid_pixels import ValidPixels, depth_pixels, flow_pixels
+from nnet_training.utilities.dataset_statistics import MAX_DEPTH
 
 __all__ = ['MetricBase', 'SegmentationMetric', 'DepthMetric',
-           'BoundaryBoxMetric', 'ClassificationMetric']
+           'BoundaryBoxMetric', 'ClassificationMetric', 'confidence_interval']
+
+def confidence_interval(std: float, n_samples: int) -> float:
+    """
+    Half width of the t-based confidence interval of a mean, same confidence
+    level as the plots and experiment_comp but from the standard deviation
+    """
+    return stats.t.ppf(0.95, n_samples-1) * std / np.sqrt(n_samples)
 
 class MetricBase(object):
     """
@@ -30,6 +39,7 @@ class MetricBase(object):
     def __init__(self, savefile: str, base_dir: Path, main_metric: str, mode='training'):
         assert mode in ['training', 'validation']
         self.mode = mode
+        self.epoch = None
         self.metric_data = dict()
         if main_metric[:6] != "Batch_":
             main_metric = "Batch_"+main_metric
@@ -63,35 +73,40 @@ class MetricBase(object):
                 n_epochs += len(list(hfile['cache/training']))
             return n_epochs
 
-    def save_epoch(self):
+    def save_epoch(self, epoch: int = None):
         """
-        Save Data to new dataset named by epoch name
+        Save Data to new dataset named by epoch name, the epoch given to
+        new_epoch if not given, otherwise the next unused epoch number
         """
+        if epoch is not None:
+            self.epoch = epoch
+
         if self._path is not None:
             with h5py.File(self._path, 'a') as hfile:
                 # Clear any Cached data from previous first into main
                 if 'cache' in list(hfile) and len(list(hfile['cache'])) > 0:
                     self._flush_to_main()
 
-                if self.mode in list(hfile):
-                    group_name = self.mode + '/Epoch_' + str(len(list(hfile[self.mode])) + 1)
-                else:
-                    group_name = self.mode + '/Epoch_1'
+                group_name = self.mode + '/' + self._epoch_name(hfile, self.mode)
 
-                top_group = hfile.create_group(group_name)
-                for name, data in self.metric_data.items():
-                    data = np.asarray(data)
-                    if name[:6] == "Batch_" and len(data.shape) > 1:
-                        data = data.reshape(data.shape[0] * data.shape[1], -1)
-                    top_group.create_dataset(name, data=data)
+                # Nothing to save if this epoch was skipped or discarded
+                if all(len(metric) > 0 for metric in self.metric_data.values()):
+                    if group_name in hfile:
+                        del hfile[group_name]
+                    top_group = hfile.create_group(group_name)
+                    for name, data in self.metric_data.items():
+                        data = np.asarray(data)
+                        if name[:6] == "Batch_" and len(data.shape) > 1:
+                            data = data.reshape(data.shape[0] * data.shape[1], -1)
+                        top_group.create_dataset(name, data=data)
 
-                mean, variance = np.asarray(self.get_current_statistics(main_metric=False))
-                top_group.create_dataset('Summary_Mean', data=mean)
-                top_group.create_dataset('Summary_Variance', data=variance)
+                    mean, variance = np.asarray(self.get_current_statistics(main_metric=False))
+                    top_group.create_dataset('Summary_Mean', data=mean)
+                    top_group.create_dataset('Summary_Variance', data=variance)
 
-                # Flush current data as its now in long term
-                # storage and we're ready for next dataset
-                self._reset_metric()
+                    # Flush current data as its now in long term
+                    # storage and we're ready for next dataset
+                    self._reset_metric()
 
         else:
             print("No File Specified for Segmentation Metric Manager")
@@ -113,9 +128,22 @@ class MetricBase(object):
         print("No File Specified for Segmentation Metric Manager")
         return None
 
-    def new_epoch(self, mode='training'):
+    def discard_epoch(self):
+        """
+        Drops the data of the current epoch without saving or caching it
+        """
+        self._reset_metric()
+
+    def get_main_metric_samples(self) -> np.ndarray:
         """
-        Caches any data that hasn't been saved and resets metrics
+        Returns the main metric of each sample in the current epoch
+        """
+        return np.asarray(self.metric_data[self.main_metric]).flatten()
+
+    def new_epoch(self, mode='training', epoch: int = None):
+        """
+        Caches any data that hasn't been saved and resets metrics,
+        the new epoch's data is saved under epoch if given
         """
         assert mode in ['training', 'validation']
 
@@ -125,8 +153,30 @@ class MetricBase(object):
             self._cache_data()
 
         self.mode = mode
+        self.epoch = epoch
         self._reset_metric()
 
+    def _epoch_name(self, hfile: h5py.File, mode: str) -> str:
+        """
+        Group name of the current epoch, if no epoch number was given it follows
+        on from the largest epoch number saved or cached for the mode
+        """
+        if self.epoch is not None:
+            return 'Epoch_' + str(self.epoch)
+
+        epochs = [0]
+        for group in [mode, 'cache/' + mode]:
+            if group in hfile:
+                epochs.extend(int(epoch[6:]) for epoch in hfile[group])
+        return 'Epoch_' + str(max(epochs) + 1)
+
+    @staticmethod
+    def _sorted_epochs(group: h5py.Group) -> List[str]:
+        """
+        Epoch group names in order of epoch number
+        """
+        return sorted(list(group), key=lambda x: int(x[6:]))
+
     def plot_epoch_data(self, epoch_idx):
         """
         This plots all the statistics for an epoch
@@ -136,12 +186,15 @@ class MetricBase(object):
 
         group_name = 'Epoch_' + str(epoch_idx)
         with h5py.File(self._path, 'r') as hfile:
+            # Validation may have been skipped on this epoch
+            modes = [mode for mode in ['training', 'validation']
+                     if mode in hfile and group_name in hfile[mode]]
             num_metrics = len(list(hfile['training'][group_name]))
             for idx, metric in enumerate(list(hfile['training'][group_name])):
                 plt.subplot(1, num_metrics, idx+1)
-                plt.plot(hfile['training'][group_name][metric][:])
-                plt.plot(hfile['validation'][group_name][metric][:])
-                plt.legend(["Training", "Validation"])
+                for mode in modes:
+                    plt.plot(hfile[mode][group_name][metric][:])
+                plt.legend([mode.capitalize() for mode in modes])
                 plt.title('Batch ' + str(metric) + ' over Epochs')
                 plt.ylabel(str(metric))
                 plt.xlabel('Iter #')
@@ -154,15 +207,9 @@ class MetricBase(object):
         """
         if self._path is not None:
             with h5py.File(self._path, 'a') as hfile:
-                n_cached = 1
-                if 'cache' in list(hfile) and self.mode in list(hfile['cache']):
-                    n_cached = len(list(hfile['cache/'+self.mode])) + 1
-
-                if self.mode in list(hfile):
-                    group_name = 'cache/' + self.mode + '/Epoch_' +\
-                        str(len(list(hfile[self.mode])) + n_cached)
-                else:
-                    group_name = 'cache/' + self.mode + '/Epoch_' + str(n_cached)
+                group_name = 'cache/' + self.mode + '/' + self._epoch_name(hfile, self.mode)
+                if group_name in hfile:
+                    del hfile[group_name]
 
                 top_group = hfile.create_group(group_name)
                 for name, data in self.metric_data.items():
@@ -185,16 +232,24 @@ class MetricBase(object):
         with h5py.File(self._path, 'a') as hfile:
             for mode in list(hfile['cache']):
                 for epoch in list(hfile['cache/'+mode]):
+                    # A resumed epoch replaces what was saved of it before
+                    if mode in hfile and epoch in hfile[mode]:
+                        del hfile[mode+'/'+epoch]
                     hfile.copy('cache/'+mode+'/'+epoch, mode+'/'+epoch)
                     del hfile['cache/'+mode+'/'+epoch]
 
     def get_summary_data(self):
         """
-        Returns dictionary with testing and validation statistics
+        Returns dictionary with testing and validation statistics, and the epoch
+        numbers of each as Training_Epochs and Validation_Epochs since validation
+        may not have been run (or kept) on every training epoch
         """
         with h5py.File(self._path, 'r') as hfile:
+            training_epochs = self._sorted_epochs(hfile['training'])
+            validation_epochs = self._sorted_epochs(hfile['validation'])
+
             metrics = []
-            for metric in list(hfile['training/Epoch_1']):
+            for metric in list(hfile['training/'+training_epochs[0]]):
                 if metric[:5] == 'Batch':
                     metrics.append(metric)
 
@@ -203,15 +258,14 @@ class MetricBase(object):
             training_var = np.zeros((len(list(hfile['training'])), len(metrics)))
             testing_var = np.zeros((len(list(hfile['validation'])), len(metrics)))
 
-            sort_func = lambda x: int(x[6:])
-            for idx, epoch in enumerate(sorted(list(hfile['training']), key=sort_func)):
+            for idx, epoch in enumerate(training_epochs):
                 if 'Summary' in list(hfile['training/'+epoch]):
                     training_mean[idx] = hfile['training/'+epoch+'/Summary'][:]
                 else:
                     training_mean[idx] = hfile['training/'+epoch+'/Summary_Mean'][:]
                     training_var[idx] = hfile['training/'+epoch+'/Summary_Variance'][:]
 
-            for idx, epoch in enumerate(sorted(list(hfile['validation']), key=sort_func)):
+            for idx, epoch in enumerate(validation_epochs):
                 if 'Summary' in list(hfile['validation/'+epoch]):
                     testing_mean[idx] = hfile['validation/'+epoch+'/Summary'][:]
                 else:
@@ -225,6 +279,8 @@ class MetricBase(object):
                 "Validation_Mean" : testing_mean[:, idx],
                 "Training_Variance" : training_var[:, idx],
                 "Validation_Variance" : testing_var[:, idx],
+                "Training_Epochs" : np.asarray([int(x[6:]) for x in training_epochs]),
+                "Validation_Epochs" : np.asarray([int(x[6:]) for x in validation_epochs]),
             }
 
         return ret_val
@@ -236,9 +292,10 @@ class MetricBase(object):
         assert dataset in ['validation', 'training']
 
         with h5py.File(self._path, 'r') as hfile:
-            for metric in list(hfile[f'{dataset}/Epoch_1']):
+            first_epoch = self._sorted_epochs(hfile[dataset])[0]
+            for metric in list(hfile[f'{dataset}/{first_epoch}']):
                 if metric[:5] == 'Batch':
-                    return hfile[f'{dataset}/Epoch_1/{metric}'][:].shape[0]
+                    return hfile[f'{dataset}/{first_epoch}/{metric}'][:].shape[0]
 
         return 0
 
@@ -256,21 +313,23 @@ class MetricBase(object):
         for idx, metric in enumerate(summary_data):
             plt.subplot(1, len(summary_data), idx+1)
 
+            epochs = summary_data[metric]["Training_Epochs"]
             data_mean = summary_data[metric]["Training_Mean"]
             data_conf = stats.t.ppf(0.95, n_training-1) * \
                 summary_data[metric]["Training_Variance"] / np.sqrt(n_training)
-            plt.plot(data_mean)
+            plt.plot(epochs, data_mean)
             plt.fill_between(
-                np.arange(0, data_mean.shape[0]),
+                epochs,
                 data_mean - data_conf, data_mean + data_conf,
                 alpha=0.2)
 
+            epochs = summary_data[metric]["Validation_Epochs"]
             data_mean = summary_data[metric]["Validation_Mean"]
             data_conf = stats.t.ppf(0.95, n_validation-1) * \
                 summary_data[metric]["Validation_Variance"] / np.sqrt(n_validation)
-            plt.plot(data_mean)
+            plt.plot(epochs, data_mean)
             plt.fill_between(
-                np.arange(0, data_mean.shape[0]),
+                epochs,
                 data_mean - data_conf, data_mean + data_conf,
                 alpha=0.2)
 
@@ -291,7 +350,7 @@ class MetricBase(object):
         with h5py.File(self._path, 'r') as hfile:
             training_metrics = {}
             validation_metrics = {}
-            for metric in list(hfile['training/Epoch_1']):
+            for metric in list(hfile['training/'+self._sorted_epochs(hfile['training'])[0]]):
                 if metric[:5] == 'Batch':
                     training_metrics[metric] = np.zeros((1, 1))
                     validation_metrics[metric] = np.zeros((1, 1))
@@ -500,6 +559,16 @@ class SegmentationMetric(MetricBase):
         loss = np.asarray(self.metric_data["Batch_Loss"]).mean()
         print(f"Pixel Accuracy: {pixel_acc:.4f}\nmIoU: {miou:.4f}\nLoss: {loss:.4f}")
 
+    def get_main_metric_samples(self) -> np.ndarray:
+        """
+        Returns the main metric of each sample in the current epoch, mIoU is
+        averaged over the classes present in each sample
+        """
+        if self.main_metric == 'Batch_IoU':
+            data = np.asarray(self.metric_data['Batch_IoU']).reshape(-1, self._n_classes)
+            return np.nanmean(data, axis=1)
+        return super().get_main_metric_samples()
+
     def get_current_statistics(self, main_metric=True, loss_metric=True):
         """
         Returns Accuracy Metrics [pixelwise, mIoU, loss]\n
@@ -662,8 +731,9 @@ class SegmentationMetric(MetricBase):
                 data_mean = np.zeros((len(list(hfile[dataset])), self._n_classes))
                 data_conf = np.zeros((len(list(hfile[dataset])), self._n_classes))
 
-                sort_lmbda = lambda x: int(x[6:])
-                for idx, epoch in enumerate(sorted(list(hfile[dataset]), key=sort_lmbda)):
+                epoch_names = self._sorted_epochs(hfile[dataset])
+                epochs = np.asarray([int(epoch[6:]) for epoch in epoch_names])
+                for idx, epoch in enumerate(epoch_names):
                     epoch_data = hfile[f'{dataset}/{epoch}/Batch_IoU'][:]
                     n_samples = np.count_nonzero(~np.isnan(epoch_data), axis=0)
                     data_mean[idx] = np.nanmean(epoch_data, axis=0)
@@ -671,9 +741,9 @@ class SegmentationMetric(MetricBase):
                         np.nanvar(epoch_data, axis=0, ddof=1) / np.sqrt(n_samples)
 
             for idx in range(self._n_classes):
-                axis[idx%3][idx//3].plot(data_mean[:, idx], label=dataset)
+                axis[idx%3][idx//3].plot(epochs, data_mean[:, idx], label=dataset)
                 axis[idx%3][idx//3].fill_between(
-                    np.arange(0, data_mean[:, idx].shape[0]),
+                    epochs,
                     data_mean[:, idx] - data_conf[:, idx],
                     data_mean[:, idx] + data_conf[:, idx],
                     alpha=0.2)
@@ -685,56 +755,40 @@ class SegmentationMetric(MetricBase):
 
     def conf_summary_data(self):
         """
-        Generates summary data that can be infered from the confusion matrix.
+        Generates summary data that can be infered from the confusion matrix,
+        'epochs' is the epoch number of each row as validation may not be run every epoch.
         """
         test = {}
         train = {}
 
         with h5py.File(self._path, 'r') as hfile:
-            # assert len(list(hfile['training'])) == len(list(hfile['validation']))
-            num_epochs = len(list(hfile['validation']))
-            training_data = np.zeros((num_epochs, self._n_classes, self._n_classes))
-            testing_data = np.zeros((num_epochs, self._n_classes, self._n_classes))
-
-            sort_lmbda = lambda x: int(x[6:])
-            for idx, epoch in enumerate(sorted(list(hfile['training']), key=sort_lmbda)):
-                training_data[idx] = hfile['training/'+epoch+'/Confusion_Mat'][:]
-
-            for idx, epoch in enumerate(sorted(list(hfile['validation']), key=sort_lmbda)):
-                testing_data[idx] = hfile['validation/'+epoch+'/Confusion_Mat'][:]
-
-        test['iou'] = np.zeros((num_epochs, self._n_classes))
-        train['iou'] = np.zeros((num_epochs, self._n_classes))
-
-        test['precision'] = np.zeros((num_epochs, self._n_classes))
-        train['precision'] = np.zeros((num_epochs, self._n_classes))
-
-        test['recall'] = np.zeros((num_epochs, self._n_classes))
-        train['recall'] = np.zeros((num_epochs, self._n_classes))
-
-        for idx in range(num_epochs):
-            test['iou'][idx] = self._confmat_cls_iou(testing_data[idx, :, :])
-            train['iou'][idx] = self._confmat_cls_iou(training_data[idx, :, :])
-
-            test['precision'][idx], test['recall'][idx] = \
-                self._confmat_cls_pr_rc(testing_data[idx, :, :])
-
-            train['precision'][idx], train['recall'][idx] = \
-                self._confmat_cls_pr_rc(training_data[idx, :, :])
+            for dataset, summary in [('training', train), ('validation', test)]:
+                epoch_names = self._sorted_epochs(hfile[dataset])
+                num_epochs = len(epoch_names)
+                summary['epochs'] = np.asarray([int(epoch[6:]) for epoch in epoch_names])
+                summary['iou'] = np.zeros((num_epochs, self._n_classes))
+                summary['precision'] = np.zeros((num_epochs, self._n_classes))
+                summary['recall'] = np.zeros((num_epochs, self._n_classes))
+
+                for idx, epoch in enumerate(epoch_names):
+                    conf_mat = hfile[dataset+'/'+epoch+'/Confusion_Mat'][:]
+                    summary['iou'][idx] = self._confmat_cls_iou(conf_mat)
+                    summary['precision'][idx], summary['recall'][idx] = \
+                        self._confmat_cls_pr_rc(conf_mat)
 
         return test, train
 
     def display_conf_mat(self, index=-1, dataset='validation'):
         """
         Plots the confusion matrix of an epoch.\n
-        @param index: the index of the epoch you want to plot\n
+        @param index: the epoch number you want to plot, the latest if not positive\n
         @param dataset: either training or validation data.
         """
         assert dataset in ['validation', 'training']
         with h5py.File(self._path, 'r') as hfile:
-            num_epochs = len(list(hfile[dataset]))
-            assert index < num_epochs
-            epoch_name = f'Epoch_{index}' if index > 0 else f'Epoch_{num_epochs}'
+            epoch_names = self._sorted_epochs(hfile[dataset])
+            epoch_name = f'Epoch_{index}' if index > 0 else epoch_names[-1]
+            assert epoch_name in epoch_names
             epoch_data = hfile[dataset][epoch_name+'/Confusion_Mat'][:]
 
         plt.figure(figsize=(18, 5))
@@ -757,8 +811,8 @@ class SegmentationMetric(MetricBase):
 
         for idx in range(self._n_classes):
             plt.subplot(3, self._n_classes//3+1, idx+1)
-            plt.plot(train['iou'][:, idx])
-            plt.plot(test['iou'][:, idx])
+            plt.plot(train['epochs'], train['iou'][:, idx])
+            plt.plot(test['epochs'], test['iou'][:, idx])
             plt.legend(["Training", "Validation"])
             plt.title(f'{trainId2name[idx]}')
             plt.xlabel('Epoch #')
@@ -771,8 +825,8 @@ class SegmentationMetric(MetricBase):
 
         for idx in range(self._n_classes):
             plt.subplot(3, self._n_classes//3+1, idx+1)
-            plt.plot(train['precision'][:, idx])
-            plt.plot(test['precision'][:, idx])
+            plt.plot(train['epochs'], train['precision'][:, idx])
+            plt.plot(test['epochs'], test['precision'][:, idx])
             plt.legend(["Training", "Validation"])
             plt.title(f'{trainId2name[idx]}')
             plt.xlabel('Epoch #')
@@ -785,8 +839,8 @@ class SegmentationMetric(MetricBase):
 
         for idx in range(self._n_classes):
             plt.subplot(3, self._n_classes//3+1, idx+1)
-            plt.plot(train['recall'][:, idx])
-            plt.plot(test['recall'][:, idx])
+            plt.plot(train['epochs'], train['recall'][:, idx])
+            plt.plot(test['epochs'], test['recall'][:, idx])
             plt.legend(["Training", "Validation"])
             plt.title(f'{trainId2name[idx]}')
             plt.xlabel('Epoch #')
@@ -797,63 +851,62 @@ class SegmentationMetric(MetricBase):
 class DepthMetric(MetricBase):
     """
     Accuracy/Error and Loss Staticstics tracking for depth based networks.\n
-    Tracks Invariant, RMSE Linear, RMSE Log, Squared Relative and Absolute Relative.
+    Tracks Invariant, RMSE Linear, RMSE Log, Squared Relative and Absolute Relative.\n
+    Ground truth beyond max_depth is excluded from the metrics.
     """
-    def __init__(self, savefile: str, base_dir: Path, main_metric: str, mode='training'):
+    def __init__(self, savefile: str, base_dir: Path, main_metric: str, mode='training',
+                 max_depth: float = MAX_DEPTH):
         super(DepthMetric, self).__init__(savefile=savefile, base_dir=base_dir,
                                           main_metric=main_metric, mode=mode)
+        self._max_depth = max_depth
         self._reset_metric()
         assert self.main_metric in self.metric_data.keys()
 
-    def add_sample(self, pred_depth: torch.Tensor, gt_depth: torch.Tensor, loss=None):
+    def add_sample(self, pred_depth: torch.Tensor, gt_depth: torch.Tensor, loss=None, cache=None):
+        """
+        Metrics are only evaluated on the pixels with ground truth depth (0, max_depth)m,
+        cache is the PyramidCache of the batch, reusing the gathered pixels if there is one
+        """
         self.metric_data["Batch_Loss"].append(loss if loss is not None else 0)
         if isinstance(pred_depth, List):
             pred_depth = pred_depth[0]
 
-        pred_depth = pred_depth.squeeze(dim=1)
-        pred_depth[pred_depth == 0] += 1e-7
+        valid = cache.apply(depth_pixels, gt_depth, max_depth=self._max_depth) \
+            if cache is not None else depth_pixels(gt_depth, max_depth=self._max_depth)
 
-        gt_mask = gt_depth < 80.
-        gt_mask &= gt_depth > 0.
-        n_valid = torch.sum(gt_mask, dim=(1, 2))
-        gt_mask = ~gt_mask
+        pred_depth = valid.gather(pred_depth)
+        pred_depth = pred_depth.masked_fill(pred_depth == 0, 1e-7)
+        gt_depth = valid.gather(gt_depth)
 
         difference = pred_depth - gt_depth
-        difference[gt_mask] = 0.
         squared_diff = difference.pow(2)
 
-        log_diff = (torch.log(pred_depth) - torch.log(gt_depth))
-        log_diff[gt_mask] = 0.
-        sq_log_diff = torch.sum(log_diff.pow(2), dim=(1, 2)) / n_valid
+        log_diff = torch.log(pred_depth) - torch.log(gt_depth)
+        sq_log_diff = valid.batch_mean(log_diff.pow(2))
 
-        abs_rel = difference.abs() / gt_depth
-        abs_rel[gt_mask] = 0.
         self.metric_data['Batch_Absolute_Relative'].append(
-            (torch.sum(abs_rel, dim=(1, 2)) / n_valid).cpu().data.numpy())
+            valid.batch_mean(difference.abs() / gt_depth).cpu().data.numpy())
 
-        sqr_rel = squared_diff / gt_depth
-        sqr_rel[gt_mask] = 0.
         self.metric_data['Batch_Squared_Relative'].append(
-            (torch.sum(sqr_rel, dim=(1, 2)) / n_valid).cpu().data.numpy())
+            valid.batch_mean(squared_diff / gt_depth).cpu().data.numpy())
 
         self.metric_data['Batch_RMSE_Linear'].append(
-            torch.sqrt(torch.sum(squared_diff, dim=(1, 2)) / n_valid).cpu().data.numpy())
+            torch.sqrt(valid.batch_mean(squared_diff)).cpu().data.numpy())
 
         self.metric_data['Batch_RMSE_Log'].append(
             torch.sqrt(sq_log_diff).cpu().data.numpy())
 
         eqn1 = sq_log_diff
-        eqn2 = torch.sum(log_diff.abs(), dim=(1, 2))**2 / n_valid**2
+        eqn2 = valid.batch_sum(log_diff.abs())**2 / valid.counts.to(log_diff.dtype)**2
         self.metric_data['Batch_Invariant'].append((eqn1 - eqn2).cpu().data.numpy())
 
         threshold = torch.max(pred_depth / gt_depth, gt_depth / pred_depth)
-        threshold[gt_mask] = 1.25 ** 3
         self.metric_data['Batch_a1'].append(
-            (torch.sum(threshold < 1.25, dim=(1, 2)) / n_valid).cpu().numpy())
+            valid.batch_mean((threshold < 1.25).float()).cpu().numpy())
         self.metric_data['Batch_a2'].append(
-            (torch.sum(threshold < 1.25 ** 2, dim=(1, 2)) / n_valid).cpu().numpy())
+            valid.batch_mean((threshold < 1.25 ** 2).float()).cpu().numpy())
         self.metric_data['Batch_a3'].append(
-            (torch.sum(threshold < 1.25 ** 3, dim=(1, 2)) / n_valid).cpu().numpy())
+            valid.batch_mean((threshold < 1.25 ** 3).float()).cpu().numpy())
 
     def max_accuracy(self, main_metric=True):
         """
@@ -908,43 +961,46 @@ class OpticFlowMetric(MetricBase):
         assert self.main_metric in self.metric_data.keys()
 
     @staticmethod
-    def error_rate(epe_map, gt_flow, mask):
+    def error_rate(epe: torch.Tensor, gt_flow: torch.Tensor, valid: ValidPixels) -> torch.Tensor:
         """
-        Calculates the outlier rate given a flow epe, ground truth and mask.
+        Outlier rate of each sample given the epe [N] and ground truth flow [N, 2]
+        of the valid pixels, outliers are over 3px and 5% of the flow magnitude
         """
-        bad_pixels = torch.logical_and(
-            epe_map * mask > 3,
-            epe_map * mask / torch.maximum(
-                torch.sqrt(torch.sum(torch.square(gt_flow), dim=1)),
-                torch.tensor([1e-10], device=gt_flow.get_device())) > 0.05)
-        return torch.sum(bad_pixels, dim=(1, 2)) / torch.sum(mask, dim=(1, 2))
+        bad_pixels = (epe > 3) & (epe / gt_flow.norm(dim=1).clamp(min=1e-10) > 0.05)
+        return valid.batch_mean(bad_pixels.float())
 
-    def add_sample(self, orig_img, seq_img, flow_pred, flow_target=None, loss=None):
+    def add_sample(self, orig_img, seq_img, flow_pred, flow_target=None, loss=None, cache=None):
         """
-        @input list of original, prediction and sequence images i.e. [left, right]
+        @input list of original, prediction and sequence images i.e. [left, right]\n
+        cache is the PyramidCache of the batch, reusing the loss's warp if there is one\n
+        EPE and outlier rate are only evaluated on the pixels of the flow mask
         """
         self.metric_data["Batch_Loss"].append(loss if loss is not None else 0)
 
-        if flow_target is not None:
-            flow_target["flow_mask"] = flow_target["flow_mask"].squeeze(1)
-            n_valid = torch.sum(flow_target["flow_mask"], dim=(1, 2))
+        # Models can return the flow at its native level resolution
+        if flow_pred.size()[2:] != orig_img.size()[2:]:
+            size = tuple(orig_img.size()[2:])
+            flow_pred = cache.apply(upsample_flow, flow_pred, size=size) if cache is not None \
+                else upsample_flow(flow_pred, size)
 
-            diff = flow_pred - flow_target["flow"]
-            norm_diff = ((diff[:, 0, :, :]**2 + diff[:, 1, :, :]**2)**0.5)
-            masked_epe = torch.sum(norm_diff * flow_target["flow_mask"], dim=(1, 2))
+        if flow_target is not None:
+            valid = cache.apply(flow_pixels, flow_target["flow_mask"]) if cache is not None \
+                else flow_pixels(flow_target["flow_mask"])
 
-            self.metric_data["Batch_EPE"].append(
-                (masked_epe / n_valid).cpu().numpy())
+            gt_flow = valid.gather(flow_target["flow"])
+            epe = (valid.gather(flow_pred) - gt_flow).norm(dim=1)
 
+            self.metric_data["Batch_EPE"].append(valid.batch_mean(epe).cpu().numpy())
             self.metric_data["Batch_Fl_all"].append(
-                self.error_rate(norm_diff, flow_target["flow"],
-                                flow_target["flow_mask"]).cpu().numpy())
+                self.error_rate(epe, gt_flow, valid).cpu().numpy())
         else:
             self.metric_data["Batch_EPE"].append(np.zeros((flow_pred.shape[0], 1)))
             self.metric_data["Batch_Fl_all"].append(np.zeros((flow_pred.shape[0], 1)))
 
+        seq_warped = cache.apply(flow_warp, seq_img, flow_pred) if cache is not None \
+            else flow_warp(seq_img, flow_pred)
         self.metric_data["Batch_SAD"].append(
-            (orig_img-flow_warp(seq_img, flow_pred)).abs().mean(dim=(1, 2, 3)).cpu().numpy())
+            (orig_img-seq_warped).abs().mean(dim=(1, 2, 3)).cpu().numpy())
 
     def max_accuracy(self, main_metric=True):
         """
@@ -1013,11 +1069,12 @@ class ClassificationMetric(MetricBase):
     def _reset_metric(self):
         raise NotImplementedError
 
-def get_loggers(logger_cfg: Dict[str, str], basepath: Path) -> Dict[str, MetricBase]:
+def get_loggers(logger_cfg: Dict[str, str], basepath: Path,
+                max_depth: float = MAX_DEPTH) -> Dict[str, MetricBase]:
     """
     Given a dictionary of [key, value] = [objective type, main metric] and
     basepath to save the file returns a dictionary that consists of performance
-    metric trackers.
+    metric trackers. max_depth is the depth clip of the depth metrics.
     """
     loggers = {}
 
@@ -1030,7 +1087,7 @@ def get_loggers(logger_cfg: Dict[str, str], basepath: Path) -> Dict[str, MetricB
                 19, 'seg_data', main_metric=main_metric, base_dir=basepath)
         elif logger_type == 'depth':
             loggers['depth'] = DepthMetric(
-                'depth_data', main_metric=main_metric, base_dir=basepath)
+                'depth_data', main_metric=main_metric, base_dir=basepath, max_depth=max_depth)
         else:
             raise NotImplementedError(logger_type)
 
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+__author__ = "Bryce Ferenczi"
+__email__ = "bryce.ferenczi@monashmotorsport.com"
+
+import time
+import json
+import copy
+import argparse
+from typing import Dict, List
+
+from easydict import EasyDict
+
+import torch
+
+from nnet_training.nnet_models import get_model, report_graph_breaks
+
+def synthetic_batch(config: EasyDict, device: torch.device) -> Dict[str, torch.Tensor]:
+    """
+    Random image pair with the same shape as the configured training batches
+    """
+    dim_w, dim_h = config.dataset.augmentations.output_size
+    batch_size = config.dataset.batch_size
+    return {
+        'l_img' : torch.rand(batch_size, 3, dim_h, dim_w, device=device),
+        'l_seq' : torch.rand(batch_size, 3, dim_h, dim_w, device=device)
+    }
+
+def _gather_outputs(forward) -> List[torch.Tensor]:
+    """
+    Flattens the nested forward dictionary into a list of float tensors
+    """
+    if isinstance(forward, torch.Tensor):
+        return [forward] if forward.is_floating_point() else []
+    if isinstance(forward, dict):
+        forward = forward.values()
+    outputs = []
+    for item in forward:
+        outputs.extend(_gather_outputs(item))
+    return outputs
+
+def benchmark_model(model: torch.nn.Module, batch: Dict[str, torch.Tensor],
+                    n_iter=20, n_warmup=5, backward=True) -> Dict[str, float]:
+    """
+    Returns the average forward and backward time of a model in milliseconds
+    """
+    device = next(model.parameters()).device
+    batch = {key: data.contiguous(memory_format=model.memory_format)
+             for key, data in batch.items()}
+
+    t_fwd = 0.
+    t_bwd = 0.
+    for iter_ in range(n_iter + n_warmup):
+        model.zero_grad(set_to_none=True)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+        start_time = time.time()
+        with torch.set_grad_enabled(backward):
+            forward = model(**batch)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        fwd_time = time.time() - start_time
+
+        start_time = time.time()
+        if backward:
+            sum([out.mean() for out in _gather_outputs(forward)]).backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        bwd_time = time.time() - start_time
+
+        if iter_ >= n_warmup:
+            t_fwd += fwd_time
+            t_bwd += bwd_time
+
+    return {'forward': 1000. * t_fwd / n_iter, 'backward': 1000. * t_bwd / n_iter}
+
+def compare_memory_formats(config: EasyDict, n_iter=20, backward=True,
+                           compile_mode: str = None) -> None:
+    """
+    Benchmarks a model configuration in both NCHW and NHWC (channels_last) layouts
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    batch = synthetic_batch(config, device)
+
+    results = {}
+    for channels_last in [False, True]:
+        model_cfg = copy.deepcopy(config.model)
+        model_cfg.channels_last = channels_last
+        if compile_mode is not None:
+            model_cfg.compile = {"mode": compile_mode}
+        model = get_model(model_cfg).to(device)
+        model.train(backward)
+
+        name = 'channels_last' if channels_last else 'contiguous'
+        results[name] = benchmark_model(model, batch, n_iter=n_iter, backward=backward)
+
+        del model
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    print(f"{config.model.name} on {device}, batch: {config.dataset.batch_size}, "
+          f"resolution: {config.dataset.augmentations.output_size}, "
+          f"compiled: {compile_mode is not None}")
+    for name, timing in results.items():
+        print(f"{name:>14}: Forward: {timing['forward']:.3f}ms, "
+              f"Backward: {timing['backward']:.3f}ms")
+
+    speedup = (results['contiguous']['forward'] + results['contiguous']['backward']) / \
+        (results['channels_last']['forward'] + results['channels_last']['backward'])
+    print(f"channels_last speedup: {speedup:.3f}x")
+
+def print_graph_breaks(config: EasyDict, backward=True) -> None:
+    """
+    Prints where TorchDynamo has to split the model's forward into multiple graphs
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = get_model(config.model).to(device)
+    model.train(backward)
+    with torch.set_grad_enabled(backward):
+        print(report_graph_breaks(model, **synthetic_batch(config, device)))
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument('-c', '--config', default='configs/HRNetV2_kt.json')
+    PARSER.add_argument('-n', '--iterations', type=int, default=20)
+    PARSER.add_argument('--inference', action='store_true',
+                        help='Only benchmark the forward pass in eval mode')
+    PARSER.add_argument('--compile', nargs='?', const='default', default=None,
+                        help='Benchmark with torch.compile, optionally giving the compile mode')
+    PARSER.add_argument('--graph-breaks', action='store_true',
+                        help='Report the torch.compile graph breaks of the model')
+
+    ARGS = PARSER.parse_args()
+
+    with open(ARGS.config) as f:
+        CONFIG = EasyDict(json.load(f))
+
+    if ARGS.graph_breaks:
+        print_graph_breaks(CONFIG, backward=not ARGS.inference)
+    else:
+        compare_memory_formats(CONFIG, n_iter=ARGS.iterations,
+                               backward=not ARGS.inference, compile_mode=ARGS.compile)
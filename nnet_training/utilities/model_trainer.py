@@ -6,6 +6,9 @@ __email__ = "bryce.ferenczi@monashmotorsport.com"
 import os
 import time
 import sys
+import json
+import random
+import itertools
 from pathlib import Path
 from typing import Dict, Union, List
 
@@ -15,14 +18,51 @@ import torchvision
 
 import matplotlib.pyplot as plt
 
-from nnet_training.utilities.metrics import get_loggers
+from nnet_training.utilities.metrics import get_loggers, confidence_interval
+from nnet_training.utilities.dataset_statistics import MAX_DEPTH
 from nnet_training.utilities.lr_scheduler import LRScheduler
+from nnet_training.utilities.resolution_schedule import ResolutionSchedule
+from nnet_training.utilities.validation_subset import StratifiedSubset, required_samples
+from nnet_training.utilities.feature_cache import get_feature_cache_loaders
+from nnet_training.utilities.checkpoint_writer import AsyncCheckpointWriter, snapshot_state
 from nnet_training.utilities.visualisation import get_color_pallete, flow_to_image
+from nnet_training.loss_functions.pyramid_cache import PyramidCache
+from nnet_training.loss_functions.UnFlowLoss import upsample_flow
 
-__all__ = ['ModelTrainer']
+__all__ = ['ModelTrainer', 'calculate_losses']
 
 MIN_DEPTH = 0.
-MAX_DEPTH = 80.
+
+def calculate_losses(loss_fns: Dict[str, torch.nn.Module],
+                     nnet_outputs: Dict[str, torch.Tensor],
+                     batch_data: Dict[str, torch.Tensor],
+                     reduction='mean') -> Dict[str, torch.Tensor]:
+    """
+    Calculates losses for different outputs and loss functions,
+    reduction 'none' gives the losses of each sample [B]
+    """
+    losses = {}
+
+    if 'flow' in loss_fns:
+        losses['flow'], _, _, _ = loss_fns['flow'](
+            pred_flow_fw=nnet_outputs['flow'], pred_flow_bw=nnet_outputs['flow_b'],
+            im1_origin=batch_data['l_img'], im2_origin=batch_data['l_seq'],
+            cache=batch_data.get('pyramid_cache', None), reduction=reduction)
+
+    if 'segmentation' in loss_fns:
+        losses['seg'] = loss_fns['segmentation'](
+            seg_pred=nnet_outputs, seg_gt=batch_data['seg'], reduction=reduction)
+
+    if 'depth' in loss_fns:
+        # Supervised losses use disp_gt, self-supervised reprojection
+        # losses the image sequence, pose (telemetry) and camera
+        losses['depth'] = loss_fns['depth'](
+            disp_pred=nnet_outputs['depth'], disp_gt=batch_data.get('l_disp', None),
+            source_img=batch_data.get('l_seq', None), target_img=batch_data['l_img'],
+            telemetry=batch_data.get('pose', None), camera=batch_data.get('cam', None),
+            cache=batch_data.get('pyramid_cache', None), reduction=reduction)
+
+    return losses
 
 class ModelTrainer(object):
     """
@@ -32,10 +72,26 @@ class ModelTrainer(object):
                  loss_fn: Dict[str, torch.nn.Module],
                  dataloaders: Dict[str, torch.utils.data.DataLoader],
                  lr_cfg: Dict[str, Union[str, float]], basepath: Path,
-                 logger_cfg: Dict[str, str], checkpoints=True):
+                 logger_cfg: Dict[str, str], checkpoints=True,
+                 feature_cache_cfg: Dict[str, str] = None,
+                 checkpoint_cfg: Dict[str, int] = None,
+                 resolution_cfg: Dict[str, List[float]] = None,
+                 target_metrics: Dict[str, float] = None,
+                 validation_cfg: Dict[str, Union[int, float, Dict[str, float]]] = None,
+                 max_depth: float = MAX_DEPTH):
         '''
         Initialize the Model trainer giving it a nn.Model, nn.Optimizer and dataloaders as
-        a dictionary with Training, Validation and Testing loaders
+        a dictionary with Training, Validation and Testing loaders\n
+        If feature_cache_cfg is given the backbone is frozen and the heads are trained
+        from cached backbone features, optionally initialised from feature_cache_cfg.pretrained\n
+        checkpoint_cfg.interval saves a resumable checkpoint every interval training iterations\n
+        resolution_cfg is a ResolutionSchedule of the training resolution over epochs\n
+        target_metrics {objective: value} records the training time taken to reach each value\n
+        validation_cfg sets how often to validate (interval) and optionally a stratified
+        subset validated in place of the full set, sized so the confidence interval of
+        each main metric is within tolerance (float or {objective: float}). A full pass
+        is still run every full_interval epochs and whenever the subset may be a new best.\n
+        max_depth is the depth clip of the depth metrics and visualisation
         '''
         self._device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -43,23 +99,36 @@ class ModelTrainer(object):
         self._validation_loader = dataloaders["Validation"]
 
         self.epoch = 0
+        self._resume_state = None
+        self._train_time = 0.
+        self._epoch_start_time = None
 
-        self.metric_loggers = get_loggers(logger_cfg, basepath)
+        self._max_depth = max_depth
+        self.metric_loggers = get_loggers(logger_cfg, basepath, max_depth)
 
         self._loss_fn = loss_fn
         self._scaler = torch.cuda.amp.GradScaler()
 
         self._model, self._optimizer = model.cuda(), optimizer
+        self._memory_format = getattr(model, 'memory_format', torch.contiguous_format)
 
         self._lr_manager = LRScheduler(**lr_cfg)
 
         self._checkpoints = checkpoints
+        self._checkpoint_writer = AsyncCheckpointWriter() if checkpoints else None
+        self._checkpoint_interval = checkpoint_cfg.get('interval', 0) if checkpoint_cfg else 0
 
         if not os.path.isdir(basepath):
             os.makedirs(basepath)
 
         self._basepath = basepath
 
+        self._target_metrics = target_metrics if target_metrics is not None else {}
+        self._time_to_target = {}
+        if os.path.isfile(self._basepath / "time_to_target.json"):
+            with open(self._basepath / "time_to_target.json") as json_file:
+                self._time_to_target = json.load(json_file)
+
         if self._checkpoints:
             self.load_checkpoint(self._basepath / (self._model.modelname+"_latest.pth"))
         elif os.path.isfile(self._basepath / (self._model.modelname+"_latest.pth")):
@@ -67,6 +136,41 @@ class ModelTrainer(object):
         else:
             sys.stdout.write("\nStarting From Scratch without Checkpoints!")
 
+        if feature_cache_cfg is not None:
+            if resolution_cfg is not None:
+                raise ValueError("Resolution schedule can't be used with the feature cache")
+            self._setup_feature_cache(feature_cache_cfg)
+
+        self._validation_cfg = validation_cfg if validation_cfg is not None else {}
+        self._val_subset_loader = None
+        if 'tolerance' in self._validation_cfg:
+            self._val_strata = StratifiedSubset(
+                self._validation_loader.dataset, self._validation_cfg.get('seed', 0))
+
+        if resolution_cfg is not None:
+            self._resolution_schedule = ResolutionSchedule(**resolution_cfg)
+            self._full_size = list(self._training_loader.dataset.base_size)
+        else:
+            self._resolution_schedule = None
+
+    def _setup_feature_cache(self, feature_cache_cfg: Dict[str, str]):
+        """
+        Swaps the dataloaders for ones that read the frozen backbone's features from disk
+        """
+        if self.epoch == 0 and 'pretrained' in feature_cache_cfg:
+            checkpoint = torch.load(feature_cache_cfg['pretrained'],
+                                    map_location=torch.device(self._device))
+            self._model.load_state_dict(checkpoint['model_state_dict'])
+            sys.stdout.write(f"\nInitialised from {feature_cache_cfg['pretrained']}\n")
+
+        loaders = get_feature_cache_loaders(
+            self._model, {"Training": self._training_loader,
+                          "Validation": self._validation_loader},
+            self._basepath, self._memory_format)
+
+        self._training_loader = loaders["Training"]
+        self._validation_loader = loaders["Validation"]
+
     def get_learning_rate(self) -> float:
         """
         Returns current learning rate of manager
@@ -91,26 +195,105 @@ class ModelTrainer(object):
             self._model.load_state_dict(checkpoint['model_state_dict'])
             self._optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
             self.epoch = checkpoint['epochs']
-            sys.stdout.write(f"\nCheckpoint loaded from {str(path)} "
-                             f"starting from epoch: {self.epoch}\n")
+            self._train_time = checkpoint.get('train_time', 0.)
+            if 'iteration' in checkpoint:
+                # Saved part way through an epoch, restored when training starts
+                self._resume_state = snapshot_state(
+                    {key: checkpoint[key] for key in ['iteration', 'sampler_state',
+                                                      'lr_state_dict', 'rng_state',
+                                                      'metric_data']})
+                sys.stdout.write(f"\nCheckpoint loaded from {str(path)} resuming epoch: "
+                                 f"{self.epoch + 1} at iteration {checkpoint['iteration']}\n")
+            else:
+                sys.stdout.write(f"\nCheckpoint loaded from {str(path)} "
+                                 f"starting from epoch: {self.epoch}\n")
         else:
             #Raise Error if it does not exist
             sys.stdout.write("\nCheckpoint Does Not Exist, Starting From Scratch!")
 
-    def save_checkpoint(self, path: Path, metrics=False):
+    def save_checkpoint(self, path: Path, metrics=False, links: List[Path] = None,
+                        iteration: int = None):
         '''
-        Saves progress of the model
+        Saves progress of the model, the state is copied to host memory and written
+        in the background. Paths in links are hard linked to the same checkpoint.\n
+        If iteration is given the checkpoint is of the current epoch in progress and
+        includes everything required to resume at that iteration.
         '''
         sys.stdout.write("\nSaving Model")
         if metrics:
             for metric in self.metric_loggers.values():
-                metric.save_epoch()
+                metric.save_epoch(self.epoch)
+
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = AsyncCheckpointWriter()
 
-        torch.save({
+        checkpoint = {
             'model_state_dict'    : self._model.state_dict(),
             'optimizer_state_dict': self._optimizer.state_dict(),
-            'epochs'              : self.epoch
-        }, path)
+            'epochs'              : self.epoch,
+            'train_time'          : self._train_time
+        }
+
+        if iteration is not None:
+            checkpoint['train_time'] += time.time() - self._epoch_start_time
+            checkpoint.update({
+                'epochs'          : self.epoch - 1,
+                'iteration'       : iteration,
+                'sampler_state'   : self._sampler_state_dict(iteration),
+                'lr_state_dict'   : self._lr_manager.state_dict(),
+                'rng_state'       : {
+                    'torch'  : torch.get_rng_state(),
+                    'cuda'   : torch.cuda.get_rng_state_all() \
+                        if torch.cuda.is_available() else None,
+                    'numpy'  : np.random.get_state(),
+                    'python' : random.getstate()
+                },
+                'metric_data'     : {key: logger.metric_data
+                                     for key, logger in self.metric_loggers.items()}
+            })
+
+        self._checkpoint_writer.save(checkpoint, path, links)
+
+    def _sampler_state_dict(self, n_batches: int):
+        """
+        Returns the training sampler's state after n_batches if it is resumable
+        """
+        batch_sampler = self._training_loader.batch_sampler
+        if hasattr(batch_sampler, 'state_dict') and hasattr(batch_sampler.sampler, 'state_dict'):
+            return batch_sampler.state_dict(n_batches)
+        if hasattr(self._training_loader.sampler, 'state_dict'):
+            return self._training_loader.sampler.state_dict(
+                n_batches * self._training_loader.batch_size)
+        return None
+
+    def _restore_epoch_state(self) -> int:
+        """
+        Restores the sampler, RNG, LR and metric state of an epoch in progress
+        from a mid-epoch checkpoint and returns the iteration to resume from
+        """
+        state, self._resume_state = self._resume_state, None
+
+        if state['sampler_state'] is None:
+            sys.stdout.write("\nWarning: Training sampler isn't resumable, "
+                             "epoch order won't match the original\n")
+        elif hasattr(self._training_loader.batch_sampler, 'load_state_dict'):
+            self._training_loader.batch_sampler.load_state_dict(state['sampler_state'])
+        else:
+            self._training_loader.sampler.load_state_dict(state['sampler_state'])
+
+        self._lr_manager.load_state_dict(state['lr_state_dict'])
+
+        torch.set_rng_state(state['rng_state']['torch'])
+        if state['rng_state']['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state['rng_state']['cuda'])
+        np.random.set_state(state['rng_state']['numpy'])
+        random.setstate(state['rng_state']['python'])
+
+        for key, logger in self.metric_loggers.items():
+            logger.new_epoch('training', self.epoch)
+            logger.metric_data = state['metric_data'][key]
+
+        return state['iteration']
 
     def write_summary(self):
         """
@@ -119,9 +302,48 @@ class ModelTrainer(object):
         with open(self._basepath / "Summary.txt", "w") as txt_file:
             txt_file.write(f"{self._model.modelname} Summary, # Epochs: {self.epoch}\n")
             for key, metric in self.metric_loggers.items():
-                value = metric.max_accuracy(main_metric=True)[1]
-                txt_file.write(f"Objective: {key}\tMetric: {metric.main_metric}"
-                               f"\tValue: {value:.3f}\n")
+                best = metric.max_accuracy(main_metric=True)
+                if best is not None:
+                    txt_file.write(f"Objective: {key}\tMetric: {metric.main_metric}"
+                                   f"\tValue: {best[1]:.3f}\n")
+            for key, reached in self._time_to_target.items():
+                txt_file.write(f"Objective: {key}\tTarget: {reached['target']}\t"
+                               f"Reached at epoch {reached['epoch']} after "
+                               f"{reached['time'] / 3600:.2f} h\n")
+
+    def _set_resolution(self):
+        """
+        Applies the resolution curriculum stage of the current epoch to the training
+        dataset, the rand_scale batch sampler's scales are relative to this size
+        """
+        scale, lr_scale = self._resolution_schedule(self.epoch)
+        dataset = self._training_loader.dataset
+        new_size = ResolutionSchedule.scaled_size(self._full_size, scale)
+        if list(dataset.base_size) != new_size:
+            sys.stdout.write(f"\nTraining resolution: {new_size}, lr scale: {lr_scale}\n")
+        dataset.base_size = new_size
+        self._lr_manager.lr_scale = lr_scale
+
+    def _check_targets(self):
+        """
+        Records the epoch and accumulated training time when the best
+        main metric of an objective first reaches its target
+        """
+        new_targets = False
+        for key, target in self._target_metrics.items():
+            if key in self._time_to_target or key not in self.metric_loggers:
+                continue
+            best = self.metric_loggers[key].max_accuracy(main_metric=True)
+            if best is not None and best[0](best[1], target) == best[1]:
+                self._time_to_target[key] = {
+                    'target': target, 'epoch': self.epoch, 'time': self._train_time}
+                sys.stdout.write(f"\n{key} reached {target} at epoch {self.epoch} "
+                                 f"after {self._train_time:.1f}s of training\n")
+                new_targets = True
+
+        if new_targets:
+            with open(self._basepath / "time_to_target.json", "w") as json_file:
+                json.dump(self._time_to_target, json_file, indent=4)
 
     def train_model(self, n_epochs):
         """
@@ -136,68 +358,188 @@ class ModelTrainer(object):
         while self.epoch < max_epoch:
             self.epoch += 1
             epoch_start_time = time.time()
+            self._epoch_start_time = epoch_start_time
 
             # Calculate the training loss, training duration for each epoch, and validation accuracy
-            for metric in self.metric_loggers.values():
-                metric.new_epoch('training')
+            if self._resume_state is not None:
+                start_iter = self._restore_epoch_state()
+            else:
+                start_iter = 0
+                for metric in self.metric_loggers.values():
+                    metric.new_epoch('training', self.epoch)
+
+            if self._resolution_schedule is not None:
+                self._set_resolution()
 
             torch.cuda.empty_cache()
 
             self._model.train()
-            self._train_epoch(max_epoch)
+            self._train_epoch(max_epoch, start_iter)
 
             for metric in self.metric_loggers.values():
-                metric.new_epoch('validation')
+                metric.new_epoch('validation', self.epoch)
 
             torch.cuda.empty_cache()
 
             self._model.eval()
-            self._validate_model(max_epoch)
+            full_validation = self._run_validation(max_epoch)
 
             epoch_duration = time.time() - epoch_start_time
+            self._train_time += epoch_duration
+            self._epoch_start_time = None
 
             if self._checkpoints:
+                best_paths = []
                 for key, logger in self.metric_loggers.items():
+                    # Bests are only selected from full validation passes
+                    if not full_validation:
+                        continue
                     epoch_acc, _ = logger.get_current_statistics(
                         main_metric=True, loss_metric=False)
                     prev_best = logger.max_accuracy(main_metric=True)
                     if prev_best is None or \
                         prev_best[0](epoch_acc[0], prev_best[1]) == epoch_acc[0]:
-                        filename = f"{self._model.modelname}_{key}.pth"
-                        self.save_checkpoint(self._basepath / filename, metrics=False)
+                        best_paths.append(self._basepath / f"{self._model.modelname}_{key}.pth")
 
+                # Written once, the new bests are links to the latest checkpoint
                 self.save_checkpoint(
-                    self._basepath / f"{self._model.modelname}_latest.pth", metrics=True)
+                    self._basepath / f"{self._model.modelname}_latest.pth",
+                    metrics=True, links=best_paths)
 
+                # Needs this epoch's validation statistics to be saved
+                self._check_targets()
                 self.write_summary()
 
             sys.stdout.write(f'\rEpoch {self.epoch} Finished, Time: {epoch_duration}s\n')
             sys.stdout.write("\033[K")
             sys.stdout.flush()
 
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.flush()
+
         train_end_time = time.time()
 
         print(f"\nTotal Traning Time: \t{train_end_time - train_start_time}")
 
-    def _train_epoch(self, max_epoch):
+    def _run_validation(self, max_epoch) -> bool:
+        """
+        Validates according to the validation_cfg cadence, returns true if the
+        epoch's validation statistics are from a full pass and should be kept
+        """
+        interval = self._validation_cfg.get('interval', 1)
+        if self.epoch % interval != 0 and self.epoch != max_epoch:
+            sys.stdout.write(f"\rSkipping validation of epoch {self.epoch}\033[K")
+            return False
+
+        full_interval = self._validation_cfg.get('full_interval', 0)
+        if self._val_subset_loader is not None and \
+                (full_interval == 0 or self.epoch % full_interval != 0):
+            self._validate_model(max_epoch, self._val_subset_loader)
+            new_best = self._subset_may_be_best()
+            for logger in self.metric_loggers.values():
+                logger.discard_epoch()
+            if not new_best:
+                return False
+            sys.stdout.write("\nValidation subset may be a new best, running full validation\n")
+
+        self._validate_model(max_epoch)
+
+        if 'tolerance' in self._validation_cfg:
+            self._update_validation_subset()
+
+        return True
+
+    def _subset_may_be_best(self) -> bool:
+        """
+        True if the best end of the subset's confidence interval
+        beats the best full validation of any objective
+        """
+        for logger in self.metric_loggers.values():
+            samples = logger.get_main_metric_samples()
+            samples = samples[np.isfinite(samples)]
+            prev_best = logger.max_accuracy(main_metric=True)
+            if prev_best is None or samples.shape[0] < 2:
+                return True
+
+            epoch_acc, _ = logger.get_current_statistics(main_metric=True, loss_metric=False)
+            conf = confidence_interval(samples.std(ddof=1), samples.shape[0])
+            optimistic = prev_best[0](epoch_acc[0] - conf, epoch_acc[0] + conf)
+            sys.stdout.write(f"\nSubset {logger.main_metric}: {epoch_acc[0]:.4f} +/- {conf:.4f}")
+            if prev_best[0](optimistic, prev_best[1]) == optimistic:
+                return True
+
+        return False
+
+    def _update_validation_subset(self):
+        """
+        Sizes the validation subset from the spread of each main metric in the full
+        pass just run, the subset only grows so earlier subset results stay comparable
+        """
+        tolerance = self._validation_cfg['tolerance']
+        n_samples = 2
+        for key, logger in self.metric_loggers.items():
+            samples = logger.get_main_metric_samples()
+            samples = samples[np.isfinite(samples)]
+            obj_tol = tolerance[key] if isinstance(tolerance, dict) else tolerance
+            n_samples = max(n_samples, required_samples(
+                samples.std(ddof=1) if samples.shape[0] > 1 else np.inf,
+                obj_tol, len(self._val_strata)))
+
+        if self._val_subset_loader is not None and \
+                n_samples <= len(self._val_subset_loader.dataset):
+            return
+
+        if n_samples >= len(self._val_strata):
+            sys.stdout.write("\nValidation subset would need the full set, disabling it\n")
+            self._val_subset_loader = None
+            return
+
+        subset = torch.utils.data.Subset(
+            self._validation_loader.dataset, self._val_strata.indices(n_samples))
+        self._val_subset_loader = torch.utils.data.DataLoader(
+            subset, batch_size=self._validation_loader.batch_size, shuffle=False,
+            num_workers=self._validation_loader.num_workers,
+            pin_memory=self._validation_loader.pin_memory)
+        sys.stdout.write(f"\nValidation subset: {n_samples}/{len(self._val_strata)} samples\n")
+
+    def _train_epoch(self, max_epoch, start_iter=0):
         start_time = time.time()
 
-        for batch_idx, batch_data in enumerate(self._training_loader):
+        loader = self._training_loader
+        if start_iter > 0 and self._sampler_state_dict(0) is None:
+            # Sampler can't skip ahead so the finished batches are loaded and discarded
+            loader = itertools.islice(loader, start_iter, None)
+
+        # Samplers that learn from the loss, e.g. LossImportanceSampler
+        sampler = getattr(self._training_loader.batch_sampler, 'sampler', None)
+        if not hasattr(sampler, 'update_losses'):
+            sampler = None
+
+        for batch_idx, batch_data in enumerate(loader, start_iter):
             cur_lr = self._lr_manager(batch_idx)
             for param_group in self._optimizer.param_groups:
                 param_group['lr'] = cur_lr
 
-            self._data_to_gpu(batch_data)
+            self._data_to_gpu(batch_data, self._memory_format)
 
             # Computer loss, use the optimizer object to zero all of the gradients
             # Then backpropagate and step the optimizer
             forward = self._model(**batch_data)
-            losses = self.calculate_losses(forward, batch_data)
+            if sampler is not None:
+                # Each sample's loss is weighted by 1/(N*p) of its sampling probability
+                losses = self.calculate_losses(forward, batch_data, reduction='none')
+                sample_loss = sum(losses.values())
+                indices = sampler.next_batch(sample_loss.shape[0])
+                loss = (sampler.importance_weight(indices).to(sample_loss) * sample_loss).mean()
+                sampler.update_losses(indices, sample_loss.detach())
+                losses = {key: losses[key].mean() for key in losses}
+            else:
+                losses = self.calculate_losses(forward, batch_data)
 
-            # Accumulate losses
-            loss = 0
-            for key in losses:
-                loss += losses[key]
+                # Accumulate losses
+                loss = 0
+                for key in losses:
+                    loss += losses[key]
 
             self._optimizer.zero_grad()
             loss.backward()
@@ -205,9 +547,16 @@ class ModelTrainer(object):
 
             self.log_output_performance(forward, batch_data, losses)
 
+            if self._checkpoints and self._checkpoint_interval > 0 and \
+                    (batch_idx + 1) % self._checkpoint_interval == 0 and \
+                    batch_idx + 1 < len(self._training_loader):
+                self.save_checkpoint(
+                    self._basepath / f"{self._model.modelname}_latest.pth",
+                    iteration=batch_idx + 1)
+
             if not batch_idx % 10:
                 time_elapsed = time.time() - start_time
-                time_remain = time_elapsed / (batch_idx + 1) * \
+                time_remain = time_elapsed / (batch_idx + 1 - start_iter) * \
                     (len(self._training_loader) - (batch_idx + 1))
 
                 sys.stdout.write(f'\rTrain Epoch: [{self.epoch:2d}/{max_epoch:2d}] || '
@@ -220,12 +569,13 @@ class ModelTrainer(object):
                 sys.stdout.flush()
 
     @torch.no_grad()
-    def _validate_model(self, max_epoch):
+    def _validate_model(self, max_epoch, loader=None):
         start_time = time.time()
+        loader = self._validation_loader if loader is None else loader
 
-        for batch_idx, batch_data in enumerate(self._validation_loader):
+        for batch_idx, batch_data in enumerate(loader):
             # Put both image and target onto device
-            self._data_to_gpu(batch_data)
+            self._data_to_gpu(batch_data, self._memory_format)
 
             # Caculate the loss and accuracy for the predictions
             forward = self._model(**batch_data)
@@ -235,7 +585,7 @@ class ModelTrainer(object):
 
             if not batch_idx % 10:
                 sys.stdout.write(f'\rValidaton Epoch: [{self.epoch:2d}/{max_epoch:2d}] || '
-                                 f'Iter: [{batch_idx+1:4d}/{len(self._validation_loader):4d}]')
+                                 f'Iter: [{batch_idx+1:4d}/{len(loader):4d}]')
 
                 if 'seg' in self.metric_loggers.keys():
                     sys.stdout.write(f" || {self.metric_loggers['seg'].main_metric}: "\
@@ -249,20 +599,29 @@ class ModelTrainer(object):
 
                 time_elapsed = time.time() - start_time
                 time_remain = time_elapsed/(batch_idx+1)*\
-                    (len(self._validation_loader)-batch_idx+1)
+                    (len(loader)-batch_idx+1)
                 sys.stdout.write(f' || Time Elapsed: {time_elapsed:.1f} s'\
                                  f' Remain: {time_remain:.1f} s')
                 sys.stdout.write("\033[K")
                 sys.stdout.flush()
 
     @staticmethod
-    def _data_to_gpu(data):
+    def _data_to_gpu(data, memory_format=torch.contiguous_format):
         # Put both image and target onto device
         cuda_s = torch.cuda.Stream()
         with torch.cuda.stream(cuda_s):
             for key in data:
-                if key in ['l_img', 'l_seq', 'seg', 'l_disp', 'r_img', 'r_seq', 'r_disp']:
+                if key in ['l_img', 'l_seq', 'r_img', 'r_seq']:
+                    data[key] = data[key].cuda(non_blocking=True).contiguous(
+                        memory_format=memory_format)
+                elif key in ['seg', 'l_disp', 'r_disp', 'pose']:
                     data[key] = data[key].cuda(non_blocking=True)
+                elif key == 'cam':
+                    data[key] = {name: value.cuda(non_blocking=True)
+                                 for name, value in data[key].items()}
+                elif key in ['l_img_pyr', 'l_seq_pyr']:
+                    data[key] = [feats.cuda(non_blocking=True).contiguous(
+                        memory_format=memory_format) for feats in data[key]]
 
             if all(key in data.keys() for key in ["flow", "flow_mask"]):
                 data['flow_gt'] = {"flow": data['flow'].cuda(non_blocking=True),
@@ -272,6 +631,9 @@ class ModelTrainer(object):
                 data['flow_gt'] = None
         cuda_s.synchronize()
 
+        # Resized images etc. shared by the losses and loggers of this batch
+        data['pyramid_cache'] = PyramidCache()
+
     @torch.no_grad()
     def log_output_performance(self, nnet_outputs: Dict[str, torch.Tensor],
                                batch_data: Dict[str, torch.Tensor],
@@ -282,7 +644,8 @@ class ModelTrainer(object):
         if 'flow' in self.metric_loggers:
             self.metric_loggers['flow'].add_sample(
                 batch_data['l_img'], batch_data['l_seq'], nnet_outputs['flow'][0],
-                batch_data['flow_gt'], loss=losses['flow'].item()
+                batch_data['flow_gt'], loss=losses['flow'].item(),
+                cache=batch_data.get('pyramid_cache', None)
             )
 
         if 'seg' in self.metric_loggers:
@@ -294,30 +657,16 @@ class ModelTrainer(object):
         if 'depth' in self.metric_loggers:
             self.metric_loggers['depth'].add_sample(
                 nnet_outputs['depth'], batch_data['l_disp'],
-                loss=losses['depth'].item()
+                loss=losses['depth'].item(), cache=batch_data.get('pyramid_cache', None)
             )
 
     def calculate_losses(self, nnet_outputs: Dict[str, torch.Tensor],
-                         batch_data: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+                         batch_data: Dict[str, torch.Tensor],
+                         reduction='mean') -> Dict[str, torch.Tensor]:
         """
         Calculates losses for different outputs and loss functions
         """
-        losses = {}
-
-        if 'flow' in self._loss_fn:
-            losses['flow'], _, _, _ = self._loss_fn['flow'](
-                pred_flow_fw=nnet_outputs['flow'], pred_flow_bw=nnet_outputs['flow_b'],
-                im1_origin=batch_data['l_img'], im2_origin=batch_data['l_seq'])
-
-        if 'segmentation' in self._loss_fn:
-            losses['seg'] = self._loss_fn['segmentation'](
-                seg_pred=nnet_outputs, seg_gt=batch_data['seg'])
-
-        if 'depth' in self._loss_fn:
-            losses['depth'] = self._loss_fn['depth'](
-                disp_pred=nnet_outputs['depth'], disp_gt=batch_data['l_disp'])
-
-        return losses
+        return calculate_losses(self._loss_fn, nnet_outputs, batch_data, reduction)
 
     def plot_data(self):
         """
@@ -341,7 +690,7 @@ class ModelTrainer(object):
         self._model.eval()
 
         batch_data = next(iter(self._validation_loader))
-        self._data_to_gpu(batch_data)
+        self._data_to_gpu(batch_data, self._memory_format)
 
         start_time = time.time()
         forward = self._model(**batch_data)
@@ -357,7 +706,8 @@ class ModelTrainer(object):
             seg_pred_cpu = torch.argmax(forward['seg'], dim=1).cpu().numpy()
 
         if 'flow' in forward:
-            np_flow_12 = forward['flow'][0].detach().type(torch.float32).cpu().numpy()
+            np_flow_12 = upsample_flow(forward['flow'][0].detach().type(torch.float32),
+                                       batch_data['l_img'].shape[2:]).cpu().numpy()
 
         if hasattr(self._validation_loader.dataset, 'img_normalize'):
             img_mean = self._validation_loader.dataset.img_normalize.mean
@@ -401,12 +751,12 @@ class ModelTrainer(object):
             if 'depth' in forward and 'l_disp' in batch_data:
                 plt.subplot(2, 4, 4)
                 plt.imshow(depth_gt_cpu[i], cmap='magma',
-                           vmin=MIN_DEPTH, vmax=MAX_DEPTH)
+                           vmin=MIN_DEPTH, vmax=self._max_depth)
                 plt.xlabel("Ground Truth Disparity")
 
                 plt.subplot(2, 4, 8)
                 plt.imshow(depth_pred_cpu[i, 0], cmap='magma',
-                           vmin=MIN_DEPTH, vmax=MAX_DEPTH)
+                           vmin=MIN_DEPTH, vmax=self._max_depth)
                 plt.xlabel("Predicted Depth")
 
             plt.suptitle("Propagation time: " + str(propagation_time))
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+"""
+Progressive resolution curriculum, early epochs train at a fraction of output_size
+"""
+
+__author__ = "Bryce Ferenczi"
+__email__ = "bryce.ferenczi@monashmotorsport.com"
+
+import bisect
+from typing import List, Tuple
+
+__all__ = ['ResolutionSchedule']
+
+class ResolutionSchedule(object):
+    """
+    Piecewise constant schedule of the training resolution.\n
+    epochs: the epoch (counted from 1) each stage starts at, in ascending order\n
+    scales: fraction of the configured output_size used in each stage\n
+    lr_scales: optional multiplier of the learning rate in each stage\n
+    Example: {"epochs": [1, 10, 20], "scales": [0.5, 0.75, 1.0]}
+    """
+    def __init__(self, epochs: List[int], scales: List[float], lr_scales: List[float] = None):
+        assert len(epochs) == len(scales), "A scale is required for each stage"
+        assert all(start < end for start, end in zip(epochs[:-1], epochs[1:])), \
+            "Stage epochs must be ascending"
+        if lr_scales is not None:
+            assert len(lr_scales) == len(scales), "A lr scale is required for each stage"
+
+        self.epochs = epochs
+        self.scales = scales
+        self.lr_scales = lr_scales if lr_scales is not None else [1.] * len(scales)
+
+    def __call__(self, epoch: int) -> Tuple[float, float]:
+        """
+        Returns the resolution and learning rate scale of an epoch
+        """
+        stage = bisect.bisect_right(self.epochs, epoch) - 1
+        if stage < 0:
+            return 1., 1.
+        return self.scales[stage], self.lr_scales[stage]
+
+    @staticmethod
+    def scaled_size(output_size: List[int], scale: float) -> List[int]:
+        """
+        Scaled output size rounded down to a multiple of 32 like rand_scale
+        """
+        return [int(scale * x / 32.0) * 32 for x in output_size]
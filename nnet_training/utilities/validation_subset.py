@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+"""
+Fixed stratified subset of a validation set, sized so the confidence
+interval of the main metric estimated from it stays within a tolerance
+"""
+
+__author__ = "Bryce Ferenczi"
+__email__ = "bryce.ferenczi@monashmotorsport.com"
+
+import os
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from nnet_training.utilities.metrics import confidence_interval
+
+__all__ = ['required_samples', 'StratifiedSubset']
+
+def required_samples(std: float, tolerance: float, n_max: int) -> int:
+    """
+    Smallest number of samples where the confidence interval of
+    the mean is within the tolerance, capped at n_max
+    """
+    if not np.isfinite(std) or tolerance <= 0:
+        return n_max
+    # Normal approximation as a starting point, then step up with the t distribution
+    n_samples = max(int(np.ceil((1.645 * std / tolerance) ** 2)), 2)
+    while n_samples < n_max and confidence_interval(std, n_samples) > tolerance:
+        n_samples += 1
+    return min(n_samples, n_max)
+
+class StratifiedSubset(object):
+    """
+    Samples of each stratum (the folder of each image, i.e. the city for Cityscapes)
+    are drawn in a fixed random order, a subset of any size takes its share from the
+    front of each so subsets grow without changing the samples already in them.
+    """
+    def __init__(self, dataset: torch.utils.data.Dataset, seed=0):
+        strata: Dict[str, List[int]] = {}
+        if hasattr(dataset, 'l_img'):
+            for idx, path in enumerate(dataset.l_img):
+                strata.setdefault(os.path.basename(os.path.dirname(path)), []).append(idx)
+        else:
+            strata[''] = list(range(len(dataset)))
+
+        rng = np.random.RandomState(seed)
+        self._strata = [rng.permutation(indices).tolist() for _, indices in sorted(strata.items())]
+        self._n_total = len(dataset)
+
+    def __len__(self):
+        return self._n_total
+
+    def indices(self, n_samples: int) -> List[int]:
+        """
+        Dataset indices of a subset of n_samples with each stratum proportionally represented
+        """
+        n_samples = min(n_samples, self._n_total)
+        shares = [len(stratum) * n_samples / self._n_total for stratum in self._strata]
+        counts = [int(share) for share in shares]
+
+        # Hand out the remainder to the strata with the largest rounding loss
+        remainder = sorted(range(len(shares)), key=lambda i: counts[i] - shares[i])
+        for idx in remainder[:n_samples - sum(counts)]:
+            counts[idx] += 1
+
+        return sorted(idx for stratum, count in zip(self._strata, counts)
+                      for idx in stratum[:count])